@@ -0,0 +1,1420 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+benchmarks.py
+بنچمارک‌های محلی ربات (بدون اتصال به تلگرام)
+
+    python benchmarks.py storage [--users 5000] [--items 6]
+    python benchmarks.py io [--users 5000]
+    python benchmarks.py commit [--users 500]
+    python benchmarks.py reports [--users 5000] [--items 6]
+    python benchmarks.py export [--users 10000] [--products 200]
+    python benchmarks.py lookups [--users 5000] [--products 200]
+    python benchmarks.py broadcast [--pending 20] [--admins 5] [--latency 0.05]
+    python benchmarks.py stress [--users 500] [--latency 0.002]
+    python benchmarks.py approvals [--pending 200] [--admins 5] [--latency 0.002]
+    python benchmarks.py records [--count 100000] [--products 200]
+    python benchmarks.py render [--users 2000] [--products 200] [--repeat 200]
+    python benchmarks.py workers [--users 200] [--rounds 3] [--workers 1,2,4] [--latency 0.002]
+    python benchmarks.py coldstart [--users 5000] [--backend json] [--boots 3]
+    python benchmarks.py load [--users 200] [--rounds 3] [--backend json] [--workers 1] [--latency 0.002]
+    python benchmarks.py metrics [--users 300] [--repeat 200]
+
+--out FILE ذخیرهٔ نتیجه (به‌همراه commit و مشخصات سیستم)؛ --baseline FILE مقایسه با نتیجهٔ یک commit دیگر.
+
+همه‌چیز داخل یک پوشهٔ موقت اجرا می‌شود و به ./data دست نمی‌زند.
+"""
+
+import argparse
+import asyncio
+import atexit
+import contextlib
+import json
+import math
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+# main.py needs a token and reads ./data at import time: give it a throwaway one
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+_WORKDIR = tempfile.mkdtemp(prefix="bookshop-bench-")
+atexit.register(shutil.rmtree, _WORKDIR, ignore_errors=True)
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+_CALLER_DIR = Path.cwd()   # --out / --baseline paths are relative to where we were started
+os.chdir(_WORKDIR)
+
+import main  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+TYPES = ["رنگی کیفیت بالا", "رنگی کیفیت پایین", "سیاه و سفید"]
+
+
+# ---------------- synthetic data ----------------
+def make_dataset(n_users: int, n_products: int = 200, items_per_user: int = 6, seed: int = 1):
+    rnd = random.Random(seed)
+    products = {
+        str(i): {"title": f"جزوه {i}", "color_high_price": 1000, "color_low_price": 700, "bw_price": 400}
+        for i in range(1, n_products + 1)
+    }
+
+    def items():
+        out = []
+        for _ in range(items_per_user):
+            pid = str(rnd.randint(1, n_products))
+            out.append({
+                "product_id": pid,
+                "title": products[pid]["title"],
+                "type": rnd.choice(TYPES),
+                "qty": rnd.randint(1, 3),
+                "unit_price": 1000,
+            })
+        return out
+
+    users, orders, purchases, payments = {}, {}, {}, {}
+    for n in range(n_users):
+        uid = 10_000 + n
+        key = str(uid)
+        users[key] = {"first_name": f"نام{n}", "last_name": "خانوادگی", "is_dorm": n % 2 == 0,
+                      "dorm_name": "خوابگاه دانش" if n % 2 == 0 else None, "cart": items()[:2]}
+        order = {"order_id": str(uuid.UUID(int=rnd.getrandbits(128))), "user_id": uid, "items": items(), "total": 1000,
+                 "timestamp": "2024-01-01T00:00:00", "paid": False}
+        orders[key] = [order]
+        purchases[key] = [{"purchase_id": str(uuid.UUID(int=rnd.getrandbits(128))), "user_id": uid,
+                           "items": items(), "total": 1000, "timestamp": "2024-01-01T00:00:00"}]
+        pay_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+        payments[pay_id] = {"payment_id": pay_id, "user_id": uid, "order_id": order["order_id"],
+                            "items": order["items"], "total": 1000, "file_id": "x",
+                            "status": "pending" if n % 10 == 0 else "approved"}
+    return {
+        "users": users, "products": products, "orders": orders, "pending_payments": payments,
+        "purchases": purchases, "blocked": [], "admins": [],
+    }
+
+
+def _timeit(fn, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return {
+        "mean_us": round(statistics.fmean(samples) * 1e6, 1),
+        "p95_us": round(samples[math.ceil(len(samples) * 0.95) - 1] * 1e6, 1),
+    }
+
+
+# ---------------- storage ----------------
+def _seed(backend: str, directory: Path, data: dict):
+    if backend == "sqlite":
+        store = main.SqliteStorage(directory / "bookshop.db")
+        with store.conn:
+            store._replace_all(data)
+        store.close()
+    else:
+        for name, path in main.COLLECTION_FILES.items():
+            if name in data:   # sessions are not part of the synthetic data
+                main.save_json(directory / path.name, data[name])
+
+
+def bench_storage(n_users: int, items_per_user: int, repeat: int) -> dict:
+    data = make_dataset(n_users, items_per_user=items_per_user)
+    results = {}
+
+    # what every mutation used to cost: all seven files rewritten with indent=2
+    legacy_dir = Path(tempfile.mkdtemp(dir=_WORKDIR))
+
+    def full_rewrite():
+        for name, value in data.items():
+            (legacy_dir / main.COLLECTION_FILES[name].name).write_text(
+                json.dumps(value, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    results["legacy_persist_all"] = {"mutation": _timeit(full_rewrite, max(3, repeat // 50))}
+
+    for backend in ("json", "sqlite"):
+        directory = Path(tempfile.mkdtemp(dir=_WORKDIR))
+        _seed(backend, directory, data)
+        t0 = time.perf_counter()
+        store = main.SqliteStorage(directory / "bookshop.db") if backend == "sqlite" else main.JsonLogStorage(directory)
+        colls = store.load()
+        load_s = time.perf_counter() - t0
+        keys = list(colls["users"])
+        rnd = random.Random(2)
+
+        def cart_edit():
+            key = rnd.choice(keys)
+            colls["users"][key]["cart"].append({"product_id": "1", "title": "جزوه 1", "type": TYPES[0], "qty": 1, "unit_price": 1})
+            store.write([main.encode_change({"c": "users", "k": key, "v": colls["users"][key]})])
+
+        def finalize():
+            key = rnd.choice(keys)
+            store.write([main.encode_change({"c": "orders", "k": key, "v": colls["orders"][key]}),
+                         main.encode_change({"c": "users", "k": key, "v": colls["users"][key]})])
+
+        def rename():
+            # names live only on the user record: one write, whatever the history
+            key = rnd.choice(keys)
+            colls["users"][key]["last_name"] = f"جدید {rnd.random()}"
+            store.write([main.encode_change({"c": "users", "k": key, "v": colls["users"][key]})])
+
+        def purchased_report():
+            store.type_totals("purchases")
+
+        def product_drilldown():
+            store.user_totals("orders", str(rnd.randint(1, 200)), TYPES[0])
+
+        results[backend] = {
+            "load_s": round(load_s, 3),
+            "cart_edit": _timeit(cart_edit, repeat),
+            "finalize": _timeit(finalize, repeat),
+            "rename": _timeit(rename, repeat),
+            "type_totals": _timeit(purchased_report, max(3, repeat // 20)),
+            "user_totals": _timeit(product_drilldown, repeat),
+        }
+        store.close()
+    return results
+
+
+def _export_args(data: dict) -> tuple:
+    # what the "📊" handler collects on the loop before handing off to the pool
+    return (
+        list(data["users"]),
+        [main.make_disp_name(u) for u in data["users"].values()],
+        list(dict.fromkeys(p["title"] for p in data["products"].values())),
+        main.purchase_items_long(data["purchases"]),
+    )
+
+
+# ---------------- event-loop stalls ----------------
+async def _max_loop_lag(work, interval: float = 0.005) -> dict:
+    loop = asyncio.get_running_loop()
+    lags = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(max(0.0, loop.time() - start - interval))
+
+    probe_task = asyncio.create_task(probe())
+    t0 = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - t0
+    done.set()
+    await probe_task
+    return {"max_lag_ms": round(max(lags, default=0.0) * 1000, 1), "total_s": round(elapsed, 3)}
+
+
+def bench_io(n_users: int, rounds: int) -> dict:
+    data = make_dataset(n_users)
+    # what the "📤 دریافت بکاپ" handler zips: the backup collections, no sessions
+    colls = {name: data[name] for name in main.BACKUP_COLLECTIONS}
+    names = [main.COLLECTION_FILES[name].name for name in main.BACKUP_COLLECTIONS]
+    export_args = _export_args(data)
+    xlsx = Path(_WORKDIR) / "bench.xlsx"
+
+    async def inline():
+        for _ in range(rounds):
+            main.build_backup_zip(main.snapshot_payloads(colls), names)
+            await asyncio.sleep(0)
+            main.export_purchases(*export_args, xlsx)
+            await asyncio.sleep(0)
+
+    async def offloaded():
+        for _ in range(rounds):
+            await main.io_executor.run(main.build_backup_zip, main.snapshot_payloads(colls), names, kind="backup_zip")
+            await main.io_executor.run(main.export_purchases, *export_args, xlsx, kind="excel", cpu=True)
+
+    async def run_all():
+        return {
+            "inline": await _max_loop_lag(inline),
+            "executor": await _max_loop_lag(offloaded),
+        }
+
+    results = asyncio.run(run_all())
+    results["executor"]["io_stats"] = main.io_executor.stats()["timings"]
+    main.io_executor.shutdown()
+    return results
+
+
+# ---------------- group commit ----------------
+def bench_commit(n_users: int) -> dict:
+    data = make_dataset(n_users, items_per_user=3)
+    main.users.update(data["users"])
+    keys = list(data["users"])
+
+    async def finalize(key: str, one_by_one: bool):
+        u = main.users[key]
+        main.orders.setdefault(key, []).append({"order_id": str(uuid.uuid4()), "user_id": int(key),
+                                                 "items": u["cart"], "total": 1})
+        u["cart"] = []
+        if one_by_one:
+            # one fsync'd write per finalization, like a flush per handler
+            lines = [main.encode_change({"c": "orders", "k": key, "v": main.orders[key]}),
+                     main.encode_change({"c": "users", "k": key, "v": u})]
+            await main.committer.call(main.storage.write, lines)
+        else:
+            main.persist("orders", key)
+            await main.persist("users", key)
+
+    async def burst(one_by_one: bool) -> dict:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(finalize(k, one_by_one) for k in keys))
+        elapsed = time.perf_counter() - t0
+        return {"total_s": round(elapsed, 3), "per_second": round(len(keys) / elapsed, 1)}
+
+    async def grouped(window_ms: int) -> dict:
+        main.committer.window = window_ms / 1000
+        before = main.committer.stats["batches"]
+        result = await burst(False)
+        result["batches"] = main.committer.stats["batches"] - before
+        return result
+
+    async def run_all():
+        results = {"one_write_each": await burst(True)}
+        # 0 is the default: commit as soon as the writer is free
+        for window_ms in (0, 50):
+            results[f"group_commit_{window_ms}ms"] = await grouped(window_ms)
+        main.committer.window = main.COMMIT_WINDOW_MS / 1000
+        return results
+
+    return asyncio.run(run_all())
+
+
+# ---------------- admin reports ----------------
+def bench_reports(n_users: int, items_per_user: int, repeat: int) -> dict:
+    data = make_dataset(n_users, items_per_user=items_per_user)
+    store = main.JsonLogStorage(Path(tempfile.mkdtemp(dir=_WORKDIR)))
+    store.colls = data
+    keys = list(data["orders"])
+    rnd = random.Random(3)
+
+    t0 = time.perf_counter()
+    agg = main.ItemAggregates(data["orders"]).ready()
+    build_s = time.perf_counter() - t0
+
+    def drilldown_args():
+        return str(rnd.randint(1, 200)), rnd.choice(TYPES)
+
+    def item_removed():
+        # what persist("orders", key) costs after an edit to one user's orders
+        key = rnd.choice(keys)
+        items = data["orders"][key][0]["items"]
+        items.append(items.pop(0))
+        agg.refresh_user(key)
+
+    return {
+        "full_scan": {
+            "type_totals": _timeit(lambda: store.type_totals("orders"), max(3, repeat // 20)),
+            "user_totals": _timeit(lambda: store.user_totals("orders", *drilldown_args()), max(3, repeat // 20)),
+        },
+        "aggregates": {
+            "build_s": round(build_s, 3),
+            "type_totals": _timeit(agg.type_totals, repeat),
+            "user_totals": _timeit(lambda: agg.user_totals(*drilldown_args()), repeat),
+            "refresh_user": _timeit(item_removed, repeat),
+        },
+    }
+
+
+# ---------------- purchases export ----------------
+def _legacy_export(data: dict, path: Path) -> float:
+    # the previous handler: users × products × purchases × items, matched by title
+    import pandas as pd
+    users, purchases = data["users"], data["purchases"]
+    all_products = list(data["products"].values())
+    t0 = time.perf_counter()
+    rows = []
+    for uid_k, u in users.items():
+        row = {"نام": main.make_disp_name(u)}
+        for p in all_products:
+            found_items = []
+            for pur in purchases.get(str(uid_k), []):
+                for it in pur.get('items', []):
+                    if it.get('title') == p['title']:
+                        found_items.append(f"{it['type']} × {it['qty']}")
+            row[p['title']] = " / ".join(found_items) if found_items else 0
+        rows.append(row)
+    rows.sort(key=lambda r: (1, r['نام']) if "تهران" in r['نام'] else (0, r['نام']))
+    rows_s = time.perf_counter() - t0
+    pd.DataFrame(rows).to_excel(path, index=False)
+    return rows_s
+
+
+def bench_export(n_users: int, n_products: int, items_per_user: int) -> dict:
+    data = make_dataset(n_users, n_products=n_products, items_per_user=items_per_user)
+    out = Path(_WORKDIR)
+    results = {}
+
+    t0 = time.perf_counter()
+    rows_s = _legacy_export(data, out / "legacy.xlsx")
+    results["legacy"] = {"on_loop_s": round(rows_s, 3), "total_s": round(time.perf_counter() - t0, 3)}
+
+    for fmt in main.EXPORT_FORMATS:
+        t0 = time.perf_counter()
+        args = _export_args(data)
+        collect_s = time.perf_counter() - t0
+        frame = main.build_purchase_frame(*args)
+        pivot_s = time.perf_counter() - t0 - collect_s
+        written = main.write_table(frame, out / f"bench.{fmt}", fmt) if fmt != "parquet" else \
+            main.export_purchases(*args, out / f"bench.{fmt}", fmt)
+        results[f"pipeline_{fmt}"] = {
+            "on_loop_s": round(collect_s, 3),
+            "pivot_s": round(pivot_s, 3),
+            "total_s": round(time.perf_counter() - t0, 3),
+            "file": written.name,
+            "mb": round(written.stat().st_size / 1e6, 2),
+        }
+    return results
+
+
+# ---------------- index lookups ----------------
+def bench_lookups(n_users: int, n_products: int, items_per_user: int, repeat: int) -> dict:
+    data = make_dataset(n_users, n_products=n_products, items_per_user=items_per_user)
+    t0 = time.perf_counter()
+    idx = main.RecordIndexes(data)
+    build_s = time.perf_counter() - t0
+    rnd = random.Random(4)
+    titles = [p["title"] for p in data["products"].values()]
+    order_ids = [(k, lst[0]["order_id"]) for k, lst in data["orders"].items()]
+
+    def title_scan():
+        title = rnd.choice(titles)
+        next(pid for pid, p in data["products"].items() if p.get("title") == title)
+
+    def order_scan():
+        key, oid = rnd.choice(order_ids)
+        next(o for o in data["orders"].get(key, []) if o.get("order_id") == oid)
+
+    def delete_scope_scan():
+        pid = str(rnd.randint(1, n_products))
+        [k for k, lst in data["orders"].items() if any(it.get("product_id") == pid for o in lst for it in o["items"])]
+
+    return {
+        "scan": {
+            "by_title": _timeit(title_scan, repeat),
+            "order_id": _timeit(order_scan, repeat),
+            "delete_scope": _timeit(delete_scope_scan, max(3, repeat // 20)),
+        },
+        "indexed": {
+            "build_s": round(build_s, 3),
+            "by_title": _timeit(lambda: idx.product_by_title(rnd.choice(titles)), repeat),
+            "order_id": _timeit(lambda: idx.order(*reversed(rnd.choice(order_ids))), repeat),
+            "delete_scope": _timeit(lambda: idx.users_referencing("orders", str(rnd.randint(1, n_products))), repeat),
+        },
+    }
+
+
+# ---------------- broadcast ----------------
+class FakeBot:
+    """Bot API stand-in: fixed latency, 429s for chats that send too fast, a few blocked chats"""
+
+    def __init__(self, latency: float, chat_interval: float, blocked=()):
+        from telegram.error import Forbidden, RetryAfter
+        self._Forbidden, self._RetryAfter = Forbidden, RetryAfter
+        self.latency = latency
+        self.chat_interval = chat_interval
+        self.blocked = set(blocked)
+        self.last_sent = {}
+        self.delivered = {}
+        self.rejected_429 = 0
+
+    async def send_photo(self, chat_id, photo, caption=None, **_):
+        # the server sees the request half a round trip in
+        await asyncio.sleep(self.latency / 2)
+        try:
+            if chat_id in self.blocked:
+                raise self._Forbidden("bot was blocked by the user")
+            now = time.monotonic()
+            if now - self.last_sent.get(chat_id, -1e9) < self.chat_interval:
+                self.rejected_429 += 1
+                raise self._RetryAfter(1)
+            self.last_sent[chat_id] = now
+            self.delivered.setdefault(chat_id, []).append(caption)
+        finally:
+            await asyncio.sleep(self.latency / 2)
+
+
+def bench_broadcast(n_pending: int, n_admins: int, latency: float) -> dict:
+    chats = list(range(1, n_admins + 1))
+    captions = [f"receipt {i}" for i in range(n_pending)]
+    # bursts of 3 are fine, a sustained flood to one chat gets a 429
+    chat_interval = 1.0 / 3
+
+    async def sequential():
+        bot = FakeBot(latency, chat_interval, blocked=[chats[-1]])
+        failed = 0
+        for caption in captions:
+            for chat_id in chats:
+                try:
+                    await bot.send_photo(chat_id=chat_id, photo="x", caption=caption)
+                except Exception:
+                    failed += 1
+        return bot, failed
+
+    async def fanout():
+        bot = FakeBot(latency, chat_interval, blocked=[chats[-1]])
+        b = main.Broadcaster(chat_rate=3, chat_burst=1)
+        jobs = [(chat_id, (lambda c, caption=caption: bot.send_photo(chat_id=c, photo="x", caption=caption)))
+                for caption in captions for chat_id in chats]
+        results = await b.run(jobs)
+        return bot, sum(not r["ok"] for r in results), b.stats
+
+    async def run_all():
+        out = {}
+        t0 = time.perf_counter()
+        bot, failed = await sequential()
+        out["sequential"] = {"total_s": round(time.perf_counter() - t0, 3), "failed": failed,
+                             "rejected_429": bot.rejected_429}
+        t0 = time.perf_counter()
+        bot, failed, stats = await fanout()
+        in_order = all(bot.delivered.get(c, []) == captions for c in chats[:-1])
+        out["broadcaster"] = {"total_s": round(time.perf_counter() - t0, 3), "failed": failed,
+                              "rejected_429": bot.rejected_429, "in_order": in_order, **stats}
+        return out
+
+    return asyncio.run(run_all())
+
+
+# ---------------- concurrent users ----------------
+class FakeBotApi(BaseRequest):
+    """Bot API stand-in for driving the real handlers: fixed round trip, remembers what was sent where"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.outbox = {}   # chat_id -> texts the bot sent there
+        self.calls = {}
+        self.updates = 0
+        self._update_ids = iter(range(1, 10 ** 9))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **_):
+        # handlers really interleave at every send
+        await asyncio.sleep(self.latency)
+        params = dict(request_data.parameters) if request_data is not None else {}
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif endpoint in ("sendMessage", "sendPhoto"):
+            chat_id = int(params["chat_id"])
+            self.outbox.setdefault(chat_id, []).append(params.get("text") or params.get("caption"))
+            result = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    async def install(self):
+        app = main.application
+        # keep the Bot API instrumentation main.py would have put in front of the real client
+        request = main.InstrumentedRequest(self) if main.METRICS else self
+        app.bot._request = (request, request)
+        await app.initialize()
+
+    def message(self, uid: int, text: str = None, photo: str = None) -> dict:
+        self.updates += 1
+        m = {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"},
+             "from": {"id": uid, "is_bot": False, "first_name": "u"}}
+        if text is not None:
+            m["text"] = text
+            if text.startswith("/"):
+                m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        if photo:
+            m["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}]
+        return {"update_id": next(self._update_ids), "message": m}
+
+    def button(self, uid: int, data: str, callback_id: str = None) -> dict:
+        self.updates += 1
+        n = next(self._update_ids)
+        return {"update_id": n, "callback_query": {
+            "id": callback_id or str(n), "chat_instance": "bench", "data": data,
+            "from": {"id": uid, "is_bot": False, "first_name": "admin"},
+            "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "caption": "receipt"}}}
+
+    @staticmethod
+    async def process(body: dict):
+        from telegram import Update
+        await main.application.process_update(Update.de_json(body, main.application.bot))
+
+
+def _seed_products(titles: list):
+    for i, title in enumerate(titles, 1):
+        main.products[str(i)] = {"title": title, "color_high_price": 300, "color_low_price": 200, "bw_price": 100}
+        main.persist("products", str(i))
+
+
+def bench_stress(n_users: int, latency: float, seed: int = 1) -> dict:
+    """n_users کاربر هم‌زمان سبد می‌سازند و فیش می‌فرستند؛ دو ادمین هم‌زمان تایید/رد می‌کنند"""
+    rng = random.Random(seed)
+    api = FakeBotApi(latency)
+    message, button, process = api.message, api.button, api.process
+    outbox = api.outbox
+
+    titles = [f"جزوه {i}" for i in range(1, 11)]
+    admin_a, admin_b = 10 ** 9 + 1, 10 ** 9 + 2
+    users = list(range(1001, 1001 + n_users))
+    items_each = 3
+
+    async def shopper(uid: int):
+        steps = [message(uid, "/start"), message(uid, "📝 ثبت اطلاعات هویتی"),
+                 message(uid, f"کاربر شماره{uid}"), message(uid, "تهرانی")]
+        for _ in range(items_each):
+            steps += [message(uid, "🛒 انتخاب جزوه"), message(uid, rng.choice(titles)),
+                      message(uid, "⬛ سیاه سفید"), message(uid, str(rng.randint(1, 5)))]
+        steps += [message(uid, "✅ ثبت نهایی سبد خرید"), message(uid, "💳 خرید جزوات نهایی شده"),
+                  message(uid, "سفارش: 1 - 0 تومان"), message(uid, photo=f"receipt-{uid}")]
+        for body in steps:
+            await process(body)
+
+    clicked = set()
+
+    async def admins_at_work(shoppers: asyncio.Future):
+        # both admins hit approve and reject on every receipt at the same time, plus a double tap
+        clicks = []
+        while True:
+            done = shoppers.done()
+            for pay_id in [p for p in main.pending_payments if p not in clicked]:
+                clicked.add(pay_id)
+                one, other = rng.sample([admin_a, admin_b], 2)
+                taps = [button(one, f"pay_approve:{pay_id}"), button(other, f"pay_reject:{pay_id}"),
+                        button(other, f"pay_approve:{pay_id}")]
+                rng.shuffle(taps)
+                clicks += [asyncio.create_task(process(t)) for t in taps]
+            if done:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*clicks)
+
+    async def run() -> dict:
+        await api.install()
+        os.environ["PHOTO_GROUP_ID"] = "-100"
+        _seed_products(titles)
+        main.admins.update([admin_a, admin_b])
+        await main.persist("admins")
+
+        t0 = time.perf_counter()
+        shoppers = asyncio.ensure_future(asyncio.gather(*(shopper(uid) for uid in users)))
+        shopped = {}
+        shoppers.add_done_callback(lambda _: shopped.setdefault("s", time.perf_counter() - t0))
+        await admins_at_work(shoppers)
+        await shoppers
+        await main.committer.flush()
+        elapsed = time.perf_counter() - t0
+
+        lost_items = double_processed = 0
+        outcomes = {"approved": 0, "rejected": 0}
+        for uid in users:
+            key = str(uid)
+            placed = [it for o in main.orders.get(key, []) for it in o["items"]]
+            placed += [it for p in main.purchases.get(key, []) for it in p["items"]]
+            lost_items += items_each - len(placed) + len(main.users[key]["cart"])
+            notices = [t for t in outbox.get(uid, []) if "پرداخت شما" in t]
+            double_processed += len(notices) > 1 or len(main.purchases.get(key, [])) > 1
+        # settled receipts have left the hot store for the archive
+        stuck = len(main.pending_payments)
+        for pay in await main.archived_payments():
+            outcomes[pay["status"]] += 1
+            has_purchase = bool(main.purchases.get(str(pay["user_id"])))
+            double_processed += has_purchase != (pay["status"] == "approved")
+
+        n_updates = api.updates
+        # one admin's taps run in order, each waits for its commit: the admins finish last
+        return {"users": {"shoppers_s": round(shopped["s"], 3), "total_s": round(elapsed, 3), "updates": n_updates,
+                          "updates_per_s": round(n_updates / elapsed, 1), "receipts": len(clicked),
+                          **outcomes},
+                "invariants": {"lost_cart_items": lost_items, "double_processed": double_processed,
+                               "unprocessed_receipts": stuck, "receipt_clicks": 3 * len(clicked)},
+                "locks": main.locks.snapshot()}
+
+    return asyncio.run(run())
+
+
+def bench_approvals(n_receipts: int, n_admins: int, latency: float) -> dict:
+    """هر فیش را همهٔ ادمین‌ها هم‌زمان تایید می‌کنند، و هر callback یک بار هم دوباره تحویل می‌شود"""
+    api = FakeBotApi(latency)
+    admins = [10 ** 9 + i for i in range(1, n_admins + 1)]
+    async def run() -> dict:
+        await api.install()
+        _seed_products(["جزوه 1"])
+        pay_ids = []
+        for n in range(n_receipts):
+            uid = 2001 + n
+            key = str(uid)
+            order = {"order_id": str(uuid.uuid4()), "user_id": uid, "total": 100, "paid": False,
+                     "items": [{"product_id": "1", "title": "جزوه 1", "type": TYPES[2], "qty": 1, "unit_price": 100}]}
+            main.users[key] = {"first_name": "u", "last_name": key, "cart": []}
+            main.orders[key] = [order]
+            pay_id = str(uuid.uuid4())
+            main.pending_payments[pay_id] = {"payment_id": pay_id, "user_id": uid, "order_id": order["order_id"],
+                                             "items": order["items"], "total": 100, "status": "pending"}
+            pay_ids.append(pay_id)
+            for name in ("users", "orders"):
+                main.persist(name, key)
+            main.persist("pending_payments", pay_id)
+        main.admins.update(admins)
+        await main.persist("admins")
+        before = dict(main.payment_stats)
+        taps, redelivered = [], []
+        for pay_id in pay_ids:
+            for admin in admins:
+                body = api.button(admin, f"pay_approve:{pay_id}")
+                taps.append(body)
+                redelivered.append(json.loads(json.dumps(body)))   # same callback id, new delivery
+        writes_before = main.committer.stats.get("entries", 0)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(api.process(b) for b in taps + redelivered))
+        elapsed = time.perf_counter() - t0
+        await main.committer.flush()
+        stats = {k: main.payment_stats[k] - before[k] for k in before}
+
+        settled = await main.archived_payments()
+        purchases = sum(len(main.purchases.get(str(p["user_id"]), [])) for p in settled)
+        notices = sum(t == "پرداخت شما تایید شد ✅️" for texts in api.outbox.values() for t in texts)
+        return {"callbacks": {"total_s": round(elapsed, 3), "fired": len(taps) + len(redelivered), **stats},
+                "invariants": {"receipts": n_receipts, "purchases_written": purchases, "user_notices": notices,
+                               "archived": len(settled), "still_pending": len(main.pending_payments)},
+                "writes": {"committed_entries": main.committer.stats.get("entries", 0) - writes_before}}
+
+    return asyncio.run(run())
+
+
+# ---------------- record memory ----------------
+def bench_records(n_items: int, n_products: int) -> dict:
+    """حافظهٔ n_items آیتم: dict خوانده‌شده از JSON در برابر Item"""
+    import gc
+    import tracemalloc
+
+    rnd = random.Random(5)
+    rows = []
+    for n in range(n_items):
+        pid = str(rnd.randint(1, n_products))
+        row = {"product_id": pid, "title": f"جزوه شماره {pid}", "type": rnd.choice(TYPES),
+               "qty": rnd.randint(1, 3), "unit_price": 1000}
+        if n % 4 == 0:
+            row["item_id"] = str(uuid.UUID(int=rnd.getrandbits(128)))
+        rows.append(row)
+    text = json.dumps(rows, ensure_ascii=False)
+    del rows
+
+    def retained(build) -> tuple:
+        # timed without tracing, measured with it
+        t0 = time.perf_counter()
+        build()
+        elapsed = time.perf_counter() - t0
+        gc.collect()
+        tracemalloc.start()
+        kept = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return kept, size, elapsed
+
+    def as_items():
+        return [main.Item.from_json(d) for d in json.loads(text)]
+
+    dicts, dict_bytes, dict_s = retained(lambda: json.loads(text))
+    items, item_bytes, item_s = retained(as_items)
+    return {
+        "dict": {"bytes_per_item": round(dict_bytes / n_items, 1), "total_mb": round(dict_bytes / 2 ** 20, 2),
+                 "load_s": round(dict_s, 3)},
+        "Item": {"bytes_per_item": round(item_bytes / n_items, 1), "total_mb": round(item_bytes / 2 ** 20, 2),
+                 "load_s": round(item_s, 3), "saved": f"{1 - item_bytes / dict_bytes:.0%}"},
+        "round_trip": {"identical_json": main.dump_compact(items) == main.dump_compact(dicts)},
+    }
+
+
+# ---------------- metrics ----------------
+def bench_metrics(n_users: int, repeat: int) -> dict:
+    """هزینهٔ ابزار /metrics: هر observation، هر هندلر و فراخوانی API پوشانده‌شده، و هر scrape"""
+    n = repeat * 1000
+    hist = main.Histogram("bench_seconds", "bench", ("handler", "state"))
+    counter = main.Counter("bench_total", "bench", ("method", "code"))
+    main._metrics.remove(hist)
+    main._metrics.remove(counter)
+
+    def per_op_ns(fn) -> float:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - t0) / n * 1e9
+
+    observe_ns = per_op_ns(lambda: hist.observe(0.003, "handle_text_main", "main"))
+    inc_ns = per_op_ns(lambda: counter.inc("sendMessage", 200))
+
+    async def noop(update, context):
+        return None
+
+    async def wrapped_ns() -> tuple:
+        # the same awaits with and without the wrappers, the difference is their cost
+        async def loop(call) -> float:
+            t0 = time.perf_counter()
+            for _ in range(n):
+                await call()
+            return (time.perf_counter() - t0) / n * 1e9
+
+        timed = main.timed(noop, "bench")
+        raw_api, api = FakeBotApi(0.0), main.InstrumentedRequest(FakeBotApi(0.0))
+        url = "https://api.telegram.org/botTOKEN/answerCallbackQuery"
+        handler = await loop(lambda: timed(None, None)) - await loop(lambda: noop(None, None))
+        request = await loop(lambda: api.do_request(url, "POST")) - await loop(lambda: raw_api.do_request(url, "POST"))
+        return handler, request
+
+    handler_ns, request_ns = asyncio.run(wrapped_ns())
+    main.handler_seconds.series.clear()   # only the stress run below counts
+    main.api_seconds.series.clear()
+
+    stress = bench_stress(n_users, 0.0)
+    updates = stress["users"]["updates"]
+    wrapped_handlers = sum(sum(row[:-1]) for row in main.handler_seconds.series.values())
+    api_calls = sum(sum(row[:-1]) for row in main.api_seconds.series.values())
+    overhead_us = (wrapped_handlers * handler_ns + api_calls * request_ns) / updates / 1000
+    update_us = stress["users"]["total_s"] / updates * 1e6
+
+    scrapes = []
+    for _ in range(max(1, repeat // 10)):
+        t0 = time.perf_counter()
+        text = main.render_metrics()
+        scrapes.append(time.perf_counter() - t0)
+    return {
+        "per_op_ns": {"histogram_observe": round(observe_ns), "counter_inc": round(inc_ns),
+                      "timed_handler": round(handler_ns), "instrumented_api_call": round(request_ns)},
+        "stress": {"updates": updates, "wrapped_handler_runs": wrapped_handlers, "api_calls": api_calls,
+                   "overhead_us_per_update": round(overhead_us, 2), "wall_us_per_update": round(update_us, 1),
+                   "overhead": f"{overhead_us / update_us:.2%}"},
+        "scrape": {"median_ms": round(statistics.median(scrapes) * 1000, 3), "lines": text.count("\n"),
+                   "kb": round(len(text.encode("utf-8")) / 1024, 1)},
+    }
+
+
+# ---------------- rendering ----------------
+def bench_render(n_users: int, n_products: int, repeat: int) -> dict:
+    """زمان پاسخ هندلرهای پرتکرار (منوها، لیست جزوات، اسامی) با و بدون RenderCache"""
+    api = FakeBotApi(0.0)
+    admin, shopper = 10 ** 9 + 1, 1001
+    cache = main.render_cache
+    cached_methods = {"disp_name": cache.disp_name, "keyboard": cache.keyboard}
+    uncached_methods = {"disp_name": lambda uid: main.make_disp_name(main.users.get(str(uid), {})),
+                        "keyboard": lambda key, build, depends=(): build()}
+    screens = {
+        "admin_menu": [(admin, "🔙 بازگشت")],
+        "product_list": [(admin, "📚 لیست جزوات"), (admin, "🔙 بازگشت")],
+        "registered_names": [(admin, "👥 اسامی ثبت نام نهایی کنندگان")],
+        "buyer_names": [(admin, "👤 اسامی خریداران")],
+        "user_menu": [(shopper, "🔙 بازگشت")],
+        "choose_product": [(shopper, "🛒 انتخاب جزوه"), (shopper, "🔙 بازگشت")],
+    }
+
+    async def timed(steps) -> float:
+        t0 = time.perf_counter()
+        for uid, text in steps:
+            await api.process(api.message(uid, text))
+        return time.perf_counter() - t0
+
+    async def measure(methods: dict) -> dict:
+        vars(cache).update(methods)
+        out = {}
+        for screen, steps in screens.items():
+            await timed(steps)   # warm up, and fill the cache
+            out[screen] = round(statistics.median([await timed(steps) for _ in range(repeat)]) * 1e6, 1)
+        # the pieces alone, without the Bot API round trip
+        out["names_only"] = _timeit(lambda: [cache.disp_name(k) for k in main.users], max(10, repeat // 4))["mean_us"]
+        out["keyboard_only"] = _timeit(lambda: main.products_keyboard("🔙 بازگشت"), repeat)["mean_us"]
+        return out
+
+    async def run() -> dict:
+        await api.install()
+        _seed_products([f"جزوه شماره {i}" for i in range(1, n_products + 1)])
+        for n in range(n_users):
+            key = str(2001 + n)
+            main.users[key] = {"first_name": f"نام{n}", "last_name": f"خانوادگی{n}", "is_dorm": n % 3 == 0,
+                               "dorm_name": main.DORMS[n % len(main.DORMS)] if n % 3 == 0 else None, "cart": []}
+            item = {"product_id": "1", "title": "جزوه شماره 1", "type": TYPES[2], "qty": 1, "unit_price": 100}
+            if n % 2:
+                main.orders[key] = [{"order_id": str(uuid.uuid4()), "user_id": int(key), "items": [item], "total": 100}]
+            else:
+                main.purchases[key] = [{"payment_id": str(uuid.uuid4()), "user_id": int(key), "items": [item], "total": 100}]
+            for name in ("users", "orders", "purchases"):
+                main.persist(name, key)
+        # added admins go through the identity check like everyone else
+        for uid in (shopper, admin):
+            main.users[str(uid)] = {"first_name": "کاربر", "last_name": str(uid), "is_dorm": False, "dorm_name": None, "cart": []}
+            main.persist("users", str(uid))
+        main.admins.add(admin)
+        await main.persist("admins")
+        for uid in (shopper, admin):
+            await api.process(api.message(uid, "/start"))   # enter the conversation
+        await main.committer.flush()
+
+        # alternate the two and keep the better round of each: the heap keeps growing between runs
+        rounds = [(await measure(uncached_methods), await measure(cached_methods)) for _ in range(2)]
+        before = {screen: min(r[0][screen] for r in rounds) for screen in rounds[0][0]}
+        after = {screen: min(r[1][screen] for r in rounds) for screen in rounds[0][1]}
+        speedup = {screen: f"{before[screen] / after[screen]:.1f}x" for screen in before}
+        return {"uncached_us": before, "cached_us": after, "speedup": speedup, "cache": dict(cache.stats)}
+
+    return asyncio.run(run())
+
+
+# ---------------- multi-worker ----------------
+class BotApiServer:
+    """Bot API over real HTTP for worker processes (ASGI): fixed round trip, counts messages per chat"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = {}
+        self.sent = {}        # chat_id -> text messages sent there
+        self.arrived = {}     # chat_id -> perf_counter() of each text message
+        self.receipts = asyncio.Queue()   # payment ids from receipt photos sent to admins
+        self.webhook_url = ""   # kept across bot restarts, like Telegram does
+        self._changed = asyncio.Event()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        from urllib.parse import parse_qs
+        body = b""
+        while True:
+            msg = await receive()
+            body += msg.get("body", b"")
+            if not msg.get("more_body"):
+                break
+        await asyncio.sleep(self.latency)
+        # files (backups) come as multipart: only the urlencoded calls are looked into
+        urlencoded = (b"content-type", b"application/x-www-form-urlencoded") in scope["headers"]
+        params = {k: v[-1] for k, v in parse_qs(body.decode()).items()} if urlencoded else {}
+        endpoint = scope["path"].rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif endpoint == "sendPhoto":
+            chat_id = int(params["chat_id"])
+            caption = params.get("caption", "")
+            if "payment_id: " in caption:
+                uid = int(caption.split("آیدی: ", 1)[1].split()[0])
+                self.receipts.put_nowait((caption.rsplit("payment_id: ", 1)[1].split()[0], uid))
+            result = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}}
+        elif endpoint == "sendMessage":
+            chat_id = int(params["chat_id"])
+            self.sent[chat_id] = self.sent.get(chat_id, 0) + 1
+            self.arrived.setdefault(chat_id, []).append(time.perf_counter())
+            self._changed.set()
+            result = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}}
+        elif endpoint == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            result = True
+        elif endpoint == "getWebhookInfo":
+            result = {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            result = True
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": json.dumps({"ok": True, "result": result}).encode()})
+
+    async def wait_for(self, chat_id: int, count: int, timeout: float) -> bool:
+        deadline = time.perf_counter() + timeout
+        while self.sent.get(chat_id, 0) < count:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                return False
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), left)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.asynccontextmanager
+async def _bot_api_server(latency: float):
+    # BotApiServer on a local port, in this process's event loop
+    import uvicorn
+    api, port = BotApiServer(latency), _free_port()
+    server = uvicorn.Server(uvicorn.Config(api, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        yield api, port
+    finally:
+        server.should_exit = True
+        await task
+
+
+@contextlib.contextmanager
+def _bot_process(workdir: Path, port: int, api_port: int, n_workers: int = 1, **env):
+    # main.py under uvicorn in workdir (./data lives there), talking to the local Bot API
+    import signal
+    import subprocess
+    env = {**os.environ, "PYTHONPATH": str(Path(__file__).resolve().parent), "WEB_WORKERS": str(n_workers),
+           "BOT_TOKEN": "0:bench", "BOT_API_URL": f"http://127.0.0.1:{api_port}",
+           "WEBHOOK_URL": f"http://127.0.0.1:{port}/webhook", "BACKUP_INTERVAL": "86400", **env}
+    log = open(workdir / "server.log", "w")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:fastapi_app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(n_workers), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        yield proc
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+
+def _webhook_message(update_id: int, uid: int, text: str = None, photo: str = None) -> dict:
+    m = {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"},
+         "from": {"id": uid, "is_bot": False, "first_name": "u"}}
+    if text is not None:
+        m["text"] = text
+        if text.startswith("/"):
+            m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    if photo:
+        m["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}]
+    return {"update_id": update_id, "message": m}
+
+
+def _webhook_button(update_id: int, uid: int, data: str) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "bench", "data": data,
+        "from": {"id": uid, "is_bot": False, "first_name": "admin"},
+        "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "caption": "receipt"}}}
+
+
+def _percentiles(samples: list, scale: float = 1000) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+    pick = lambda q: round(samples[min(len(samples) - 1, int(len(samples) * q))] * scale, 1)
+    return {"n": len(samples), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(samples[-1] * scale, 1)}
+
+
+def bench_workers(n_users: int, latency: float, worker_counts=(1, 2, 4), rounds: int = 3) -> dict:
+    """همان سناریوی خرید از طریق /webhook واقعی، با ۱، ۲ و ۴ پروسهٔ uvicorn روی یک فایل SQLite
+
+    هر کاربر پیام بعدی را بعد از رسیدن جواب قبلی می‌فرستد؛ connectionهای httpx بین
+    workerها پخش می‌شوند، پس آپدیت‌های پشت سر هم یک کاربر به workerهای مختلف می‌رسند.
+    در پایان سبد هر کاربر در فایل SQLite باید دقیقاً rounds آیتم داشته باشد.
+    """
+    import logging
+    import sqlite3
+    import httpx
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)   # one line per webhook post otherwise
+    titles = [f"جزوه {i}" for i in range(1, 11)]
+    users = list(range(1001, 1001 + n_users))
+
+    def script(uid: int, rng: random.Random) -> list:
+        steps = ["/start", "📝 ثبت اطلاعات هویتی", f"کاربر شماره{uid}", "تهرانی"]
+        for _ in range(rounds):
+            steps += ["🛒 انتخاب جزوه", rng.choice(titles), "⬛ سیاه سفید", str(rng.randint(1, 5))]
+        return steps + ["📦 سبد خرید"]
+
+    async def one_run(n_workers: int) -> dict:
+        workdir = Path(tempfile.mkdtemp(prefix=f"workers{n_workers}-", dir=_WORKDIR))
+        (workdir / "data").mkdir()
+        products = {str(i): {"title": t, "color_high_price": 300, "color_low_price": 200, "bw_price": 100}
+                    for i, t in enumerate(titles, 1)}
+        # JSON files: the first worker to start migrates them into SQLite
+        _seed("json", workdir / "data", {**make_dataset(0), "products": products})
+
+        port = _free_port()
+        async with _bot_api_server(latency) as (api, api_port):
+            with _bot_process(workdir, port, api_port, n_workers, STORAGE_BACKEND="sqlite") as proc:
+                # every worker calls getMe once it is up
+                deadline = time.perf_counter() + 60
+                while api.calls.get("getMe", 0) < n_workers:
+                    if proc.poll() is not None or time.perf_counter() > deadline:
+                        raise RuntimeError(f"workers did not start, see {workdir / 'server.log'}")
+                    await asyncio.sleep(0.05)
+
+                update_ids = iter(range(1, 10 ** 9))
+                replies, stalled = [], 0
+
+                async def shopper(client, uid: int):
+                    nonlocal stalled
+                    for text in script(uid, random.Random(uid)):
+                        expected = api.sent.get(uid, 0) + 1
+                        t0 = time.perf_counter()
+                        await client.post(f"http://127.0.0.1:{port}/webhook", json=_webhook_message(next(update_ids), uid, text))
+                        if not await api.wait_for(uid, expected, 30):
+                            stalled += 1
+                            return
+                        replies.append(api.arrived[uid][expected - 1] - t0)
+
+                limits = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+                async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+                    t0 = time.perf_counter()
+                    await asyncio.gather(*(shopper(client, uid) for uid in users))
+                    elapsed = time.perf_counter() - t0
+
+        # what actually reached the shared database
+        conn = sqlite3.connect(str(workdir / "data" / "bookshop.db"))
+        carts = {int(k): len(json.loads(d).get("cart", [])) for k, d in conn.execute("SELECT user_key, data FROM users")}
+        conn.close()
+        lost = sum(abs(rounds - carts.get(uid, 0)) for uid in users)
+        leaders = (workdir / "server.log").read_text().count("is the leader")
+        n_updates = len(users) * len(script(0, random.Random(0)))
+        replies.sort()
+        pct = lambda q: round(replies[min(len(replies) - 1, int(len(replies) * q))] * 1000, 1) if replies else 0.0
+        return {"updates": n_updates, "total_s": round(elapsed, 3), "updates_per_s": round(n_updates / elapsed, 1),
+                "reply_p50_ms": pct(0.50), "reply_p95_ms": pct(0.95), "stalled_users": stalled,
+                "lost_cart_items": lost, "leaders": leaders if n_workers > 1 else "-"}
+
+    async def run() -> dict:
+        results = {}
+        for n in worker_counts:
+            results[f"{n} worker{'s' if n > 1 else ''}"] = await one_run(n)
+        base = results[next(iter(results))]["updates_per_s"]
+        for r in results.values():
+            r["speedup"] = f"{r['updates_per_s'] / base:.2f}x"
+        return {"host": {"cpus": os.cpu_count()}, **results}
+
+    return asyncio.run(run())
+
+
+# ---------------- load ----------------
+LOAD_REPORTS = ["📚 جزوات خریداری شده", "📄 جزوات ثبت نهایی شده", "👥 اسامی ثبت نام نهایی کنندگان",
+                "👤 اسامی خریداران", "🕓 فیش‌های در انتظار تایید", "🔙 بازگشت"]
+
+
+def bench_load(n_users: int, rounds: int, latency: float, backend: str = "json", n_workers: int = 1,
+               report_every: int = 25) -> dict:
+    """بار مصنوعی از طریق /webhook: ثبت‌نام، سبد خرید، ثبت نهایی، فیش، تایید ادمین و گزارش‌ها
+
+    هر کاربر (و ادمین) پیام بعدی را بعد از رسیدن جواب قبلی می‌فرستد. latency هر مرحله
+    از ارسال آپدیت تا رسیدن جوابش به Bot API جعلی است؛ lag حلقهٔ رویداد و latency صف
+    آپدیت‌ها از /health خوانده می‌شوند. seedها ثابت‌اند تا اجرای commitهای مختلف
+    قابل مقایسه باشد (--out / --baseline).
+    """
+    import logging
+    import httpx
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    titles = [f"جزوه {i}" for i in range(1, 11)]
+    admin = 10 ** 9 + 1
+    users = list(range(1001, 1001 + n_users))
+
+    def shopper_script(uid: int) -> list:
+        rng = random.Random(uid)
+        steps = [("register", t) for t in ("/start", "📝 ثبت اطلاعات هویتی", f"کاربر شماره{uid}", "تهرانی")]
+        for _ in range(rounds):
+            steps += [("cart", t) for t in ("🛒 انتخاب جزوه", rng.choice(titles), "⬛ سیاه سفید", str(rng.randint(1, 5)))]
+        return steps + [("finalize", t) for t in ("✅ ثبت نهایی سبد خرید", "💳 خرید جزوات نهایی شده", "سفارش: 1 - 0 تومان")]
+
+    workdir = Path(tempfile.mkdtemp(prefix="load-", dir=_WORKDIR))
+    (workdir / "data").mkdir()
+    products = {str(i): {"title": t, "color_high_price": 300, "color_low_price": 200, "bw_price": 100}
+                for i, t in enumerate(titles, 1)}
+    # a registered extra admin: receipts reach it as photos, ADMIN_ID (0) gets the registration notices
+    staff = {str(admin): {"first_name": "ادمین", "last_name": "بار", "is_dorm": False, "dorm_name": None, "cart": []}}
+    _seed("json", workdir / "data", {**make_dataset(0), "products": products, "users": staff, "admins": [admin]})
+
+    async def run() -> dict:
+        latencies = {stage: [] for stage in ("register", "cart", "finalize", "receipt", "approve", "report")}
+        lag_samples = []
+        receipt_sent = {uid: asyncio.Event() for uid in users}
+        update_ids = iter(range(1, 10 ** 9))
+        stalled = approved = 0
+        port = _free_port()
+        url = f"http://127.0.0.1:{port}"
+
+        async def step(client, stage: str, body: dict, reply_chat: int):
+            nonlocal stalled
+            expected = api.sent.get(reply_chat, 0) + 1
+            t0 = time.perf_counter()
+            await client.post(f"{url}/webhook", json=body)
+            if not await api.wait_for(reply_chat, expected, 30):
+                stalled += 1
+                raise RuntimeError(f"no reply to {stage} update for {reply_chat}")
+            latencies[stage].append(api.arrived[reply_chat][expected - 1] - t0)
+
+        async def shopper(client, uid: int):
+            for stage, text in shopper_script(uid):
+                await step(client, stage, _webhook_message(next(update_ids), uid, text), uid)
+            await step(client, "receipt", _webhook_message(next(update_ids), uid, photo=f"receipt-{uid}"), uid)
+            receipt_sent[uid].set()
+
+        async def admin_at_work(client, shoppers: asyncio.Future):
+            nonlocal approved
+            await step(client, "report", _webhook_message(next(update_ids), admin, "/start"), admin)
+            seen = set()
+            idle_since = None
+            while True:
+                try:
+                    pay_id, uid = await asyncio.wait_for(api.receipts.get(), 0.05)
+                except asyncio.TimeoutError:
+                    # the admins' copies are fanned out after the user's reply,
+                    # paced per chat: give the stragglers time to arrive
+                    now = time.perf_counter()
+                    idle_since = idle_since or now
+                    if shoppers.done() and (len(seen) >= len(users) or now - idle_since > 30):
+                        break
+                    continue
+                idle_since = None
+                if pay_id in seen:   # the pending-receipts report sends them again
+                    continue
+                seen.add(pay_id)
+                await receipt_sent[uid].wait()
+                await step(client, "approve", _webhook_button(next(update_ids), admin, f"pay_approve:{pay_id}"), uid)
+                approved += 1
+                if approved % report_every == 0:
+                    for text in LOAD_REPORTS:
+                        await step(client, "report", _webhook_message(next(update_ids), admin, text), admin)
+            for text in LOAD_REPORTS:
+                await step(client, "report", _webhook_message(next(update_ids), admin, text), admin)
+
+        async def sample_lag(client, stop: asyncio.Event):
+            while not stop.is_set():
+                health = (await client.get(f"{url}/health")).json()
+                lag_samples.append(health["io"]["loop_lag_ms"]["last_ms"] / 1000)
+                try:
+                    await asyncio.wait_for(stop.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+
+        async with _bot_api_server(latency) as (api, api_port):
+            with _bot_process(workdir, port, api_port, n_workers, STORAGE_BACKEND=backend, PHOTO_GROUP_ID="") as proc:
+                deadline = time.perf_counter() + 60
+                while api.calls.get("getMe", 0) < n_workers:
+                    if proc.poll() is not None or time.perf_counter() > deadline:
+                        raise RuntimeError(f"bot did not start, see {workdir / 'server.log'}")
+                    await asyncio.sleep(0.05)
+                limits = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+                async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+                    stop = asyncio.Event()
+                    sampler = asyncio.create_task(sample_lag(client, stop))
+                    t0 = time.perf_counter()
+                    shoppers = asyncio.ensure_future(asyncio.gather(*(shopper(client, uid) for uid in users)))
+                    await asyncio.gather(shoppers, admin_at_work(client, shoppers))
+                    elapsed = time.perf_counter() - t0
+                    stop.set()
+                    await sampler
+                    health = (await client.get(f"{url}/health")).json()
+
+        n_updates = sum(len(v) for v in latencies.values())
+        return {
+            "throughput": {"updates": n_updates, "total_s": round(elapsed, 3), "updates_per_s": round(n_updates / elapsed, 1)},
+            "reply_ms": {stage: _percentiles(samples) for stage, samples in latencies.items()},
+            "all_replies_ms": {"all": _percentiles([x for v in latencies.values() for x in v])},
+            # enqueue -> handlers done, inside the bot (last 1000 updates of one worker)
+            "server": {"queue_to_done_ms": health["updates"]["latency_ms"],
+                       "loop_lag_ms": {**_percentiles(lag_samples), "max_seen": health["io"]["loop_lag_ms"]["max_ms"]}},
+            "checks": {"stalled": stalled, "receipts_approved": approved, "expected": len(users)},
+        }
+
+    return asyncio.run(run())
+
+
+# ---------------- cold start ----------------
+def bench_coldstart(n_users: int, backend: str, boots: int = 3) -> dict:
+    """از اجرای پروسه تا جواب اولین آپدیت، مثل بیدار شدن سرور رایگانی که خوابیده بود
+
+    اولین بوت کارهای یک‌باره را هم دارد (مهاجرت، آرشیو فیش‌ها، set_webhook)؛ بوت‌های بعدی
+    حالت عادی‌اند. /start از همان لحظه‌ای فرستاده می‌شود که پورت باز می‌شود.
+    """
+    import logging
+    import httpx
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    workdir = Path(tempfile.mkdtemp(prefix="coldstart-", dir=_WORKDIR))
+    (workdir / "data").mkdir()
+    _seed("json", workdir / "data", make_dataset(n_users))
+    uid = 10_000   # registered in the dataset: /start answers with the main menu
+
+    port = _free_port()   # same webhook URL on every boot
+
+    async def boot(api, api_port: int, n: int) -> dict:
+        sent_before = api.sent.get(uid, 0)
+        t0 = time.perf_counter()
+        with _bot_process(workdir, port, api_port, STORAGE_BACKEND=backend) as proc:
+            async with httpx.AsyncClient(timeout=30) as client:
+                while True:
+                    if proc.poll() is not None:
+                        raise RuntimeError(f"bot did not start, see {workdir / 'server.log'}")
+                    try:
+                        await client.post(f"http://127.0.0.1:{port}/webhook", json=_webhook_message(n, uid, "/start"))
+                        break
+                    except httpx.TransportError:
+                        await asyncio.sleep(0.005)
+                if not await api.wait_for(uid, sent_before + 1, 60):
+                    raise RuntimeError(f"no reply to /start, see {workdir / 'server.log'}")
+                first_reply_ms = (api.arrived[uid][sent_before] - t0) * 1000
+                # the reply goes out before the handler returns, and the webhook check runs after start
+                while True:
+                    report = (await client.get(f"http://127.0.0.1:{port}/health")).json()["startup"]
+                    if report["first_update_ms"] is not None and report["webhook"]["checked"]:
+                        break
+                    await asyncio.sleep(0.01)
+        return {"first_reply_ms": round(first_reply_ms, 1), "in_process_ms": report["first_update_ms"],
+                "target_met": report["target_met"], **report["phases_ms"],
+                "webhook": "unchanged" if report["webhook"]["unchanged"] else "set"}
+
+    async def run() -> dict:
+        results = {}
+        async with _bot_api_server(0.002) as (api, api_port):
+            for n in range(1, boots + 1):
+                results[f"boot {n}"] = await boot(api, api_port, n)
+        return results
+
+    return asyncio.run(run())
+
+
+def _flatten(results: dict, prefix: str = "") -> dict:
+    out = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            out.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[f"{prefix}{key}"] = value
+    return out
+
+
+def _git_revision():
+    import subprocess
+    here = Path(__file__).resolve().parent
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True, check=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "main.py"], cwd=here, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev.stdout.strip() + ("+dirty" if dirty.stdout.strip() else "")
+
+
+def _print_comparison(baseline: dict, record: dict):
+    # every numeric result that both runs have; for times lower is better, for rates higher
+    before, after = _flatten(baseline["results"]), _flatten(record["results"])
+    print(f"\n== {record['suite']}: {baseline.get('revision')} -> {record.get('revision')} ==")
+    ignored = ("out", "baseline", "json")
+    differs = [k for k, v in record["args"].items() if k not in ignored and baseline.get("args", {}).get(k) != v]
+    if baseline.get("suite") != record["suite"] or differs or baseline.get("host") != record["host"]:
+        print(f"warning: not the same run (suite / host / {', '.join(differs) or '-'} differ)")
+    for key, new in after.items():
+        if key not in before:
+            continue
+        old = before[key]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "-"
+        print(f"{key:<44} {old:>12} {new:>12} {change:>9}")
+
+
+def _print_table(title: str, results: dict):
+    print(f"\n== {title} ==")
+    for name, metrics in results.items():
+        for op, value in metrics.items():
+            if isinstance(value, dict) and "mean_us" in value:
+                print(f"{name:>20} {op:<14} mean {value['mean_us']:>12.1f} us   p95 {value['p95_us']:>12.1f} us")
+            else:
+                print(f"{name:>20} {op:<14} {value}")
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("suite", choices=["storage", "io", "commit", "reports", "export", "lookups", "broadcast", "stress", "approvals", "records", "render", "workers", "coldstart", "load", "metrics"])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--items", type=int, default=6, help="items per order / purchase")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--count", type=int, default=100_000, help="records: items to load")
+    parser.add_argument("--rounds", type=int, default=3, help="io: backup + export rounds; workers: items per cart")
+    parser.add_argument("--workers", default="1,2,4",
+                        help="workers: uvicorn process counts to compare; load: the first one is used")
+    parser.add_argument("--report-every", type=int, default=25, help="load: admin report round every N approvals")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"], help="coldstart: storage engine")
+    parser.add_argument("--boots", type=int, default=3, help="coldstart: restarts over the same data")
+    parser.add_argument("--pending", type=int, default=None,
+                        help="receipts: broadcast re-sends 20, approvals settles 200")
+    parser.add_argument("--admins", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=None,
+                        help="fake Bot API round trip (s); broadcast 0.05, stress / approvals 0.002")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--out", help="also write the results (with git revision and host) to this JSON file")
+    parser.add_argument("--baseline", help="compare with a file written by --out on another commit")
+    args = parser.parse_args(argv)
+
+    if args.suite == "storage":
+        results = bench_storage(args.users, args.items, args.repeat)
+        title = f"storage, {args.users} users"
+    elif args.suite == "io":
+        results = bench_io(args.users, args.rounds)
+        title = f"event-loop stalls, {args.users} users"
+    elif args.suite == "commit":
+        results = bench_commit(args.users)
+        title = f"burst of {args.users} concurrent finalizations"
+    elif args.suite == "reports":
+        results = bench_reports(args.users, args.items, args.repeat)
+        title = f"admin product reports, {args.users} users"
+    elif args.suite == "export":
+        results = bench_export(args.users, args.products, args.items)
+        title = f"purchases export, {args.users} users × {args.products} products"
+    elif args.suite == "lookups":
+        results = bench_lookups(args.users, args.products, args.items, args.repeat)
+        title = f"index lookups, {args.users} users × {args.products} products"
+    elif args.suite == "broadcast":
+        args.pending = 20 if args.pending is None else args.pending
+        results = bench_broadcast(args.pending, args.admins, 0.05 if args.latency is None else args.latency)
+        title = f"{args.pending} receipts × {args.admins} admins (one admin has blocked the bot)"
+    elif args.suite == "stress":
+        results = bench_stress(args.users, 0.002 if args.latency is None else args.latency)
+        title = f"{args.users} concurrent users, 2 admins approving and rejecting the same receipts"
+    elif args.suite == "approvals":
+        args.pending = 200 if args.pending is None else args.pending
+        results = bench_approvals(args.pending, args.admins, 0.002 if args.latency is None else args.latency)
+        title = f"{args.pending} receipts × {args.admins} admins approving at once, every callback delivered twice"
+    elif args.suite == "records":
+        results = bench_records(args.count, args.products)
+        title = f"{args.count} items in memory, {args.products} products"
+    elif args.suite == "render":
+        results = bench_render(args.users, args.products, args.repeat)
+        title = f"handler render time, {args.users} users × {args.products} products (median us per screen)"
+    elif args.suite == "workers":
+        counts = [int(n) for n in args.workers.split(",")]
+        results = bench_workers(args.users, 0.002 if args.latency is None else args.latency, counts, args.rounds)
+        title = f"{args.users} users shopping through /webhook, {args.rounds} items each, SQLite shared by {args.workers} workers"
+    elif args.suite == "load":
+        n_workers = int(args.workers.split(",")[0])
+        results = bench_load(args.users, args.rounds, 0.002 if args.latency is None else args.latency,
+                             args.backend, n_workers, args.report_every)
+        title = (f"{args.users} users through /webhook ({args.rounds} cart items, receipt, approval), "
+                 f"{n_workers} worker(s), {args.backend}")
+    elif args.suite == "metrics":
+        results = bench_metrics(args.users, args.repeat)
+        title = f"/metrics instrumentation cost, {args.users} users through the stress scenario"
+    elif args.suite == "coldstart":
+        results = bench_coldstart(args.users, args.backend, args.boots)
+        title = f"cold start to first /start reply, {args.users} users, {args.backend} (phases in ms)"
+
+    record = {"suite": args.suite, "revision": _git_revision(),
+              "host": {"cpus": os.cpu_count(), "python": sys.version.split()[0]}, "args": vars(args), "results": results}
+    if args.json:
+        print(json.dumps(record, ensure_ascii=False))
+    else:
+        _print_table(title, results)
+    if args.out:
+        (_CALLER_DIR / args.out).write_text(json.dumps(record, ensure_ascii=False, indent=1), encoding="utf-8")
+    if args.baseline:
+        _print_comparison(json.loads((_CALLER_DIR / args.baseline).read_text(encoding="utf-8")), record)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -9,17 +9,34 @@ fin_fixed.py
 
 import json
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Set
 import logging
 import uuid
 import datetime
+import enum
+import sys
+from dataclasses import dataclass, fields, replace
+from typing import Optional
 import os                          # ✅ اضافه شد
+import asyncio
+import atexit
+import bisect
+import collections
+import contextlib
+import contextvars
+import copy
+import functools
+import gc
+import threading
+import time
+_STARTED = time.perf_counter()      # startup profile: counted from here
 from dotenv import load_dotenv      # ✅ اضافه شد
 
 # بارگذاری متغیرهای محیطی از .env یا تنظیمات Render
 load_dotenv()                       # ✅ اضافه شد
 
-import pandas as pd
+# pandas / openpyxl / zipfile are imported where they are used (exports, backups):
+# together they cost more at startup than everything else here
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -34,8 +51,13 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
+from telegram.error import BadRequest, NetworkError, RetryAfter
 
 # ---------------- CONFIG ----------------
 TOKEN = os.getenv("BOT_TOKEN")
@@ -55,6 +77,175 @@ NOW_BACK_ID = int(os.getenv("NOW_BACK_ID", "0"))
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ---------------- STARTUP PROFILE ----------------
+# زمان هر مرحلهٔ راه‌اندازی (import، بارگذاری داده، ساخت اپ، initialize ...) و زمان
+# تا اولین آپدیتِ پاسخ‌داده‌شده؛ روی سرور رایگانی که می‌خوابد، کاربر همین را منتظر می‌ماند.
+# /health always has it; STARTUP_PROFILE=1 also logs it, and so does missing STARTUP_TARGET_MS.
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "0") == "1"
+STARTUP_TARGET_MS = int(os.getenv("STARTUP_TARGET_MS", "2000"))
+
+
+class StartupProfile:
+    def __init__(self, started: float):
+        self.started = self._last = started
+        self.phases: Dict[str, float] = {}   # phase -> ms since the previous mark
+        self.first_update_ms = None
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last) * 1000, 1)
+        self._last = now
+
+    def first_update(self):
+        if self.first_update_ms is not None:
+            return
+        self.first_update_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        if self.first_update_ms > STARTUP_TARGET_MS:
+            logger.warning("Startup profile (first update after %.0f ms, target %d ms): %s",
+                           self.first_update_ms, STARTUP_TARGET_MS, self.phases)
+        elif STARTUP_PROFILE:
+            logger.info("Startup profile (first update after %.0f ms): %s", self.first_update_ms, self.phases)
+
+    def report(self) -> dict:
+        met = None if self.first_update_ms is None else self.first_update_ms <= STARTUP_TARGET_MS
+        return {"phases_ms": dict(self.phases), "first_update_ms": self.first_update_ms,
+                "target_ms": STARTUP_TARGET_MS, "target_met": met}
+
+
+startup = StartupProfile(_STARTED)
+startup.mark("imports")
+
+# ---------------- METRICS ----------------
+# شمارنده‌ها و هیستوگرام‌ها برای /metrics (فرمت متنی Prometheus)، بدون وابستگی جدید.
+# An observation is a bisect and two additions, cheap enough to stay on in
+# production. Metrics recorded off the event loop (the commit writer, the I/O
+# threads) are created with threads=True and take a lock.
+# METRICS=0 leaves the handlers and the Bot API client unwrapped.
+METRICS = os.getenv("METRICS", "1") == "1"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "bookshop_"
+
+_metrics: list = []   # in the order they are rendered
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), threads: bool = False):
+        self.name = METRIC_PREFIX + name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        self._lock = threading.Lock() if threads else None
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        if self._lock is None:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+            return
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock or contextlib.nullcontext():
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield self.name + _label_text(self.labels, label_values), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 threads: bool = False):
+        self.name = METRIC_PREFIX + name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self.series: Dict[tuple, list] = {}
+        self._lock = threading.Lock() if threads else None
+        _metrics.append(self)
+
+    def observe(self, value: float, *label_values):
+        if self._lock is None:
+            self._record(value, label_values)
+            return
+        with self._lock:
+            self._record(value, label_values)
+
+    def _record(self, value: float, label_values: tuple):
+        row = self.series.get(label_values)
+        if row is None:
+            row = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self):
+        with self._lock or contextlib.nullcontext():
+            series = [(label_values, list(row)) for label_values, row in self.series.items()]
+        for label_values, row in series:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), row):
+                cumulative += n
+                le = 'le="{}"'.format(bound)
+                yield self.name + "_bucket" + _label_text(self.labels, label_values, le), cumulative
+            yield self.name + "_sum" + _label_text(self.labels, label_values), round(row[-1], 6)
+            yield self.name + "_count" + _label_text(self.labels, label_values), cumulative
+
+
+class StatMetric:
+    """مقداری که همین حالا در یکی از دیکشنری‌های stats هست؛ موقع scrape خوانده می‌شود"""
+
+    def __init__(self, name: str, help: str, read, kind: str = "gauge", labels: tuple = ()):
+        # read() returns a number, or {label values: number} when there are labels
+        self.name = METRIC_PREFIX + name
+        self.help = help
+        self.read = read
+        self.kind = kind
+        self.labels = labels
+        _metrics.append(self)
+
+    def samples(self):
+        value = self.read()
+        if not self.labels:
+            yield self.name, value
+            return
+        for label_values, v in value.items():
+            yield self.name + _label_text(self.labels, label_values), v
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{sample} {value}" for sample, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+handler_seconds = Histogram("handler_seconds", "Handler run time, lock wait included", ("handler", "state"))
+handler_errors = Counter("handler_errors_total", "Handlers that raised", ("handler", "state"))
+update_seconds = Histogram("update_seconds", "Webhook update from enqueue until handled")
+api_seconds = Histogram("bot_api_seconds", "Bot API round trip", ("method",))
+api_responses = Counter("bot_api_responses_total", "Bot API responses by HTTP status", ("method", "code"))
+api_errors = Counter("bot_api_errors_total", "Bot API calls that got no response", ("method", "error"))
+commit_seconds = Histogram("commit_seconds", "Group commit batch write (fsync included)", threads=True)
+commit_bytes = Counter("commit_bytes_total", "Bytes of change entries written by group commits", threads=True)
+file_write_seconds = Histogram("file_write_seconds", "write_atomic (snapshots, save_json, backups) by directory",
+                               ("dir",), threads=True)
+file_write_bytes = Counter("file_write_bytes_total", "Bytes written by write_atomic by directory", ("dir",), threads=True)
+
 # ---------------- STATE ENUM ----------------
 (
     S_MAIN,
@@ -88,11 +279,1247 @@ def load_json(path: Path, default):
     return default
 
 def save_json(path: Path, data):
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    write_atomic(path, json.dumps(data, ensure_ascii=False, indent=2, default=record_json))
+
+def write_atomic(path: Path, data):
+    # temp file + rename, so a crash never leaves a half-written JSON file behind
+    t0 = time.perf_counter()
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    file_write_seconds.observe(time.perf_counter() - t0, path.parent.name)
+    file_write_bytes.inc(path.parent.name, amount=len(data))
+
+# ---------------- CHANGE TRACKING ----------------
+# The global collections are wrapped so that any top-level mutation marks them
+# dirty; persist() marks them too, which covers nested edits such as
+# users[key]['cart'].append(...). Compaction only rewrites dirty collections.
+class TrackedDict(dict):
+    dirty = False
+
+    def _touch(self):
+        self.dirty = True
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._touch()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._touch()
+
+    def pop(self, *args):
+        self._touch()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._touch()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._touch()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._touch()
+
+    def clear(self):
+        super().clear()
+        self._touch()
+
+
+class TrackedSet(set):
+    """blocked / admins: membership is checked on every update, so a set instead of a list"""
+    dirty = False
+
+    def _touch(self):
+        self.dirty = True
+
+    def add(self, value):
+        super().add(value)
+        self._touch()
+
+    def discard(self, value):
+        super().discard(value)
+        self._touch()
+
+    def remove(self, value):
+        super().remove(value)
+        self._touch()
+
+    def update(self, *values):
+        super().update(*values)
+        self._touch()
+
+    def clear(self):
+        super().clear()
+        self._touch()
+
+
+# ---------------- RECORD MODEL ----------------
+# آیتم‌های سبد/سفارش/فیش/خرید بیشترین تعداد رکورد را دارند: به جای dict با
+# کلیدهای تکراری، یک dataclass با __slots__ و نوع چاپ به صورت enum.
+# Item still answers it['qty'], it.get('title'), 'item_id' in it and
+# it['qty'] -= 1, so code written against the dicts keeps working, and it
+# serializes back to exactly the dict it was read from.
+class PrintType(enum.StrEnum):
+    COLOR_HIGH = "رنگی کیفیت بالا"
+    COLOR_LOW = "رنگی کیفیت پایین"
+    BW = "سیاه و سفید"
+
+
+_PRINT_TYPE_BY_VALUE = {t.value: t for t in PrintType}
+
+def print_type(value):
+    # known types become the shared enum member; anything else (e.g. "نامشخص") is kept as is
+    return _PRINT_TYPE_BY_VALUE.get(value, value) if isinstance(value, str) else value
+
+
+class _Absent:
+    # item_id of a record that has no "item_id" key; None is an explicit null
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<absent>"
+
+
+_ABSENT = _Absent()
+
+
+@dataclass(slots=True, eq=False)
+class Item:
+    product_id: str
+    title: str
+    type: str             # a PrintType when the type is known
+    qty: int
+    unit_price: int
+    item_id: Optional[str] = _ABSENT
+    extra: Optional[dict] = None   # keys this model does not know, kept for round trips
+
+    REQUIRED = ("product_id", "title", "type", "qty", "unit_price")
+
+    @classmethod
+    def from_json(cls, d):
+        # records missing a field (old data) stay dicts: a round trip must not invent keys
+        if not isinstance(d, dict) or not all(k in d for k in cls.REQUIRED):
+            return d
+        item_id = d.get("item_id", _ABSENT)
+        extra = None
+        if len(d) > 5 + (item_id is not _ABSENT):
+            extra = {k: v for k, v in d.items() if k not in _ITEM_KEYS} or None
+        pid, title = d["product_id"], d["title"]
+        return cls(
+            sys.intern(pid) if type(pid) is str else pid,
+            sys.intern(title) if type(title) is str else title,
+            print_type(d["type"]), d["qty"], d["unit_price"], item_id, extra,
+        )
+
+    def to_json(self) -> dict:
+        d = {"product_id": self.product_id, "title": self.title, "type": self.type,
+             "qty": self.qty, "unit_price": self.unit_price}
+        if self.item_id is not _ABSENT:
+            d["item_id"] = self.item_id
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    # --- the dict interface the handlers use ---
+    def __getitem__(self, key):
+        if key in _ITEM_KEYS:
+            value = getattr(self, key)
+            if value is _ABSENT:
+                raise KeyError(key)
+            return value
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _ITEM_KEYS:
+            setattr(self, key, print_type(value) if key == "type" else value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.to_json().keys()
+
+    def __eq__(self, other):
+        if isinstance(other, Item):
+            other = other.to_json()
+        return self.to_json() == other if isinstance(other, dict) else NotImplemented
+
+    def copy(self) -> "Item":
+        return replace(self, extra=dict(self.extra) if self.extra else None)
+
+
+_ITEM_KEYS = frozenset(f.name for f in fields(Item)) - {"extra"}
+
+
+def as_item(value):
+    return value if isinstance(value, Item) else Item.from_json(value)
+
+
+def adopt_items(colls: dict):
+    """آیتم‌های خوانده‌شده از دیسک (dict) را در جای خودشان به Item تبدیل می‌کند"""
+    def convert(items):
+        if isinstance(items, list):
+            items[:] = [as_item(it) for it in items]
+
+    # colls may hold only some of the collections (one change entry from the feed)
+    for u in colls.get("users", {}).values():
+        if isinstance(u, dict):
+            convert(u.get("cart"))
+    for name in ("orders", "purchases"):
+        for record_list in colls.get(name, {}).values():
+            for rec in record_list or []:
+                if isinstance(rec, dict):
+                    convert(rec.get("items"))
+    for pay in colls.get("pending_payments", {}).values():
+        if isinstance(pay, dict):
+            convert(pay.get("items"))
+
+
+def record_json(obj):
+    # json.dumps(default=...) hook: records serialize as the dicts they were read from
+    if isinstance(obj, Item):
+        return obj.to_json()
+    if isinstance(obj, (set, frozenset)):
+        # id sets are stored as sorted JSON lists: stable diffs, same format as before
+        return sorted(obj)
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
 
-# --- 🔽 کد جدید برای ذخیره‌سازی ادمین‌ها ---
 ADMINS_FILE = DATA_DIR / "admins.json"
-admins = load_json(ADMINS_FILE, [])
+
+# ---------------- I/O EXECUTOR ----------------
+# Blocking disk, zip and export work is handed to these pools so the event
+# loop keeps serving the webhook meanwhile. At most IO_QUEUE_LIMIT jobs are
+# queued or running; callers beyond that wait (backpressure) instead of
+# piling work onto the pools.
+IO_THREADS = int(os.getenv("IO_THREADS", "4"))
+IO_PROCESSES = int(os.getenv("IO_PROCESSES", "1"))
+IO_QUEUE_LIMIT = int(os.getenv("IO_QUEUE_LIMIT", "32"))
+
+
+class IOExecutor:
+    def __init__(self, threads: int, processes: int, queue_limit: int):
+        self.threads = threads
+        self.processes = processes
+        self._thread_pool = None
+        self._process_pool = None
+        self._slots = asyncio.Semaphore(queue_limit)
+        self.queue_limit = queue_limit
+        self.waiting = 0
+        self.running = 0
+        # per kind: count, total and max seconds spent waiting / running
+        self.timings: Dict[str, dict] = {}
+        self.loop_lag = {"last_ms": 0.0, "max_ms": 0.0}
+
+    def _pool(self, cpu: bool):
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        if cpu:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.processes)
+            return self._process_pool
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="io")
+        return self._thread_pool
+
+    def _record(self, kind: str, waited: float, ran: float):
+        t = self.timings.setdefault(kind, {"count": 0, "wait_s": 0.0, "run_s": 0.0, "max_run_s": 0.0})
+        t["count"] += 1
+        t["wait_s"] += waited
+        t["run_s"] += ran
+        t["max_run_s"] = max(t["max_run_s"], ran)
+
+    async def run(self, fn, *args, kind: str = "io", cpu: bool = False):
+        """اجرای fn روی thread pool (یا process pool برای کارهای سنگین CPU) بدون بلاک کردن event loop"""
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        started_at = time.perf_counter()
+        self.running += 1
+        try:
+            return await loop.run_in_executor(self._pool(cpu), fn, *args)
+        finally:
+            self.running -= 1
+            self._slots.release()
+            self._record(kind, started_at - queued_at, time.perf_counter() - started_at)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "queue_limit": self.queue_limit,
+            "loop_lag_ms": dict(self.loop_lag),
+            "timings": {
+                kind: {
+                    "count": t["count"],
+                    "avg_wait_ms": round(t["wait_s"] / t["count"] * 1000, 2),
+                    "avg_run_ms": round(t["run_s"] / t["count"] * 1000, 2),
+                    "max_run_ms": round(t["max_run_s"] * 1000, 2),
+                }
+                for kind, t in self.timings.items()
+            },
+        }
+
+    def shutdown(self):
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self._thread_pool = self._process_pool = None
+
+
+io_executor = IOExecutor(IO_THREADS, IO_PROCESSES, IO_QUEUE_LIMIT)
+
+async def loop_lag_monitor(interval: float = 0.5):
+    # how late the loop wakes up from a sleep = how long something blocked it
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (loop.time() - start - interval) * 1000)
+        io_executor.loop_lag["last_ms"] = round(lag_ms, 2)
+        io_executor.loop_lag["max_ms"] = round(max(io_executor.loop_lag["max_ms"], lag_ms), 2)
+
+
+def build_backup_zip(payloads: Dict[str, str], names: List[str]) -> bytes:
+    import zipfile, io
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name in names:
+            z.writestr(name, payloads[name])
+    return buf.getvalue()
+
+def content_digest(*parts) -> str:
+    # str/bytes are hashed as they are, anything else as compact JSON
+    import hashlib
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif not isinstance(part, (bytes, bytearray)):
+            part = dump_compact(part).encode("utf-8")
+        h.update(len(part).to_bytes(8, "big"))
+        h.update(part)
+    return h.hexdigest()
+
+
+# ---------------- PURCHASES EXPORT ----------------
+# The loop only flattens purchases into long-format columns (one row per item);
+# the pivot to one row per user / one column per product and the file writing
+# happen in the process pool. EXPORT_FORMAT: xlsx (default), csv or parquet.
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "xlsx").lower()
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+
+def purchase_items_long(purchases_by_user: Dict[str, list]) -> Dict[str, list]:
+    cols = {"user": [], "title": [], "cell": []}
+    for uid_k, record_list in purchases_by_user.items():
+        for pur in record_list:
+            for it in pur.get('items', []):
+                cols["user"].append(str(uid_k))
+                cols["title"].append(it.get('title'))
+                cols["cell"].append(f"{it['type']} × {it['qty']}")
+    return cols
+
+def build_purchase_frame(user_keys: List[str], names: List[str], titles: List[str], items: Dict[str, list]):
+    import pandas as pd
+    long = pd.DataFrame(items, columns=["user", "title", "cell"])
+    long = long[long["title"].isin(titles) & long["user"].isin(user_keys)]
+    # item order inside a cell follows the purchases, like the old loops did;
+    # summing "cell / " strings stays vectorized where a join would run per group
+    cells = (
+        (long["cell"] + " / ")
+        .groupby([long["user"], long["title"]], sort=False)
+        .sum()
+        .str.slice(stop=-3)
+    )
+    wide = cells.unstack("title").reindex(index=user_keys, columns=titles).astype(object)
+    wide = pd.concat(
+        [pd.Series(names, index=wide.index, name="نام", dtype=object), wide.where(wide.notna(), 0)],
+        axis=1,
+    )
+    # مرتب‌سازی: اول خوابگاهی‌ها، بعد تهرانی‌ها
+    tehran = wide["نام"].str.contains("تهران", regex=False)
+    order = pd.DataFrame({"t": tehran.to_numpy(), "n": wide["نام"].to_numpy()}).sort_values(["t", "n"], kind="stable").index
+    wide = wide.iloc[order]
+    return wide.reset_index(drop=True)
+
+def write_table(frame, path: Path, fmt: str = "xlsx") -> Path:
+    if fmt == "csv":
+        # utf-8-sig so Excel opens the Persian headers correctly
+        frame.to_csv(path, index=False, encoding="utf-8-sig")
+        return path
+    if fmt == "parquet":
+        frame.astype(str).to_parquet(path, index=False)
+        return path
+    from openpyxl import Workbook
+    # write-only workbook: rows are streamed to the file instead of kept as cells
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(list(frame.columns))
+    for row in frame.itertuples(index=False, name=None):
+        ws.append(row)
+    wb.save(path)
+    return path
+
+def export_purchases(user_keys: List[str], names: List[str], titles: List[str],
+                     items: Dict[str, list], path: Path, fmt: str = "xlsx") -> Path:
+    # runs in the process pool: pandas/openpyxl are CPU-bound and hold the GIL
+    frame = build_purchase_frame(user_keys, names, titles, items)
+    if fmt == "parquet":
+        try:
+            return write_table(frame, path, fmt)
+        except ImportError:
+            # no pyarrow/fastparquet installed: CSV is the closest columnar-free stand-in
+            fmt, path = "csv", path.with_suffix(".csv")
+    return write_table(frame, path, fmt)
+
+
+# ---------------- STORAGE ENGINES ----------------
+# The module-level collections below are the working state; a storage engine
+# keeps them durable. Mutations go through persist(collection, *keys), which
+# hands only the changed records to the engine. Two engines are available,
+# selected with STORAGE_BACKEND:
+#
+#   json   (default) append-only WAL + JSON snapshots in DATA_DIR
+#   sqlite normalized tables with indexes in DATA_DIR / "bookshop.db"
+#
+# Change entries (also the WAL line format):
+#   {"c": "users", "k": "123", "v": {...}}   set one record
+#   {"c": "users", "k": "123", "d": 1}       delete one record
+#   {"c": "blocked", "v": [...]}             replace the whole collection
+#   {"c": "pending_payments", "k": "id", "a": 1, "v": {...}}
+#                                            move one settled payment to the archive
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_FILE = DATA_DIR / "bookshop.db"
+# WEB_WORKERS > 1 runs uvicorn with that many processes over one SQLite file (see WORKERS)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+MULTI_WORKER = WEB_WORKERS > 1
+if MULTI_WORKER and STORAGE_BACKEND != "sqlite":
+    raise RuntimeError("WEB_WORKERS > 1 needs STORAGE_BACKEND=sqlite: the JSON WAL has a single writer")
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"   # origin of this process's rows in the change feed
+CHANGE_POLL_MS = int(os.getenv("CHANGE_POLL_MS", "200"))
+CHANGE_RETENTION_S = int(os.getenv("CHANGE_RETENTION_S", "600"))
+WAL_COMPACT_BYTES = int(os.getenv("WAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+WAL_COMPACT_INTERVAL = int(os.getenv("WAL_COMPACT_INTERVAL", "30"))
+RESTORE_DIR = DATA_DIR / "restore.staging"     # validated backup files waiting to be installed
+RESTORE_READY = "READY"                        # marker: the swap happened, install on next load
+PAYMENT_ARCHIVE_DIR = DATA_DIR / "payments_archive"   # settled payments, one JSONL file per month
+
+COLLECTION_FILES = {
+    "users": USERS_FILE,
+    "products": PRODUCTS_FILE,
+    "orders": ORDERS_FILE,
+    "pending_payments": PENDING_PAYMENTS_FILE,
+    "purchases": PURCHASES_FILE,
+    "blocked": BLOCKED_FILE,
+    "admins": ADMINS_FILE,
+    "conversations": DATA_DIR / "conversations.json",
+    "user_data": DATA_DIR / "user_data.json",
+}
+LIST_COLLECTIONS = ("blocked", "admins")   # sets of user ids in memory, JSON lists on disk
+# ConversationHandler states and context.user_data (see StorePersistence); not part of backups
+SESSION_COLLECTIONS = ("conversations", "user_data")
+# SQLite leaves these in the table and loads one key at a time (session_record)
+LAZY_COLLECTIONS = ("user_data",)
+
+
+def _replace_collection(coll, value):
+    # dict and TrackedSet both take clear() + update()
+    coll.clear()
+    coll.update(value)
+
+def _apply_change(colls: dict, entry: dict):
+    coll = colls.get(entry.get("c"))
+    if coll is None:
+        return
+    if "k" not in entry:
+        _replace_collection(coll, entry.get("v") or type(coll)())
+    elif entry.get("d") or entry.get("a"):
+        coll.pop(entry["k"], None)
+    else:
+        coll[entry["k"]] = entry.get("v")
+
+def _empty_collections() -> dict:
+    return {
+        name: TrackedSet() if name in LIST_COLLECTIONS else TrackedDict()
+        for name in COLLECTION_FILES
+    }
+
+def dump_compact(data) -> str:
+    # no indent: json only uses its C encoder without one, and this runs on the event loop
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=record_json)
+
+def encode_change(entry: dict) -> str:
+    return json.dumps(entry, ensure_ascii=False, default=record_json)
+
+def archive_month(record: dict) -> str:
+    # partition key: the month the payment was settled in
+    stamp = record.get("processed_at") or record.get("timestamp") or datetime.datetime.utcnow().isoformat()
+    return stamp[:7]
+
+def _archive_entries(lines: List[str]) -> List[dict]:
+    # only archive moves carry "a"; skip parsing everything else
+    return [e for e in (json.loads(line) for line in lines if '"a": 1' in line) if e.get("a")]
+
+def snapshot_payloads(colls: dict) -> Dict[str, str]:
+    # serialized snapshot of every collection, keyed by file name
+    return {COLLECTION_FILES[name].name: dump_compact(coll) for name, coll in colls.items()}
+
+
+class JsonLogStorage:
+    """WAL + snapshots: each change is one appended line, snapshots are rebuilt in the background"""
+
+    queries_memory = True   # queries walk the live collections, so they run on the event loop
+
+    def __init__(self, data_dir: Path):
+        self.files = {name: data_dir / path.name for name, path in COLLECTION_FILES.items()}
+        self.wal_file = data_dir / "wal.log"
+        self.compacting_file = data_dir / "wal.log.1"   # log being folded into snapshots
+        self.archive_dir = data_dir / PAYMENT_ARCHIVE_DIR.name
+        self.colls = None
+        self.flush_stats: Dict[str, dict] = {}   # per-file timings of the last snapshot flush
+        self._fp = None
+        # files whose last append failed and may end in a partial line
+        self._torn: Set[Path] = set()
+        self._lock = asyncio.Lock()
+
+    def load(self) -> dict:
+        self._finish_restore()
+        colls = _empty_collections()
+        for name, path in self.files.items():
+            _replace_collection(colls[name], load_json(path, type(colls[name])()))
+            colls[name].dirty = False
+        applied = 0
+        for path in (self.compacting_file, self.wal_file):
+            if not path.exists():
+                continue
+            line = "\n"
+            with path.open(encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line from a crash mid-append
+                        logger.warning("Skipping unreadable WAL line in %s", path.name)
+                        continue
+                    _apply_change(colls, entry)
+                    applied += 1
+            if path == self.wal_file and not line.endswith("\n"):
+                self._torn.add(path)   # the next append starts on a new line
+        if applied:
+            logger.info("Replayed %d WAL entries", applied)
+        self.colls = colls
+        return colls
+
+    def write(self, lines: List[str]):
+        # lines are change entries already serialized by encode_change()
+        archived = _archive_entries(lines)
+        if archived:
+            # archive first: a crash in between leaves the payment in both places, never in neither
+            self._append_archive(archived)
+        if self._fp is None:
+            self._fp = self.wal_file.open("a", encoding="utf-8")
+        try:
+            self._append(self._fp, self.wal_file, "".join(line + "\n" for line in lines))
+        except BaseException:
+            fp, self._fp = self._fp, None
+            with contextlib.suppress(Exception):
+                fp.close()
+            raise
+
+    def _append(self, f, path: Path, text: str):
+        # after a failed append the file may end mid-line: the retry starts on a new
+        # line, so it is not glued to the partial one (load() skips that one)
+        if path in self._torn:
+            text = "\n" + text
+        self._torn.add(path)
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+        self._torn.discard(path)
+
+    def _append_archive(self, entries: List[dict]):
+        self.archive_dir.mkdir(exist_ok=True)
+        by_month = {}
+        for e in entries:
+            by_month.setdefault(archive_month(e["v"]), []).append(dump_compact(e["v"]))
+        for month, rows in by_month.items():
+            path = self.archive_dir / f"{month}.jsonl"
+            with path.open("a", encoding="utf-8") as f:
+                self._append(f, path, "".join(row + "\n" for row in rows))
+
+    def archived_payments(self, month: str = None, user_id: int = None) -> List[dict]:
+        if month:
+            paths = [self.archive_dir / f"{month}.jsonl"]
+        else:
+            paths = sorted(self.archive_dir.glob("*.jsonl")) if self.archive_dir.exists() else []
+        found = {}
+        for path in paths:
+            if not path.exists():
+                continue
+            with path.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue   # torn last line
+                    if user_id is None or rec.get("user_id") == user_id:
+                        # archived twice after a crash: the later copy wins
+                        found[rec.get("payment_id")] = rec
+        return list(found.values())
+
+    def _rotate(self) -> bool:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if not self.wal_file.exists():
+            return self.compacting_file.exists()
+        if self.compacting_file.exists():
+            # a previous compaction died half-way: keep its entries in order
+            with self.compacting_file.open("a", encoding="utf-8") as dst:
+                dst.write(self.wal_file.read_text(encoding="utf-8"))
+            self.wal_file.unlink()
+        else:
+            self.wal_file.rename(self.compacting_file)
+        return True
+
+    def _write_snapshots(self, payloads: Dict[str, str]):
+        for name, text in payloads.items():
+            path = self.files[name]
+            t0 = time.perf_counter()
+            write_atomic(path, text)
+            self.flush_stats[path.name] = {
+                "seconds": round(time.perf_counter() - t0, 6),
+                "bytes": len(text.encode("utf-8")),
+                "at": datetime.datetime.utcnow().isoformat(),
+            }
+        self.compacting_file.unlink(missing_ok=True)
+
+    async def compact(self, force: bool = False):
+        async with self._lock:
+            # the writer thread must not be appending while the log is rotated
+            await committer.flush()
+            # rotate + serialize in one synchronous step so the snapshot matches the log cut
+            if not self._rotate() and not force:
+                return
+            payloads = {}
+            for name, coll in self.colls.items():
+                if force or coll.dirty:
+                    payloads[name] = dump_compact(coll)
+                    coll.dirty = False
+            try:
+                await io_executor.run(self._write_snapshots, payloads, kind="snapshot")
+            except Exception:
+                # keep them dirty; the rotated log is still on disk for the next attempt
+                for name in payloads:
+                    self.colls[name].dirty = True
+                raise
+            if payloads:
+                logger.info(
+                    "Flushed %s",
+                    ", ".join(
+                        f"{self.files[n].name} ({self.flush_stats[self.files[n].name]['seconds'] * 1000:.1f} ms)"
+                        for n in payloads
+                    ),
+                )
+
+    async def install(self, swap, stage_dir: Path):
+        """Restore: the staged (validated) files become the snapshots; swap() replaces memory"""
+        async with self._lock:
+            async with committer.exclusive():
+                # the log so far describes the old data: rotate it out and drop it below
+                self._rotate()
+                # the rotated log also holds entries for collections the backup does not
+                # carry (admins, sessions): they are staged and installed with the rest
+                kept = {name: dump_compact(coll) for name, coll in self.colls.items()
+                        if coll.dirty and not (stage_dir / self.files[name].name).exists()}
+                await io_executor.run(self._stage_snapshots, stage_dir, kept, kind="snapshot")
+                # from here a crash rolls forward on the next load()
+                write_atomic(stage_dir / RESTORE_READY, "")
+                swap()
+                for name in self.files:
+                    if (stage_dir / self.files[name].name).exists():
+                        self.colls[name].dirty = False
+            await io_executor.run(self._finish_restore, kind="snapshot")
+
+    def _stage_snapshots(self, stage_dir: Path, payloads: Dict[str, str]):
+        for name, text in payloads.items():
+            write_atomic(stage_dir / self.files[name].name, text)
+
+    def _finish_restore(self):
+        stage_dir = RESTORE_DIR
+        if not (stage_dir / RESTORE_READY).exists():
+            return
+        for path in self.files.values():
+            staged = stage_dir / path.name
+            if staged.exists():
+                os.replace(staged, path)
+        self.compacting_file.unlink(missing_ok=True)
+        (stage_dir / RESTORE_READY).unlink()
+        logger.info("Installed restored snapshots")
+
+    def needs_compaction(self) -> bool:
+        return self.wal_file.exists() and self.wal_file.stat().st_size >= WAL_COMPACT_BYTES
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    # --- queries over the in-memory collections ---
+    def session_record(self, name: str, key: str):
+        return self.colls[name].get(key)
+
+    def type_totals(self, source: str) -> Dict[str, dict]:
+        agg = {}
+        for record_list in self.colls[source].values():
+            for rec in record_list:
+                for it in rec.get("items", []):
+                    per_type = agg.setdefault(it['title'], {"رنگی کیفیت بالا": 0, "رنگی کیفیت پایین": 0, "سیاه و سفید": 0})
+                    per_type[it['type']] = per_type.get(it['type'], 0) + it.get('qty', 0)
+        return agg
+
+    def user_totals(self, source: str, pid: str, typ: str) -> Dict[str, int]:
+        user_qty = {}
+        for uid_k, record_list in self.colls[source].items():
+            for rec in record_list:
+                for it in rec.get("items", []):
+                    if it.get('product_id') == pid and it.get('type') == typ:
+                        user_qty[str(uid_k)] = user_qty.get(str(uid_k), 0) + it.get('qty', 0)
+        return user_qty
+
+
+class SqliteStorage:
+    """Normalized SQLite tables; orders and purchases are split into header + item rows"""
+
+    queries_memory = False  # queries hit the tables, so they must run after pending commits
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS users (user_key TEXT PRIMARY KEY, data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS products (product_id TEXT PRIMARY KEY, title TEXT, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS ix_products_title ON products (title);
+    CREATE TABLE IF NOT EXISTS payments (
+        payment_id TEXT PRIMARY KEY, user_id INTEGER, status TEXT, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS ix_payments_user ON payments (user_id);
+    CREATE INDEX IF NOT EXISTS ix_payments_status ON payments (status);
+    CREATE TABLE IF NOT EXISTS payments_archive (
+        payment_id TEXT PRIMARY KEY, month TEXT NOT NULL, user_id INTEGER, status TEXT, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS ix_payments_archive_month ON payments_archive (month, user_id);
+    CREATE INDEX IF NOT EXISTS ix_payments_archive_user ON payments_archive (user_id);
+    CREATE TABLE IF NOT EXISTS lists (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS sessions (
+        coll TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (coll, key));
+    """
+    # orders and purchases share one layout
+    RECORD_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {t} (
+        id INTEGER PRIMARY KEY, user_key TEXT NOT NULL, pos INTEGER NOT NULL,
+        user_id INTEGER, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS ix_{t}_user_key ON {t} (user_key, pos);
+    CREATE INDEX IF NOT EXISTS ix_{t}_user_id ON {t} (user_id);
+    CREATE TABLE IF NOT EXISTS {t}_items (
+        record_id INTEGER NOT NULL, user_key TEXT NOT NULL, pos INTEGER NOT NULL,
+        product_id TEXT, title TEXT, type TEXT, qty INTEGER, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS ix_{t}_items_record ON {t}_items (record_id, pos);
+    CREATE INDEX IF NOT EXISTS ix_{t}_items_user_key ON {t}_items (user_key);
+    CREATE INDEX IF NOT EXISTS ix_{t}_items_product ON {t}_items (product_id, type);
+    """
+
+    # every write batch also lands in here when origin is set (multi-worker change feed)
+    FEED_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, at REAL NOT NULL, line TEXT NOT NULL);
+    """
+
+    def __init__(self, db_path: Path, json_dir: Path = None, origin: str = None):
+        import sqlite3
+        self.db_path = db_path
+        self.json_dir = json_dir
+        self.origin = origin
+        self.feed_seq = 0
+        # other workers' transactions: wait for them instead of failing with "database is locked"
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(self.SCHEMA)
+        for t in ("orders", "purchases"):
+            self.conn.executescript(self.RECORD_SCHEMA.format(t=t))
+        self.conn.executescript(self.FEED_SCHEMA)
+        self.colls = None
+        self.flush_stats: Dict[str, dict] = {}
+
+    def _migrated(self) -> bool:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone()
+        return row is not None
+
+    def migrate_from_json(self, json_dir: Path):
+        # one-shot import of data/*.json (+ WAL); the JSON files are left untouched
+        source = JsonLogStorage(json_dir)
+        colls = source.load()
+        # workers starting together: the first one to get the write lock migrates
+        self.conn.execute("BEGIN IMMEDIATE")
+        with self.conn:
+            if self._migrated():
+                return
+            self._replace_all(colls)
+            for rec in source.archived_payments():
+                self._archive_one(rec.get("payment_id"), rec)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('migrated_from_json', ?)",
+                (datetime.datetime.utcnow().isoformat(),),
+            )
+        logger.info("Migrated JSON data from %s into %s", json_dir, self.db_path.name)
+
+    def load(self) -> dict:
+        if self.json_dir is not None and not self._migrated():
+            self.migrate_from_json(self.json_dir)
+        # changes after this point are replayed by the change feed; replaying one that
+        # the tables below already contain is harmless, every entry is a whole record
+        self.feed_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        colls = _empty_collections()
+        for key, data in self.conn.execute("SELECT user_key, data FROM users"):
+            colls["users"][key] = json.loads(data)
+        for pid, data in self.conn.execute("SELECT product_id, data FROM products ORDER BY rowid"):
+            colls["products"][pid] = json.loads(data)
+        for pay_id, data in self.conn.execute("SELECT payment_id, data FROM payments ORDER BY rowid"):
+            colls["pending_payments"][pay_id] = json.loads(data)
+        for name in LIST_COLLECTIONS:
+            row = self.conn.execute("SELECT data FROM lists WHERE name = ?", (name,)).fetchone()
+            if row:
+                colls[name].update(json.loads(row[0]))
+        for name in SESSION_COLLECTIONS:
+            if name not in LAZY_COLLECTIONS:
+                for key, data in self.conn.execute("SELECT key, data FROM sessions WHERE coll = ?", (name,)):
+                    colls[name][key] = json.loads(data)
+        for t in ("orders", "purchases"):
+            items = {}
+            for record_id, data in self.conn.execute(f"SELECT record_id, data FROM {t}_items ORDER BY record_id, pos"):
+                items.setdefault(record_id, []).append(json.loads(data))
+            for record_id, user_key, data in self.conn.execute(f"SELECT id, user_key, data FROM {t} ORDER BY id"):
+                rec = json.loads(data)
+                rec["items"] = items.get(record_id, [])
+                colls[t].setdefault(user_key, []).append(rec)
+        for coll in colls.values():
+            coll.dirty = False
+        self.colls = colls
+        return colls
+
+    def _write_record_list(self, t: str, user_key: str, records):
+        self.conn.execute(f"DELETE FROM {t}_items WHERE user_key = ?", (user_key,))
+        self.conn.execute(f"DELETE FROM {t} WHERE user_key = ?", (user_key,))
+        for pos, rec in enumerate(records or []):
+            header = {k: v for k, v in rec.items() if k != "items"}
+            cur = self.conn.execute(
+                f"INSERT INTO {t} (user_key, pos, user_id, data) VALUES (?, ?, ?, ?)",
+                (user_key, pos, rec.get("user_id"), json.dumps(header, ensure_ascii=False)),
+            )
+            self.conn.executemany(
+                f"INSERT INTO {t}_items (record_id, user_key, pos, product_id, title, type, qty, data) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (cur.lastrowid, user_key, i, it.get("product_id"), it.get("title"),
+                     it.get("type"), it.get("qty", 0), json.dumps(it, ensure_ascii=False, default=record_json))
+                    for i, it in enumerate(rec.get("items", []))
+                ],
+            )
+
+    def _write_one(self, name: str, key: str, value):
+        deleted = value is None
+        if name == "users":
+            if deleted:
+                self.conn.execute("DELETE FROM users WHERE user_key = ?", (key,))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False, default=record_json)))
+        elif name == "products":
+            if deleted:
+                self.conn.execute("DELETE FROM products WHERE product_id = ?", (key,))
+            else:
+                self.conn.execute(
+                    "INSERT INTO products VALUES (?, ?, ?) ON CONFLICT(product_id) DO UPDATE SET title = excluded.title, data = excluded.data",
+                    (key, value.get("title"), json.dumps(value, ensure_ascii=False, default=record_json)),
+                )
+        elif name == "pending_payments":
+            if deleted:
+                self.conn.execute("DELETE FROM payments WHERE payment_id = ?", (key,))
+            else:
+                self.conn.execute(
+                    "INSERT INTO payments VALUES (?, ?, ?, ?) ON CONFLICT(payment_id) DO UPDATE SET "
+                    "user_id = excluded.user_id, status = excluded.status, data = excluded.data",
+                    (key, value.get("user_id"), value.get("status"), json.dumps(value, ensure_ascii=False, default=record_json)),
+                )
+        elif name in ("orders", "purchases"):
+            self._write_record_list(name, key, value)
+        elif name in SESSION_COLLECTIONS:
+            if deleted:
+                self.conn.execute("DELETE FROM sessions WHERE coll = ? AND key = ?", (name, key))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (name, key, json.dumps(value, ensure_ascii=False, default=record_json)))
+
+    def _archive_one(self, pay_id: str, value: dict):
+        # same transaction as the rest of the batch: the row moves, it is never in both tables
+        self.conn.execute(
+            "INSERT OR REPLACE INTO payments_archive VALUES (?, ?, ?, ?, ?)",
+            (pay_id, archive_month(value), value.get("user_id"), value.get("status"), json.dumps(value, ensure_ascii=False, default=record_json)),
+        )
+        self.conn.execute("DELETE FROM payments WHERE payment_id = ?", (pay_id,))
+
+    def _replace_collection_rows(self, name: str, value):
+        if name in LIST_COLLECTIONS:
+            self.conn.execute("INSERT OR REPLACE INTO lists VALUES (?, ?)", (name, json.dumps(sorted(value or []))))
+            return
+        if name in SESSION_COLLECTIONS:
+            self.conn.execute("DELETE FROM sessions WHERE coll = ?", (name,))
+            for key, v in (value or {}).items():
+                self._write_one(name, key, v)
+            return
+        table = {"pending_payments": "payments"}.get(name, name)
+        self.conn.execute(f"DELETE FROM {table}")
+        if name in ("orders", "purchases"):
+            self.conn.execute(f"DELETE FROM {name}_items")
+        for key, v in (value or {}).items():
+            self._write_one(name, key, v)
+
+    def _replace_all(self, colls: dict):
+        for name, coll in colls.items():
+            self._replace_collection_rows(name, coll)
+
+    def write(self, lines: List[str]):
+        with self.conn:
+            for e in map(json.loads, lines):
+                if "k" not in e:
+                    self._replace_collection_rows(e["c"], e.get("v"))
+                elif e.get("a"):
+                    self._archive_one(e["k"], e["v"])
+                else:
+                    self._write_one(e["c"], e["k"], None if e.get("d") else e.get("v"))
+            if self.origin is not None:
+                now = time.time()
+                self.conn.executemany(
+                    "INSERT INTO changes (origin, at, line) VALUES (?, ?, ?)",
+                    [(self.origin, now, line) for line in lines],
+                )
+
+    async def compact(self, force: bool = False):
+        # every write is already in its table; force rewrites everything from memory
+        await committer.flush()
+        if force:
+            with self.conn:
+                # lazy collections only hold the keys read so far
+                self._replace_all({n: c for n, c in self.colls.items() if n not in LAZY_COLLECTIONS})
+        for coll in self.colls.values():
+            coll.dirty = False
+
+    async def install(self, swap, stage_dir: Path):
+        """Restore: swap() replaces memory, then each restored collection is written once"""
+        async with committer.exclusive():
+            swap()
+            names = [n for n, p in COLLECTION_FILES.items() if (stage_dir / p.name).exists()]
+            ticket = committer.stage([encode_change({"c": n, "v": self.colls[n]}) for n in names])
+            for n in names:
+                self.colls[n].dirty = False
+        await ticket
+        import shutil
+        await io_executor.run(shutil.rmtree, stage_dir, True, kind="snapshot")
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def close(self):
+        self.conn.close()
+
+    # --- change feed ---
+    def changes_since(self, seq: int):
+        # (last seq, lines written by the other workers after seq)
+        rows = self.conn.execute("SELECT seq, origin, line FROM changes WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        if rows:
+            seq = rows[-1][0]
+        return seq, [line for _, origin, line in rows if origin != self.origin]
+
+    def trim_changes(self, before: float) -> int:
+        with self.conn:
+            return self.conn.execute("DELETE FROM changes WHERE at < ?", (before,)).rowcount
+
+    # --- indexed queries ---
+    def session_record(self, name: str, key: str):
+        row = self.conn.execute("SELECT data FROM sessions WHERE coll = ? AND key = ?", (name, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def archived_payments(self, month: str = None, user_id: int = None) -> List[dict]:
+        sql, args = "SELECT data FROM payments_archive WHERE 1 = 1", []
+        if month:
+            sql += " AND month = ?"
+            args.append(month)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            args.append(user_id)
+        return [json.loads(row[0]) for row in self.conn.execute(sql + " ORDER BY rowid", args)]
+
+    def type_totals(self, source: str) -> Dict[str, dict]:
+        agg = {}
+        rows = self.conn.execute(
+            f"SELECT title, type, SUM(qty) FROM {source}_items GROUP BY title, type ORDER BY MIN(record_id)"
+        )
+        for title, typ, qty in rows:
+            per_type = agg.setdefault(title, {"رنگی کیفیت بالا": 0, "رنگی کیفیت پایین": 0, "سیاه و سفید": 0})
+            per_type[typ] = per_type.get(typ, 0) + (qty or 0)
+        return agg
+
+    def user_totals(self, source: str, pid: str, typ: str) -> Dict[str, int]:
+        rows = self.conn.execute(
+            f"SELECT user_key, SUM(qty) FROM {source}_items WHERE product_id = ? AND type = ? "
+            f"GROUP BY user_key ORDER BY MIN(record_id)",
+            (pid, typ),
+        )
+        return {user_key: qty or 0 for user_key, qty in rows}
+
+
+def make_storage(backend: str = STORAGE_BACKEND, data_dir: Path = DATA_DIR):
+    if backend == "sqlite":
+        return SqliteStorage(data_dir / SQLITE_FILE.name, json_dir=data_dir, origin=WORKER_ID if MULTI_WORKER else None)
+    return JsonLogStorage(data_dir)
+
+
+# loading the data allocates millions of long-lived objects: no collections while it
+# runs, then they are frozen out of every later collection. GC is back on whether
+# the load succeeds or not, so a failed import never leaves the process without it.
+gc.disable()
+try:
+    storage = make_storage()
+    _loaded = storage.load()
+    adopt_items(_loaded)
+    gc.freeze()
+finally:
+    gc.enable()
+startup.mark("load")
+
+# ---------------- GROUP COMMIT ----------------
+# persist() only stages its entries and hands back a commit ticket. A single
+# writer thread writes (and fsyncs) whatever is staged as one batch, so
+# batches reach disk in order. When the writer is idle a batch goes out on
+# the next loop iteration; while it is busy, everything staged meanwhile
+# waits and becomes the next batch, so batches grow with the load instead of
+# with a timer. COMMIT_WINDOW_MS adds a fixed wait before each batch, which
+# only pays off when an fsync costs more than the window (slow disks).
+# Handlers `await` the ticket before replying, so a reply still means "saved".
+# A batch that fails to write goes back in front of the staged entries and is
+# retried (backing off up to COMMIT_RETRY_MAX_S): its waiters get the error,
+# but fire-and-forget persist() calls are not lost and the order on disk holds.
+COMMIT_WINDOW_MS = int(os.getenv("COMMIT_WINDOW_MS", "0"))
+COMMIT_RETRY_MAX_S = float(os.getenv("COMMIT_RETRY_MAX_S", "5"))
+
+
+class GroupCommitter:
+    def __init__(self, window_ms: int):
+        from concurrent.futures import ThreadPoolExecutor
+        self.window = window_ms / 1000
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="commit")
+        self._entries: List[str] = []
+        self._ticket = None
+        # held while a batch is taken and written; exclusive() holds it across a restore swap
+        self._gate = asyncio.Lock()
+        # a failing disk is not retried in a tight loop, even with no window
+        self._retry_base = max(self.window, 0.05)
+        self._retry_delay = self._retry_base
+        self.stats = {"batches": 0, "entries": 0, "flush_s": 0.0, "max_batch": 0, "failed": 0}
+
+    def stage(self, entries: List[str]):
+        self._entries.extend(entries)
+        return self._schedule(self.window)
+
+    def _schedule(self, delay: float):
+        if self._ticket is None:
+            loop = asyncio.get_running_loop()
+            self._ticket = loop.create_future()
+            loop.create_task(self._commit_after_window(delay))
+        return self._ticket
+
+    def _take_batch(self):
+        entries, ticket = self._entries, self._ticket
+        self._entries, self._ticket = [], None
+        return entries, ticket
+
+    def _write(self, entries: List[str]):
+        t0 = time.perf_counter()
+        storage.write(entries)
+        elapsed = time.perf_counter() - t0
+        self.stats["batches"] += 1
+        self.stats["entries"] += len(entries)
+        self.stats["flush_s"] += elapsed
+        commit_seconds.observe(elapsed)
+        commit_bytes.inc(amount=sum(len(e.encode("utf-8")) for e in entries))
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(entries))
+
+    async def _commit(self, entries: List[str], ticket):
+        try:
+            if entries:
+                await asyncio.get_running_loop().run_in_executor(self._writer, self._write, entries)
+        except Exception as e:
+            logger.exception("Group commit failed (%d entries, retrying in %.2fs): %s",
+                             len(entries), self._retry_delay, e)
+            self.stats["failed"] += 1
+            # nothing of the batch counts as written: it goes first in the next one
+            self._entries[:0] = entries
+            self._schedule(self._retry_delay)
+            self._retry_delay = min(self._retry_delay * 2, COMMIT_RETRY_MAX_S)
+            if ticket is not None and not ticket.done():
+                ticket.set_exception(e)
+            raise
+        self._retry_delay = self._retry_base
+        if ticket is not None and not ticket.done():
+            ticket.set_result(None)
+
+    async def _commit_after_window(self, delay: float):
+        await asyncio.sleep(delay)
+        async with self._gate:
+            entries, ticket = self._take_batch()
+            try:
+                await self._commit(entries, ticket)
+            except Exception:
+                pass  # already reported to whoever awaits the ticket
+
+    async def flush(self):
+        # commit whatever is staged now and wait until everything before it is on disk
+        async with self._gate:
+            await self._flush_now()
+
+    async def _flush_now(self):
+        entries, ticket = self._take_batch()
+        if entries:
+            await self._commit(entries, ticket)
+        else:
+            # nothing staged: still wait for a batch the writer may be in the middle of
+            await asyncio.get_running_loop().run_in_executor(self._writer, time.sleep, 0)
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        # everything staged so far is on disk and nothing more is written until the
+        # block exits; entries staged meanwhile are committed right after it
+        async with self._gate:
+            await self._flush_now()
+            yield
+
+    async def call(self, fn, *args):
+        # run fn on the writer thread after every write staged so far
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(self._writer, fn, *args)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+
+
+committer = GroupCommitter(COMMIT_WINDOW_MS)
+
+# derived in-memory views (aggregates, indexes) register here and are told
+# about every persisted change; empty keys means the whole collection changed
+_change_listeners = []
+
+def on_change(fn):
+    _change_listeners.append(fn)
+    return fn
+
+def rebuild_derived():
+    # after a restore or any bulk replacement that bypassed persist()
+    for name in COLLECTION_FILES:
+        for fn in _change_listeners:
+            fn(name, ())
+
+def persist(name: str, *keys):
+    """ثبت تغییر یک یا چند رکورد از یک مجموعه؛ خروجی را await کنید تا روی دیسک نوشته شود"""
+    coll = _loaded[name]
+    coll.dirty = True
+    for fn in _change_listeners:
+        fn(name, keys)
+    if not keys:
+        entries = [{"c": name, "v": coll}]
+    else:
+        entries = [
+            {"c": name, "k": k, "v": coll[k]} if k in coll else {"c": name, "k": k, "d": 1}
+            for k in keys
+        ]
+    # serialize now: the writer thread must not see later in-memory edits
+    return committer.stage([encode_change(e) for e in entries])
+
+def archive_payment(pay_id: str):
+    """فیش تاییدشده/ردشده از pending_payments به آرشیو ماهانه منتقل می‌شود؛ خروجی را await کنید"""
+    coll = _loaded["pending_payments"]
+    record = coll.pop(pay_id)
+    coll.dirty = True
+    for fn in _change_listeners:
+        fn("pending_payments", (pay_id,))
+    return committer.stage([encode_change({"c": "pending_payments", "k": pay_id, "a": 1, "v": record})])
+
+async def archive_settled_payments():
+    # payments settled before the archive existed still sit in the hot store
+    settled = [k for k, p in _loaded["pending_payments"].items() if p.get("status") != "pending"]
+    ticket = None
+    for pay_id in settled:
+        ticket = archive_payment(pay_id)
+    if ticket is not None:
+        await ticket
+        logger.info("Archived %d settled payments", len(settled))
+
+async def archived_payments(month: str = None, user_id: int = None) -> List[dict]:
+    # runs on the writer thread, after every archive move staged so far
+    return await committer.call(storage.archived_payments, month, user_id)
+
+async def query(method: str, *args):
+    # storage queries; SQLite ones are ordered after the pending commits
+    fn = getattr(storage, method)
+    if storage.queries_memory:
+        return fn(*args)
+    return await committer.call(fn, *args)
+
+async def compact(force: bool = False):
+    await storage.compact(force)
+
+async def wal_compactor():
+    while True:
+        await asyncio.sleep(WAL_COMPACT_INTERVAL)
+        try:
+            if storage.needs_compaction():
+                await compact()
+        except Exception as e:
+            logger.warning(f"WAL compaction failed: {e}")
+
+
+users: Dict[str, dict] = _loaded["users"]
+products: Dict[str, dict] = _loaded["products"]
+orders: Dict[str, list] = _loaded["orders"]  # orders per user (finalized, unpaid)
+pending_payments: Dict[str, dict] = _loaded["pending_payments"]
+purchases: Dict[str, list] = _loaded["purchases"]
+blocked: Set[int] = _loaded["blocked"]
+# --- 🔽 کد جدید برای ذخیره‌سازی ادمین‌ها ---
+admins = _loaded["admins"]
 # --- 🔽 اضافه کردن OTHER_ADMINS از متغیر محیطی ---
 OTHER_ADMINS_ENV = os.getenv("OTHER_ADMINS_ID", "")
 
@@ -103,30 +1530,197 @@ if OTHER_ADMINS_ENV:
         if uid.strip().isdigit()
     ]
 
-    for uid in other_admins:
-        if uid not in admins:
-            admins.append(uid)
+    admins.update(other_admins)
 # --- 🔼 پایان ---
 # --- 🔼 پایان کد جدید ---
 
 
-users: Dict[str, dict] = load_json(USERS_FILE, {})
-products: Dict[str, dict] = load_json(PRODUCTS_FILE, {})
-orders: Dict[str, list] = load_json(ORDERS_FILE, {})  # orders per user (finalized, unpaid)
-pending_payments: Dict[str, dict] = load_json(PENDING_PAYMENTS_FILE, {})
-purchases: Dict[str, list] = load_json(PURCHASES_FILE, {})
-blocked: List[int] = load_json(BLOCKED_FILE, [])
+# ---------------- MATERIALIZED AGGREGATES ----------------
+PRINT_TYPES = tuple(PrintType)
+
+class ItemAggregates:
+    """جمع تعداد آیتم‌ها به تفکیک (جزوه، نوع چاپ) و (جزوه، نوع چاپ، کاربر)
+
+    هر کاربر سهم فعلی خودش را دارد؛ با تغییر رکوردهای یک کاربر فقط همان سهم
+    کم و دوباره اضافه می‌شود و گزارش‌ها دیگر کل سفارش‌ها را پیمایش نمی‌کنند.
+    Only admin reports read these, so they are built on first use, not at startup.
+    """
+
+    def __init__(self, coll: Dict[str, list]):
+        self.coll = coll
+        self.by_type: Dict[tuple, int] = {}          # (pid, type) -> qty
+        self.by_user: Dict[tuple, Dict[str, int]] = {}  # (pid, type) -> {user_key: qty}
+        self.titles: Dict[str, str] = {}             # pid -> title as stored on the items
+        self._contrib: Dict[str, Dict[tuple, int]] = {}
+        self.built = False
+
+    def ready(self) -> "ItemAggregates":
+        if not self.built:
+            self.rebuild()
+        return self
+
+    def _add(self, uid_k: str, key: tuple, qty: int):
+        total = self.by_type.get(key, 0) + qty
+        per_user = self.by_user.setdefault(key, {})
+        mine = per_user.get(uid_k, 0) + qty
+        if mine:
+            per_user[uid_k] = mine
+        else:
+            per_user.pop(uid_k, None)
+        if total or per_user:
+            self.by_type[key] = total
+        else:
+            self.by_type.pop(key, None)
+            self.by_user.pop(key, None)
+
+    def refresh_user(self, uid_k: str):
+        for key, qty in self._contrib.pop(uid_k, {}).items():
+            self._add(uid_k, key, -qty)
+        contrib = {}
+        for rec in self.coll.get(uid_k, []):
+            for it in rec.get("items", []):
+                key = (it.get("product_id"), it.get("type"))
+                contrib[key] = contrib.get(key, 0) + it.get("qty", 0)
+                self.titles[key[0]] = it.get("title")
+        for key, qty in contrib.items():
+            self._add(uid_k, key, qty)
+        if contrib:
+            self._contrib[uid_k] = contrib
+
+    def rebuild(self):
+        self.by_type.clear()
+        self.by_user.clear()
+        self.titles.clear()
+        self._contrib.clear()
+        for uid_k in list(self.coll):
+            self.refresh_user(uid_k)
+        self.built = True
+
+    def type_totals(self) -> Dict[str, dict]:
+        # {title: {print type: qty}} for the report keyboards
+        agg = {}
+        for (pid, typ), qty in self.ready().by_type.items():
+            per_type = agg.setdefault(self.titles.get(pid), dict.fromkeys(PRINT_TYPES, 0))
+            per_type[typ] = per_type.get(typ, 0) + qty
+        return agg
+
+    def user_totals(self, pid: str, typ: str) -> Dict[str, int]:
+        return dict(self.ready().by_user.get((pid, typ), {}))
+
+
+aggregates = {
+    "orders": ItemAggregates(orders),
+    "purchases": ItemAggregates(purchases),
+}
 
-def persist_all():
-    save_json(USERS_FILE, users)
-    save_json(PRODUCTS_FILE, products)
-    save_json(ORDERS_FILE, orders)
-    save_json(PENDING_PAYMENTS_FILE, pending_payments)
-    save_json(PURCHASES_FILE, purchases)
-    save_json(BLOCKED_FILE, blocked)
-    # --- 🔽 ذخیره ادمین‌ها ---
-    save_json(ADMINS_FILE, admins)
-    # --- 🔼 پایان تغییر ---
+@on_change
+def _update_aggregates(name: str, keys: tuple):
+    agg = aggregates.get(name)
+    if agg is None or not agg.built:
+        return
+    if not keys:
+        agg.rebuild()
+        return
+    for k in keys:
+        agg.refresh_user(k)
+
+
+# ---------------- SECONDARY INDEXES ----------------
+class RecordIndexes:
+    """ایندکس‌های درون‌حافظه‌ای: عنوان → جزوه، order_id → سفارش، جزوه → کاربران ارجاع‌دهنده"""
+
+    def __init__(self, colls: dict):
+        self.colls = colls
+        self.title_pids: Dict[str, List[str]] = {}   # title -> pids, first one wins
+        self._pid_title: Dict[str, str] = {}
+        self.order_ids: Dict[str, tuple] = {}        # order_id -> (user_key, order)
+        self._user_orders: Dict[str, List[str]] = {}
+        # pid -> user keys whose orders / purchases contain the product
+        self.refs = {"orders": {}, "purchases": {}}
+        self._user_pids = {"orders": {}, "purchases": {}}
+        for name in ("products", "orders", "purchases"):
+            self.refresh(name, ())
+
+    # -- products --
+    def _refresh_product(self, pid: str):
+        old = self._pid_title.pop(pid, None)
+        if old is not None:
+            pids = self.title_pids.get(old, [])
+            if pid in pids:
+                pids.remove(pid)
+            if not pids:
+                self.title_pids.pop(old, None)
+        p = self.colls["products"].get(pid)
+        if p is not None:
+            title = p.get("title")
+            self._pid_title[pid] = title
+            self.title_pids.setdefault(title, []).append(pid)
+
+    # -- orders / purchases --
+    def _refresh_user(self, name: str, uid_k: str):
+        records = self.colls[name].get(uid_k, [])
+        if name == "orders":
+            for oid in self._user_orders.pop(uid_k, []):
+                self.order_ids.pop(oid, None)
+            oids = [o.get("order_id") for o in records]
+            for o in records:
+                self.order_ids[o.get("order_id")] = (uid_k, o)
+            if oids:
+                self._user_orders[uid_k] = oids
+        refs = self.refs[name]
+        old = self._user_pids[name].pop(uid_k, set())
+        new = {it.get("product_id") for rec in records for it in rec.get("items", [])}
+        for pid in old - new:
+            users_of = refs.get(pid)
+            if users_of is not None:
+                users_of.discard(uid_k)
+                if not users_of:
+                    refs.pop(pid, None)
+        for pid in new - old:
+            refs.setdefault(pid, set()).add(uid_k)
+        if new:
+            self._user_pids[name][uid_k] = new
+
+    def refresh(self, name: str, keys: tuple):
+        if name == "products":
+            if not keys:
+                self.title_pids.clear()
+                self._pid_title.clear()
+                keys = tuple(self.colls["products"])
+            for pid in keys:
+                self._refresh_product(pid)
+        elif name in self.refs:
+            if not keys:
+                if name == "orders":
+                    self.order_ids.clear()
+                    self._user_orders.clear()
+                self.refs[name].clear()
+                self._user_pids[name].clear()
+                keys = tuple(self.colls[name])
+            for uid_k in keys:
+                self._refresh_user(name, uid_k)
+
+    def product_by_title(self, title: str):
+        pids = self.title_pids.get(title)
+        if not pids:
+            return None, None
+        pid = pids[0]
+        return pid, self.colls["products"][pid]
+
+    def order(self, order_id: str, uid_k: str = None):
+        # (user_key, order) or (None, None); with uid_k, only that user's order counts
+        hit = self.order_ids.get(order_id)
+        if hit is None or (uid_k is not None and hit[0] != uid_k):
+            return None, None
+        return hit
+
+    def users_referencing(self, name: str, pid: str) -> List[str]:
+        return list(self.refs[name].get(pid, ()))
+
+
+indexes = RecordIndexes(_loaded)
+on_change(indexes.refresh)
+startup.mark("views")
 
 
 
@@ -138,6 +1732,519 @@ def is_admin(uid: int) -> bool:
 # --- 🔼 پایان تابع ---
 
 
+# ---------------- BROADCAST ----------------
+# Fan-out to several chats (admins, later users). Chats are sent to
+# concurrently, but messages to one chat keep their order. A global and a
+# per-chat token bucket keep us under the Bot API limits (~30 msg/s overall,
+# about 1 msg/s per chat with short bursts). A 429 pauses both buckets for
+# retry_after and the message is retried.
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))
+BROADCAST_CHAT_RATE = float(os.getenv("BROADCAST_CHAT_RATE", "1"))
+BROADCAST_CHAT_BURST = int(os.getenv("BROADCAST_CHAT_BURST", "3"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "4"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    await asyncio.sleep(self.resume_at - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """ارسال هم‌زمان به چند چت با رعایت محدودیت‌های تلگرام؛ نتیجهٔ هر گیرنده برگردانده می‌شود"""
+
+    def __init__(self, concurrency: int = BROADCAST_CONCURRENCY, global_rate: float = BROADCAST_GLOBAL_RATE,
+                 chat_rate: float = BROADCAST_CHAT_RATE, chat_burst: int = BROADCAST_CHAT_BURST,
+                 max_attempts: int = BROADCAST_MAX_ATTEMPTS):
+        self.sem = asyncio.Semaphore(concurrency)
+        self.global_bucket = TokenBucket(global_rate, int(global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self.stats = {"sent": 0, "failed": 0, "retries": 0, "retry_after_s": 0.0}
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _send_one(self, chat_id: int, make_call) -> dict:
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            await self._bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                async with self.sem:
+                    message = await make_call(chat_id)
+                self.stats["sent"] += 1
+                return {"chat_id": chat_id, "ok": True, "attempts": attempt, "error": None, "message": message}
+            except RetryAfter as e:
+                # a 429 does not say whether the chat or the bot hit the limit
+                self._bucket(chat_id).pause(e.retry_after)
+                self.global_bucket.pause(e.retry_after)
+                self.stats["retry_after_s"] += e.retry_after
+                error = e
+            except BadRequest as e:
+                error = e
+                break
+            except NetworkError as e:
+                # timeouts and connection errors: back off and try again
+                await asyncio.sleep(min(2 ** attempt, 30) * 0.5)
+                error = e
+            except Exception as e:
+                # Forbidden (bot blocked), ...: retrying will not help
+                error = e
+                break
+            self.stats["retries"] += 1
+        self.stats["failed"] += 1
+        return {"chat_id": chat_id, "ok": False, "attempts": attempt, "error": str(error), "message": None}
+
+    async def run(self, jobs: List[tuple]) -> List[dict]:
+        """jobs: (chat_id, make_call) pairs, make_call(chat_id) returns the send coroutine.
+        Results come back in job order."""
+        results: List[dict] = [None] * len(jobs)
+        per_chat: Dict[int, List[int]] = {}
+        for i, (chat_id, _) in enumerate(jobs):
+            per_chat.setdefault(chat_id, []).append(i)
+
+        async def drain(indices: List[int]):
+            for i in indices:
+                chat_id, make_call = jobs[i]
+                results[i] = await self._send_one(chat_id, make_call)
+
+        await asyncio.gather(*(drain(indices) for indices in per_chat.values()))
+        return results
+
+    async def send(self, chat_ids, make_call) -> List[dict]:
+        return await self.run([(chat_id, make_call) for chat_id in chat_ids])
+
+
+broadcaster = Broadcaster()
+
+def admin_ids() -> List[int]:
+    return list(dict.fromkeys([ADMIN_ID] + sorted(admins)))
+
+def log_failed_sends(results: List[dict], what: str):
+    for r in results:
+        if not r["ok"]:
+            logger.warning(f"⚠️ ارسال {what} به ادمین {r['chat_id']} ناموفق بود: {r['error']}")
+
+
+# ---------------- MEDIA CACHE ----------------
+# Documents are uploaded once; Telegram's file_id from that upload is reused
+# for every other recipient and for later sends of the same content. Entries
+# are keyed by a digest of what the file is built from (the zip and xlsx
+# bytes carry timestamps, so hashing the output would never hit).
+MEDIA_CACHE_FILE = DATA_DIR / "media_cache.json"
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "64"))
+
+
+class MediaCache:
+    def __init__(self, path: Path, size: int = MEDIA_CACHE_SIZE):
+        self.path = path
+        self.size = size
+        self.entries: Dict[str, dict] = load_json(path, {})  # digest -> {"file_id", "filename"}
+        self.stats = {"hits": 0, "uploads": 0, "invalidated": 0}
+
+    def get(self, digest: str):
+        entry = self.entries.get(digest)
+        return entry["file_id"] if entry else None
+
+    async def _put(self, digest: str, file_id: str, filename: str):
+        self.entries.pop(digest, None)
+        self.entries[digest] = {"file_id": file_id, "filename": filename}
+        while len(self.entries) > self.size:
+            self.entries.pop(next(iter(self.entries)))
+        await io_executor.run(write_atomic, self.path, dump_compact(self.entries), kind="media_cache")
+
+    async def _invalidate(self, digest: str):
+        if self.entries.pop(digest, None) is not None:
+            self.stats["invalidated"] += 1
+            await io_executor.run(write_atomic, self.path, dump_compact(self.entries), kind="media_cache")
+
+    async def send_document(self, bot, chat_ids, digest: str, load, filename: str, caption: str = None) -> List[dict]:
+        """load(): coroutine returning the file bytes; only awaited when an upload is needed.
+        Results per chat in chat_ids order, like Broadcaster.send."""
+        chat_ids = list(chat_ids)
+        results: Dict[int, dict] = {}
+        file_id = self.get(digest)
+        cached = file_id is not None
+        pending = chat_ids
+        if cached:
+            self.stats["hits"] += 1
+        else:
+            raw = await load()
+            # upload to one recipient at a time until one accepts it
+            for i, chat_id in enumerate(chat_ids):
+                r = (await broadcaster.send(
+                    [chat_id],
+                    lambda c: bot.send_document(chat_id=c, document=raw, filename=filename, caption=caption),
+                ))[0]
+                results[chat_id] = r
+                if r["ok"]:
+                    self.stats["uploads"] += 1
+                    file_id = r["message"].document.file_id
+                    await self._put(digest, file_id, filename)
+                    pending = chat_ids[i + 1:]
+                    break
+            else:
+                return [results[c] for c in chat_ids]
+
+        for r in await broadcaster.send(
+            pending, lambda c: bot.send_document(chat_id=c, document=file_id, caption=caption)
+        ):
+            results[r["chat_id"]] = r
+        failed = [c for c in pending if not results[c]["ok"]]
+        if cached and failed and len(failed) == len(pending):
+            # every resend failed: most likely a stale file_id, upload again
+            await self._invalidate(digest)
+            for r in await self.send_document(bot, failed, digest, load, filename, caption):
+                results[r["chat_id"]] = r
+        return [results[c] for c in chat_ids]
+
+
+media_cache = MediaCache(MEDIA_CACHE_FILE)
+
+
+# ---------------- INCREMENTAL BACKUPS ----------------
+# auto_backup sends a full snapshot now and then and, in between, a delta:
+# every record changed since that snapshot, in the WAL change-entry format.
+# Deltas are cumulative, so a restore is the full zip plus the newest delta
+# of the same base (both through "📥 وارد کردن بکاپ"). Nothing is sent while
+# the data is unchanged. The last BACKUP_KEEP bases are kept in BACKUP_DIR.
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", "60"))
+BACKUP_FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY", "60"))               # deltas before the next full
+BACKUP_FULL_MAX_AGE = int(os.getenv("BACKUP_FULL_MAX_AGE", str(24 * 3600)))  # seconds
+BACKUP_DELTA_MAX_RATIO = float(os.getenv("BACKUP_DELTA_MAX_RATIO", "0.5"))   # of the full size
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "3"))
+BACKUP_DIR = DATA_DIR / "backups"
+BACKUP_COLLECTIONS = ("users", "products", "orders", "pending_payments", "purchases", "blocked")
+
+
+class IncrementalBackup:
+    def __init__(self, colls: dict, directory: Path):
+        self.colls = colls
+        self.dir = directory
+        self.dir.mkdir(exist_ok=True)
+        self.state_file = directory / "state.json"
+        # base, seq, full_at, full_digest, full_size, last_digest
+        self.state: dict = load_json(self.state_file, {})
+        self.changed: Dict[str, set] = {}   # keys changed since the base; None = whole collection
+        self.version = 0
+        self._sent_version = -1
+        # changes made before a restart were not tracked: start with a full
+        self.need_full = True
+        # the last imported full/delta, so a delta can still follow its full
+        # after a restart
+        self.restored_file = directory / "restored.json"
+        self.restored: dict = load_json(self.restored_file, {"base": None, "seq": 0})
+        self.stats = {"full": 0, "delta": 0, "skipped": 0, "failed": 0}
+
+    def track(self, name: str, keys: tuple):
+        if name not in BACKUP_COLLECTIONS:
+            return
+        self.version += 1
+        if not keys:
+            self.changed[name] = None
+            return
+        tracked = self.changed.setdefault(name, set())
+        if tracked is not None:
+            tracked.update(keys)
+
+    def force_full(self):
+        self.need_full = True
+
+    async def mark_restored(self, base, seq: int):
+        self.restored = {"base": base, "seq": seq}
+        await io_executor.run(write_atomic, self.restored_file, dump_compact(self.restored), kind="backup_store")
+
+    def _full_due(self) -> bool:
+        st = self.state
+        return (
+            self.need_full
+            or "base" not in st
+            or st.get("seq", 0) >= BACKUP_FULL_EVERY
+            or time.time() - st.get("full_at", 0) >= BACKUP_FULL_MAX_AGE
+        )
+
+    def _delta_entries(self) -> List[dict]:
+        entries = []
+        for name, keys in self.changed.items():
+            coll = self.colls[name]
+            if keys is None:
+                entries.append({"c": name, "v": coll})
+                continue
+            for k in sorted(keys):
+                entries.append({"c": name, "k": k, "v": coll[k]} if k in coll else {"c": name, "k": k, "d": 1})
+        return entries
+
+    async def tick(self, bot, chat_id: int) -> str:
+        if not self.need_full and self.version == self._sent_version:
+            self.stats["skipped"] += 1
+            return "skipped"
+        version = self.version
+        if not self._full_due():
+            # serialized right away: later edits must not leak into this delta
+            changes = dump_compact(self._delta_entries())
+            digest = await io_executor.run(content_digest, self.state["base"], changes, kind="hash")
+            if digest == self.state.get("last_digest"):
+                self._sent_version = version
+                self.stats["skipped"] += 1
+                return "skipped"
+            if len(changes) <= BACKUP_DELTA_MAX_RATIO * self.state.get("full_size", 0):
+                if not await self._send_delta(bot, chat_id, changes, digest):
+                    # _sent_version stays behind, so the next tick tries again
+                    return "failed"
+                self._sent_version = version
+                return "delta"
+        return await self._send_full(bot, chat_id, version)
+
+    async def _send_full(self, bot, chat_id: int, version: int) -> str:
+        payloads = {COLLECTION_FILES[n].name: dump_compact(self.colls[n]) for n in BACKUP_COLLECTIONS}
+        # from here on, deltas are relative to this snapshot
+        self.changed = {}
+        names = list(payloads)
+        digest = await io_executor.run(content_digest, *payloads.values(), kind="hash")
+        if digest == self.state.get("full_digest") and not self.state.get("seq"):
+            # same data as the last full snapshot (e.g. right after a restart)
+            self.need_full = False
+            self._sent_version = version
+            self.stats["skipped"] += 1
+            return "skipped"
+        base = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        payloads["manifest.json"] = dump_compact({"kind": "full", "base": base})
+        raw = await io_executor.run(build_backup_zip, payloads, names + ["manifest.json"], kind="backup_zip")
+        filename = f"full-{base}.zip"
+        results = await self._deliver(bot, chat_id, raw, filename,
+                                      f"📦 بکاپ کامل — پایه {base}")
+        if not results[0]["ok"]:
+            # the base never reached the admin, so no delta can build on it
+            self.need_full = True
+            self.stats["failed"] += 1
+            logger.warning(f"Auto backup failed: {results[0]['error']}")
+            return "failed"
+        self.need_full = False
+        self._sent_version = version
+        self.state = {"base": base, "seq": 0, "full_at": time.time(), "full_digest": digest,
+                      "full_size": sum(len(p) for p in payloads.values())}
+        await io_executor.run(self._store, filename, raw, self.state, kind="backup_store")
+        self.stats["full"] += 1
+        return "full"
+
+    async def _send_delta(self, bot, chat_id: int, changes: str, digest: str) -> bool:
+        base = self.state["base"]
+        seq = self.state.get("seq", 0) + 1
+        delta = '{"kind":"delta","base":%s,"seq":%d,"changes":%s}' % (json.dumps(base), seq, changes)
+        raw = await io_executor.run(build_backup_zip, {"delta.json": delta}, ["delta.json"], kind="backup_zip")
+        filename = f"delta-{base}-{seq:04d}.zip"
+        results = await self._deliver(
+            bot, chat_id, raw, filename,
+            f"🧩 تغییرات {seq} از پایه {base}\nبرای بازیابی: اول بکاپ کامل همین پایه، بعد همین فایل",
+        )
+        if not results[0]["ok"]:
+            self.stats["failed"] += 1
+            logger.warning(f"Auto backup delta failed: {results[0]['error']}")
+            return False
+        self.state = {**self.state, "seq": seq, "last_digest": digest}
+        await io_executor.run(self._store, filename, raw, self.state, kind="backup_store")
+        self.stats["delta"] += 1
+        return True
+
+    async def _deliver(self, bot, chat_id: int, raw: bytes, filename: str, caption: str):
+        # not through media_cache: each file names its own base/seq, so an
+        # earlier upload of the same data is never the same backup
+        return await broadcaster.send(
+            [chat_id], lambda c: bot.send_document(chat_id=c, document=raw, filename=filename, caption=caption)
+        )
+
+    def _store(self, filename: str, raw: bytes, state: dict):
+        # runs in the I/O pool: keep the file, drop superseded deltas and old bases
+        write_atomic(self.dir / filename, raw)
+        base = state["base"]
+        for old in self.dir.glob(f"delta-{base}-*.zip"):
+            if old.name != filename:
+                old.unlink(missing_ok=True)
+        bases = sorted(p.name[len("full-"):-len(".zip")] for p in self.dir.glob("full-*.zip"))
+        for old_base in bases[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+            (self.dir / f"full-{old_base}.zip").unlink(missing_ok=True)
+            for old in self.dir.glob(f"delta-{old_base}-*.zip"):
+                old.unlink(missing_ok=True)
+        write_atomic(self.state_file, dump_compact(state))
+
+
+backups = IncrementalBackup(_loaded, BACKUP_DIR)
+on_change(backups.track)
+
+
+# ---------------- BACKUP RESTORE ----------------
+# "📥 وارد کردن بکاپ" streams the upload to a temp file, unpacks the known
+# members chunk by chunk into RESTORE_DIR with size limits, and validates
+# every collection before anything is touched. The swap into memory is one
+# synchronous step; the storage engine then installs the staged files.
+RESTORE_MAX_BYTES = int(os.getenv("RESTORE_MAX_BYTES", str(50 * 1024 * 1024)))            # the zip
+RESTORE_MAX_MEMBER_BYTES = int(os.getenv("RESTORE_MAX_MEMBER_BYTES", str(200 * 1024 * 1024)))  # one file in it
+RESTORE_MAX_RATIO = 200     # unpacked / packed size; more than this is a zip bomb
+RESTORE_CHUNK = 64 * 1024
+
+class BackupError(Exception):
+    """پیامش برای ادمین نمایش داده می‌شود"""
+
+
+async def download_to_file(tg_file, dest: Path, max_bytes: int = RESTORE_MAX_BYTES):
+    if tg_file.file_size and tg_file.file_size > max_bytes:
+        raise BackupError(f"حجم فایل بیش از {max_bytes // (1024 * 1024)} مگابایت است.")
+    src = tg_file.file_path or ""
+    if not src.startswith(("http://", "https://")):
+        # local Bot API server: the file is already on this disk
+        import shutil
+        await io_executor.run(shutil.copyfile, src, dest, kind="backup_download")
+        return
+    import httpx
+    total = 0
+    async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=60.0)) as client:
+        async with client.stream("GET", src) as resp:
+            resp.raise_for_status()
+            with dest.open("wb") as f:
+                async for chunk in resp.aiter_bytes(RESTORE_CHUNK):
+                    total += len(chunk)
+                    if total > max_bytes:
+                        raise BackupError(f"حجم فایل بیش از {max_bytes // (1024 * 1024)} مگابایت است.")
+                    f.write(chunk)
+
+
+def _copy_member(z, info, dest: Path):
+    if info.file_size > RESTORE_MAX_MEMBER_BYTES or (
+        info.compress_size and info.file_size > RESTORE_MAX_RATIO * info.compress_size
+    ):
+        raise BackupError(f"{info.filename}: حجم فایل بیش از حد مجاز است.")
+    copied = 0
+    with z.open(info) as src, dest.open("wb") as dst:
+        while True:
+            chunk = src.read(RESTORE_CHUNK)
+            if not chunk:
+                break
+            copied += len(chunk)
+            # the header sizes can lie; count what actually comes out
+            if copied > RESTORE_MAX_MEMBER_BYTES:
+                raise BackupError(f"{info.filename}: حجم فایل بیش از حد مجاز است.")
+            dst.write(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+
+def stage_backup(zip_path: Path, stage_dir: Path):
+    """Unpack the backup's known members into stage_dir; returns manifest/delta metadata or None"""
+    import shutil, zipfile
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    stage_dir.mkdir()
+    wanted = {COLLECTION_FILES[n].name for n in BACKUP_COLLECTIONS} | {"manifest.json", "delta.json"}
+    try:
+        z = zipfile.ZipFile(zip_path)
+    except zipfile.BadZipFile:
+        raise BackupError("فایل ارسالی یک فایل zip معتبر نیست.")
+    with z:
+        for info in z.infolist():
+            if info.filename in wanted:
+                _copy_member(z, info, stage_dir / info.filename)
+    meta = None
+    for name in ("delta.json", "manifest.json"):
+        path = stage_dir / name
+        if path.exists():
+            meta = _load_staged_json(path)
+            path.unlink()
+            break
+    if meta is not None and not isinstance(meta, dict):
+        raise BackupError("manifest نامعتبر است.")
+    return meta
+
+
+def _load_staged_json(path: Path):
+    try:
+        with path.open(encoding="utf-8") as f:
+            return json.load(f)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise BackupError(f"{path.name}: JSON نامعتبر ({e})")
+
+
+def validate_collection(name: str, data):
+    where = COLLECTION_FILES[name].name
+
+    def fail(msg):
+        raise BackupError(f"{where}: {msg}")
+
+    if name in LIST_COLLECTIONS:
+        if not isinstance(data, list) or not all(isinstance(x, int) for x in data):
+            fail("باید لیستی از آیدی‌های عددی باشد.")
+        return
+    if not isinstance(data, dict):
+        fail("باید یک شیء JSON باشد.")
+    for key, rec in data.items():
+        if name in ("orders", "purchases"):
+            if not isinstance(rec, list):
+                fail(f"رکورد {key} باید لیست باشد.")
+            for r in rec:
+                items = r.get("items", []) if isinstance(r, dict) else None
+                if not isinstance(items, list):
+                    fail(f"رکورد {key} ساختار نامعتبر دارد.")
+                for it in items:
+                    if not isinstance(it, dict) or not isinstance(it.get("qty", 0), int):
+                        fail(f"آیتم نامعتبر در رکورد {key}.")
+        elif not isinstance(rec, dict):
+            fail(f"رکورد {key} باید یک شیء JSON باشد.")
+        elif name == "products" and not isinstance(rec.get("title"), str):
+            fail(f"جزوه {key} عنوان ندارد.")
+
+
+def load_staged(stage_dir: Path) -> dict:
+    # missing members restore as empty collections (as before); they are staged
+    # too, so the installed snapshots always match memory
+    colls = {}
+    for name in BACKUP_COLLECTIONS:
+        path = stage_dir / COLLECTION_FILES[name].name
+        if not path.exists():
+            write_atomic(path, "[]" if name in LIST_COLLECTIONS else "{}")
+        colls[name] = _load_staged_json(path)
+        validate_collection(name, colls[name])
+    return colls
+
+
+def validate_delta(delta: dict):
+    changes = delta.get("changes")
+    if not isinstance(changes, list):
+        raise BackupError("فایل تغییرات نامعتبر است.")
+    for e in changes:
+        if not isinstance(e, dict) or e.get("c") not in BACKUP_COLLECTIONS:
+            raise BackupError("فایل تغییرات نامعتبر است.")
+        if "k" not in e:
+            validate_collection(e["c"], e.get("v"))
+        elif not e.get("d"):
+            validate_collection(e["c"], {e["k"]: e.get("v")})
+
+
 # ---------------- HELPERS ----------------
 DORMS = [
     "خوابگاه امام علی",
@@ -152,6 +2259,9 @@ def back_kb():
     return ReplyKeyboardMarkup([[KeyboardButton("🔙 بازگشت")]], resize_keyboard=True)
 
 def user_main_keyboard(has_identity: bool):
+    return render_cache.keyboard(("user_menu", has_identity), lambda: _user_main_keyboard(has_identity))
+
+def _user_main_keyboard(has_identity: bool):
     if not has_identity:
         kb = [[KeyboardButton("📝 ثبت اطلاعات هویتی")]]
         kb.append([KeyboardButton("🔙 بازگشت")])
@@ -175,6 +2285,9 @@ def user_main_keyboard(has_identity: bool):
     return ReplyKeyboardMarkup(kb, resize_keyboard=True)
 
 def admin_main_keyboard():
+    return render_cache.keyboard(("admin_menu",), _admin_main_keyboard, ("admins",))
+
+def _admin_main_keyboard():
     kb = [
         [KeyboardButton("➕ اضافه کردن جزوه"), KeyboardButton("📚 لیست جزوات")],
         [KeyboardButton("👥 اسامی ثبت نام نهایی کنندگان"), KeyboardButton("👤 اسامی خریداران")],
@@ -215,6 +2328,41 @@ def make_disp_name(u: dict) -> str:
     else:
         return f"{full} (تهرانی)"
 
+# orders, receipts and purchases only carry user_id: the name is read from
+# users, so renaming touches one record however long the history is
+NAME_FIELDS = ("first_name", "last_name", "is_dorm", "dorm_name")
+
+def record_disp_name(rec: dict) -> str:
+    key = str(rec.get("user_id"))
+    if key in users:
+        return user_disp_name(key)
+    # a user record that is gone: old data still has its copy (see normalize_user_refs)
+    return make_disp_name(rec)
+
+async def normalize_user_refs():
+    """مهاجرت یک‌باره: حذف کپی نام کاربر از سفارش‌ها، فیش‌ها و خریدها"""
+    def strip(rec) -> bool:
+        if not isinstance(rec, dict) or str(rec.get("user_id")) not in users:
+            return False
+        found = [f for f in NAME_FIELDS if f in rec]
+        for f in found:
+            del rec[f]
+        return bool(found)
+
+    touched = 0
+    for name in ("orders", "purchases"):
+        keys = [k for k, record_list in _loaded[name].items() if sum(strip(rec) for rec in record_list or [])]
+        if keys:
+            persist(name, *keys)
+            touched += len(keys)
+    pay_ids = [k for k, pay in pending_payments.items() if strip(pay)]
+    if pay_ids:
+        persist("pending_payments", *pay_ids)
+        touched += len(pay_ids)
+    if touched:
+        await committer.flush()
+        logger.info("Dropped denormalized names from %d records", touched)
+
 def next_product_id() -> str:
     if not products:
         return "1"
@@ -222,50 +2370,393 @@ def next_product_id() -> str:
     return str(max(nums) + 1 if nums else len(products) + 1)
 
 def find_product_by_title(title: str):
-    for pid, p in products.items():
-        if p.get("title") == title:
-            return pid, p
-    return None, None
+    return indexes.product_by_title(title)
 
-def update_user_name_everywhere(uid: int):
-    key = str(uid)
-    u = users.get(key)
-    if not u:
-        return
-    # update in orders
-    for uid_k, order_list in orders.items():
-        for ord_entry in order_list:
-            if ord_entry.get("user_id") == uid:
-                ord_entry["first_name"] = u.get("first_name")
-                ord_entry["last_name"] = u.get("last_name")
-    # update pending payments
-    for pay in pending_payments.values():
-        if pay.get("user_id") == uid:
-            pay["first_name"] = u.get("first_name")
-            pay["last_name"] = u.get("last_name")
-    # update purchases
-    for pur_list in purchases.values():
-        for pur in pur_list:
-            if pur.get("user_id") == uid:
-                pur["first_name"] = u.get("first_name")
-                pur["last_name"] = u.get("last_name")
-    persist_all()
+# ---------------- RENDER CACHE ----------------
+# نام نمایشی هر کاربر و کیبوردهای ثابت فقط یک بار ساخته می‌شوند.
+# ReplyKeyboardMarkup بعد از ساخت immutable است، پس یک نمونه بین همهٔ پاسخ‌ها مشترک است.
+# هر کیبورد مجموعه‌هایی را که از آن ساخته شده نام می‌برد (depends)؛
+# تغییر هر کدام از آن‌ها (از طریق persist) همان کیبوردها را دور می‌ریزد.
+DISP_NAME_CACHE_SIZE = int(os.getenv("DISP_NAME_CACHE_SIZE", "4096"))
+
+
+class RenderCache:
+    def __init__(self, size: int = DISP_NAME_CACHE_SIZE):
+        self.size = size
+        self.names = collections.OrderedDict()   # user key -> display name, LRU
+        self.keyboards: Dict[tuple, ReplyKeyboardMarkup] = {}
+        self._depends: Dict[tuple, tuple] = {}
+        self.stats = {"name_hits": 0, "name_misses": 0, "keyboard_hits": 0, "keyboard_builds": 0}
+
+    def disp_name(self, uid) -> str:
+        key = str(uid)
+        name = self.names.get(key)
+        if name is not None:
+            self.names.move_to_end(key)
+            self.stats["name_hits"] += 1
+            return name
+        self.stats["name_misses"] += 1
+        name = make_disp_name(users.get(key, {}))
+        self.names[key] = name
+        if len(self.names) > self.size:
+            self.names.popitem(last=False)
+        return name
+
+    def keyboard(self, key: tuple, build, depends: tuple = ()):
+        kb = self.keyboards.get(key)
+        if kb is None:
+            self.stats["keyboard_builds"] += 1
+            kb = self.keyboards[key] = build()
+            self._depends[key] = depends
+        else:
+            self.stats["keyboard_hits"] += 1
+        return kb
+
+    def changed(self, name: str, keys: tuple):
+        if name == "users":
+            if not keys:
+                self.names.clear()
+            for k in keys:
+                self.names.pop(k, None)
+        for key in [key for key, depends in self._depends.items() if name in depends]:
+            del self.keyboards[key], self._depends[key]
+
+
+render_cache = RenderCache()
+on_change(render_cache.changed)
+
+def user_disp_name(uid) -> str:
+    return render_cache.disp_name(uid)
+
+def products_keyboard(*extra_rows: str):
+    """یک دکمه برای هر جزوه، و بعد extra_rows (مثلا «🔙 بازگشت»)"""
+    def build():
+        kb = [[p['title']] for p in products.values()]
+        kb += [[row] for row in extra_rows]
+        return ReplyKeyboardMarkup(kb, resize_keyboard=True)
+    return render_cache.keyboard(("products",) + extra_rows, build, ("products",))
+
+def names_keyboard(kind: str, names: list, depends: tuple):
+    """«🗑 حذف لیست»، یک دکمه برای هر (uid, نام) و «🔙 بازگشت»؛ names فقط هنگام ساخت خوانده می‌شود"""
+    def build():
+        kb = [["🗑 حذف لیست"]]
+        kb += [[f"{n[1]} — id:{n[0]}"] for n in names]
+        kb.append(["🔙 بازگشت"])
+        return ReplyKeyboardMarkup(kb, resize_keyboard=True)
+    return render_cache.keyboard(("names", kind), build, depends)
+
+def picked_uid(text: str, uids) -> Optional[str]:
+    """دکمهٔ «نام — id:123» از names_keyboard؛ user key اگر در uids باشد، وگرنه None"""
+    _, sep, uid_k = text.rpartition(" — id:")
+    return uid_k if sep and uid_k in uids else None
+
+# ---------------- KEYED LOCKS ----------------
+# قفل برای هر کلید: "user:<id>" برای داده‌های یک کاربر،
+# و "products" / "blocked" / "admins" / "orders" / "purchases" برای مجموعه‌های سراسری.
+# کاربرهای مختلف موازی جلو می‌روند؛ تغییرات یک کلید پشت سر هم.
+#
+# Deadlock-free by construction: a user handler only ever holds its own
+# "user:<id>"; an admin handler holds "admin:<id>" and then takes one batch of
+# target keys, always in sorted order. Keys the task already holds are skipped,
+# so nested sections (e.g. a product delete inside an admin handler) are re-entrant.
+# "orders" / "purchases" are also taken by per-user edits, but only innermost:
+# around the synchronous edit and persist() staging (the commit is awaited after
+# letting go), never batched with a user key. Edits across many users (clear
+# all, product delete) take the collection key instead of one key per user.
+class KeyedLocks:
+    def __init__(self):
+        self._locks: Dict[str, list] = {}   # key -> [asyncio.Lock, waiters + holder]
+        self._held = contextvars.ContextVar("held_lock_keys", default=frozenset())
+        self.stats = {"acquired": 0, "contended": 0}
+        # multi-worker mode: the same keys between processes too (see WORKERS)
+        self.shared = None
+
+    def _release(self, key: str, entry: list):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys: str):
+        held = self._held.get()
+        acquired = []
+        try:
+            for key in sorted(set(keys) - held):
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                if entry[0].locked():
+                    self.stats["contended"] += 1
+                try:
+                    await entry[0].acquire()
+                except BaseException:
+                    self._release(key, entry)
+                    raise
+                if self.shared is not None:
+                    try:
+                        await self.shared.acquire(key)
+                    except BaseException:
+                        entry[0].release()
+                        self._release(key, entry)
+                        raise
+                acquired.append((key, entry))
+                self.stats["acquired"] += 1
+            if acquired and self.shared is not None:
+                # whatever the previous holder wrote in another process is in memory before we look
+                await self.shared.refresh()
+            token = self._held.set(held | {key for key, _ in acquired})
+            try:
+                yield
+            finally:
+                self._held.reset(token)
+        finally:
+            if acquired and self.shared is not None:
+                await self.shared.publish()
+            for key, entry in reversed(acquired):
+                if self.shared is not None:
+                    self.shared.release(key)
+                entry[0].release()
+                self._release(key, entry)
+
+    def snapshot(self) -> dict:
+        return {"keys": len(self._locks), **self.stats}
+
+
+locks = KeyedLocks()
+
+
+def user_lock(uid) -> str:
+    return f"user:{uid}"
+
+
+def actor_key(uid: int) -> str:
+    return f"admin:{uid}" if is_admin(uid) else user_lock(uid)
+
+
+def actor(callback):
+    """هندلر را زیر قفل فرستنده اجرا می‌کند: آپدیت‌های یک کاربر هرگز در هم نمی‌روند"""
+    @functools.wraps(callback)
+    async def run(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await callback(update, context)
+        async with locks.hold(actor_key(user.id)):
+            return await callback(update, context)
+    return run
+
+# ---------------- WORKERS ----------------
+# با WEB_WORKERS > 1 چند پروسهٔ uvicorn روی یک فایل SQLite کار می‌کنند. هر پروسه
+# همهٔ داده‌ها را در حافظه دارد؛ برای هم‌خوان ماندن:
+#   - هر batch نوشتنی یک سطر هم در جدول changes می‌گذارد و هر worker سطرهای
+#     بقیه را هر CHANGE_POLL_MS (و بلافاصله بعد از گرفتن هر قفل) روی حافظه‌اش اعمال می‌کند؛
+#   - هر کلید KeyedLocks یک فایل قفل (flock) هم دارد، پس بخش‌های بحرانی بین پروسه‌ها
+#     هم پشت سر هم اجرا می‌شوند و قبل از رها شدن قفل، نوشته‌ها commit شده‌اند؛
+#   - کارهای یک‌باره (migration، set_webhook، بکاپ، فشرده‌سازی) فقط در leader اجرا می‌شوند.
+# Lock files are per key, not hashed into a fixed set of slots: two unrelated
+# keys sharing a slot could be taken in opposite orders and deadlock.
+LOCK_DIR = DATA_DIR / "locks"
+LEADER_LOCK_FILE = DATA_DIR / "leader.lock"
+SHARED_LOCK_POLL = 0.005   # seconds between flock attempts while another worker holds the key
+LEADER_RETRY_S = 5
+
+
+class ChangeFeed:
+    """تغییرهایی که workerهای دیگر نوشته‌اند روی مجموعه‌های این پروسه اعمال می‌شوند"""
+
+    def __init__(self, seq: int):
+        self.seq = seq
+        self.listeners = []   # fn(entry) for state that lives outside _loaded (StorePersistence)
+        self._lock = asyncio.Lock()
+        self.stats = {"syncs": 0, "applied": 0, "errors": 0}
+
+    def _apply(self, entry: dict):
+        if "v" in entry:
+            adopt_items({entry["c"]: {entry["k"]: entry["v"]} if "k" in entry else entry["v"]})
+        _apply_change(_loaded, entry)
+        keys = (entry["k"],) if "k" in entry else ()
+        for fn in _change_listeners:
+            fn(entry["c"], keys)
+        for fn in self.listeners:
+            fn(entry)
+
+    async def sync(self):
+        async with self._lock:
+            self.seq, lines = await committer.call(storage.changes_since, self.seq)
+            for line in lines:
+                self._apply(json.loads(line))
+            self.stats["syncs"] += 1
+            self.stats["applied"] += len(lines)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(CHANGE_POLL_MS / 1000)
+            try:
+                await self.sync()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Change feed sync failed: {e}")
+
+
+async def trim_change_feed():
+    # leader only; every worker polls far more often than CHANGE_RETENTION_S
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await committer.call(storage.trim_changes, time.time() - CHANGE_RETENTION_S)
+        except Exception as e:
+            logger.warning(f"Change feed trim failed: {e}")
+
+
+class FileLocks:
+    """قفل هر کلید بین پروسه‌ها: یک فایل در LOCK_DIR که با flock گرفته می‌شود"""
+
+    def __init__(self, directory: Path, feed: ChangeFeed):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.dir = directory
+        self.feed = feed
+        self._fds: Dict[str, int] = {}
+        self.stats = {"acquired": 0, "waited": 0, "wait_s": 0.0}
+
+    def _path(self, key: str) -> Path:
+        return self.dir / (key.replace(":", "_").replace("/", "_") + ".lock")
+
+    async def acquire(self, key: str):
+        import fcntl   # POSIX only, and only needed with several workers
+        # the in-process lock for key is already held: one fd per key per process
+        fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT, 0o644)
+        started = None
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    started = started or time.perf_counter()
+                    await asyncio.sleep(SHARED_LOCK_POLL)
+        except BaseException:
+            os.close(fd)
+            raise
+        if started is not None:
+            self.stats["waited"] += 1
+            self.stats["wait_s"] += time.perf_counter() - started
+        self.stats["acquired"] += 1
+        self._fds[key] = fd
+
+    def release(self, key: str):
+        os.close(self._fds.pop(key))   # closing the fd drops the flock
+
+    async def refresh(self):
+        await self.feed.sync()
+
+    async def publish(self):
+        # the next holder, maybe in another process, must find our writes in the tables
+        try:
+            await committer.flush()
+        except Exception as e:
+            logger.warning(f"Commit before releasing shared locks failed: {e}")
+
+
+class LeaderLease:
+    """یک worker از بین همه کارهای یک‌باره را اجرا می‌کند؛ اگر بمیرد، flock آزاد و worker دیگری leader می‌شود"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.is_leader = False
+        self._fd = None
+
+    def try_acquire(self) -> bool:
+        import fcntl
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        self.is_leader = True
+        return True
+
+    async def run(self, lead):
+        # held until the process exits
+        while not self.try_acquire():
+            await asyncio.sleep(LEADER_RETRY_S)
+        logger.info("Worker %s is the leader", WORKER_ID)
+        await lead()
+
+
+feed = ChangeFeed(getattr(storage, "feed_seq", 0))
+leader = LeaderLease(LEADER_LOCK_FILE)
+if MULTI_WORKER:
+    locks.shared = FileLocks(LOCK_DIR, feed)
+
+# ---------------- PAYMENT STATE ----------------
+# وضعیت فیش فقط یک بار از pending عوض می‌شود (compare-and-set).
+# بین بررسی و نوشتن هیچ await نیست، پس در event loop اتمیک است:
+# دو ادمینی که هم‌زمان دکمه می‌زنند فقط یکی‌شان برنده می‌شود.
+PAYMENT_TRANSITIONS = {"pending": ("approved", "rejected")}
+CALLBACK_DEDUPE_SIZE = int(os.getenv("CALLBACK_DEDUPE_SIZE", "10000"))
+
+payment_stats = {"approved": 0, "rejected": 0, "lost_race": 0, "duplicate_callbacks": 0}
+
+
+def transition_payment(pay_id: str, expected: str, new: str, by: int) -> bool:
+    pay = pending_payments.get(pay_id)
+    if not pay or pay.get("status") != expected or new not in PAYMENT_TRANSITIONS.get(expected, ()):
+        payment_stats["lost_race"] += 1
+        return False
+    pay["status"] = new
+    pay["processed_by"] = by
+    pay["processed_at"] = datetime.datetime.utcnow().isoformat()
+    payment_stats[new] += 1
+    return True
+
+
+class SeenIds:
+    """آخرین N شناسه؛ برای کنار گذاشتن callback_queryهایی که دوباره تحویل شده‌اند"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._ids = collections.OrderedDict()
+
+    def first_time(self, item_id: str) -> bool:
+        if item_id in self._ids:
+            return False
+        self._ids[item_id] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return True
+
+    def forget(self, item_id: str):
+        self._ids.pop(item_id, None)
+
+
+seen_callbacks = SeenIds(CALLBACK_DEDUPE_SIZE)
+
+# ---------------- UPDATE GATE ----------------
+# اولین هندلر (group -1): آپدیت کاربر مسدود همین‌جا کنار گذاشته می‌شود،
+# قبل از ConversationHandler، قفل‌ها و هر درخواستی به تلگرام.
+gate_stats = {"passed": 0, "dropped_blocked": 0}
+
+async def drop_blocked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is not None and user.id in blocked:
+        gate_stats["dropped_blocked"] += 1
+        raise ApplicationHandlerStop
+    gate_stats["passed"] += 1
 
 # ---------------- HANDLERS ----------------
 
 # /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid in blocked:
-        await update.message.reply_text("🚫 شما توسط ادمین مسدود شده‌اید.")
-        return S_MAIN
     ensure_user(uid)
+    await persist("users", str(uid))
     has_identity = bool(users[str(uid)].get("first_name") and users[str(uid)].get("last_name"))
     if is_admin(uid):
         await update.message.reply_text("خوش آمدی ادمین V-1-1-6 ", reply_markup=admin_main_keyboard())
     else:
         await update.message.reply_text("سلام! به ربات سفارش جزوه خوش آمدید. جهت کسب اطلاعات، به کانال https://t.me/sbmu_med_info مراجعه کنید. ", reply_markup=user_main_keyboard(has_identity))
-    persist_all()
     return S_MAIN
 
 # main text
@@ -273,10 +2764,6 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     uid = update.effective_user.id
 
-    if uid in blocked:
-        await update.message.reply_text("🚫 شما مسدود شده‌اید.")
-        return S_MAIN
-
     ensure_user(uid)
     has_identity = bool(users[str(uid)].get("first_name") and users[str(uid)].get("last_name"))
 
@@ -287,7 +2774,7 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("چت با ادمین لغو شد.", reply_markup=user_main_keyboard(has_identity))
             return S_MAIN
         # forward text to admin with reply button
-        caption = f"پیام از {make_disp_name(users[str(uid)])} — id:{uid}\n\n{text}"
+        caption = f"پیام از {user_disp_name(uid)} — id:{uid}\n\n{text}"
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ پاسخ دادن", callback_data=f"reply_user:{uid}")]])
         await context.bot.send_message(chat_id=ADMIN_ID, text=caption, reply_markup=kb)
         await update.message.reply_text("پیام شما به ادمین ارسال شد.", reply_markup=user_main_keyboard(has_identity))
@@ -305,10 +2792,11 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if text == "✏️ ویرایش اطلاعات هویتی":
         key = str(uid)
-        old = users.get(key, {}).copy()
+        # only the identity fields: the cart does not need to ride along in user_data
+        old = {f: users.get(key, {}).get(f) for f in NAME_FIELDS}
         context.user_data['old_identity'] = old
         users[key].update({"first_name": None, "last_name": None, "is_dorm": False, "dorm_name": None})
-        persist_all()
+        await persist("users", key)
         await update.message.reply_text("اطلاعات قبلی پاک شد. لطفا نام و نام خانوادگی جدید را وارد کنید:", reply_markup=back_kb())
         return S_REGISTER_NAME
 
@@ -316,9 +2804,7 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not products:
             await update.message.reply_text("فعلا هیچ جزوه‌ای موجود نیست.", reply_markup=user_main_keyboard(has_identity))
             return S_MAIN
-        kb = [[p['title']] for p in products.values()]
-        kb.append(["🔙 بازگشت"])
-        await update.message.reply_text("لطفا جزوه مورد نظر را انتخاب کنید:", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        await update.message.reply_text("لطفا جزوه مورد نظر را انتخاب کنید:", reply_markup=products_keyboard("🔙 بازگشت"))
         return S_BUY_SELECT_PRODUCT
 
     if text == "📦 سبد خرید":
@@ -358,16 +2844,17 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         order = {
             "order_id": str(uuid.uuid4()),
             "user_id": uid,
-            "first_name": users[key].get("first_name"),
-            "last_name": users[key].get("last_name"),
             "items": cart.copy(),
             "total": total,
             "timestamp": datetime.datetime.utcnow().isoformat(),
             "paid": False,
         }
-        orders.setdefault(str(uid), []).append(order)
-        users[key]['cart'] = []
-        persist_all()
+        async with locks.hold("orders"):
+            orders.setdefault(str(uid), []).append(order)
+            users[key]['cart'] = []
+            persist("orders", key)
+            saved = persist("users", key)
+        await saved
         await update.message.reply_text(f"سبد شما ثبت نهایی شد. جمع کل: {total} تومان.\nبرای پرداخت به منوی «💳 خرید جزوات نهایی شده» بروید.", reply_markup=user_main_keyboard(has_identity))
         return S_MAIN
 
@@ -389,9 +2876,11 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text == "🗑 پاک کردن لیست":
         key = str(uid)
         if context.user_data.get('viewing_finalized'):
-            orders.pop(key, None)
+            async with locks.hold("orders"):
+                orders.pop(key, None)
+                saved = persist("orders", key)
             context.user_data.pop('viewing_finalized', None)
-            persist_all()
+            await saved
             await update.message.reply_text("لیست جزوات نهایی شده شما پاک شد.", reply_markup=user_main_keyboard(has_identity))
             return S_MAIN
         else:
@@ -406,7 +2895,7 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return S_MAIN
         kb = [[f"سفارش: {i+1} - {o.get('total')} تومان"] for i,o in enumerate(finalized)]
         kb.append(["🔙 بازگشت"])
-        context.user_data['finalized_list'] = finalized
+        context.user_data['finalized_list'] = [o.get('order_id') for o in finalized]
         await update.message.reply_text("کدام سفارش را می‌خواهید پرداخت کنید؟", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
         return S_MAIN
 
@@ -420,7 +2909,10 @@ async def handle_text_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             idx = 0
         if idx < 0 or idx >= len(flist):
             idx = 0
-        sel = flist[idx]
+        _, sel = indexes.order(flist[idx], uid_key) if flist else (None, None)
+        if sel is None:
+            await update.message.reply_text("سفارشی برای پرداخت وجود ندارد.", reply_markup=user_main_keyboard(has_identity))
+            return S_MAIN
         context.user_data['pay_order_id'] = sel.get('order_id')
         await update.message.reply_text(f"شما سفارش با جمع {sel.get('total')} تومان را انتخاب کردید.\nلطفا فیش پرداخت را به صورت عکس ارسال کنید یا '🔙 بازگشت' را بزنید.", reply_markup=back_kb())
         return S_AWAITING_RECEIPT
@@ -497,7 +2989,7 @@ async def register_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ensure_user(uid)
     users[key]['first_name'] = first
     users[key]['last_name'] = last
-    persist_all()
+    await persist("users", key)
     await update.message.reply_text("شما خوابگاهی هستید یا تهرانی؟(مهم نیست، الکی یچی بزنید!)", reply_markup=ReplyKeyboardMarkup([["تهرانی", "خوابگاهی"], ["🔙 بازگشت"]], resize_keyboard=True))
     return S_REGISTER_DORM
 
@@ -511,19 +3003,18 @@ async def register_dorm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text == "تهرانی":
         users[key]['is_dorm'] = False
         users[key]['dorm_name'] = None
+        await persist("users", key)
         await update.message.reply_text("اطلاعات هویتی تکمیل شد ✅️", reply_markup=user_main_keyboard(True))
-        msg = f"کاربری ثبت نام کرد: {make_disp_name(users[key])} — آیدی: {uid}"
+        msg = f"کاربری ثبت نام کرد: {user_disp_name(key)} — آیدی: {uid}"
         await context.bot.send_message(chat_id=ADMIN_ID, text=msg)
-        persist_all()
         if 'old_identity' in context.user_data:
             old = context.user_data.pop('old_identity')
             await notify_admin_edit(uid, old, users[key], context)
-            update_user_name_everywhere(uid)
         return S_MAIN
     elif text == "خوابگاهی":
         users[key]['is_dorm'] = True
+        await persist("users", key)
         await update.message.reply_text("لطفا خوابگاه خود را انتخاب کنید:", reply_markup=ReplyKeyboardMarkup([[d] for d in DORMS] + [["🔙 بازگشت"]], resize_keyboard=True))
-        persist_all()
         return S_REGISTER_OTHER_DORM
     else:
         await update.message.reply_text("لطفا یکی از گزینه‌ها را انتخاب کنید: تهرانی یا خوابگاهی", reply_markup=back_kb())
@@ -540,14 +3031,13 @@ async def register_other_dorm_name(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("لطفا نام خوابگاه خود را تایپ کنید:", reply_markup=back_kb())
         return S_REGISTER_OTHER_DORM
     users[key]['dorm_name'] = text
+    await persist("users", key)
     await update.message.reply_text("اطلاعات هویتی تکمیل شد ✅️", reply_markup=user_main_keyboard(True))
-    msg = f"کاربری ثبت نام کرد: {make_disp_name(users[key])} — آیدی: {uid}"
+    msg = f"کاربری ثبت نام کرد: {user_disp_name(key)} — آیدی: {uid}"
     await context.bot.send_message(chat_id=ADMIN_ID, text=msg)
-    persist_all()
     if 'old_identity' in context.user_data:
         old = context.user_data.pop('old_identity')
         await notify_admin_edit(uid, old, users[key], context)
-        update_user_name_everywhere(uid)
     return S_MAIN
 
 async def notify_admin_edit(uid: int, old: dict, new: dict, context: ContextTypes.DEFAULT_TYPE):
@@ -576,7 +3066,7 @@ async def buy_select_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
             idx = int(parts[1].replace('.', '')) - 1
             if 0 <= idx < len(users[key]['cart']):
                 removed = users[key]['cart'].pop(idx)
-                persist_all()
+                await persist("users", key)
                 await update.message.reply_text(f"آیتم {removed['title']} حذف شد.", reply_markup=user_main_keyboard(True))
                 return S_MAIN
         except Exception:
@@ -660,16 +3150,16 @@ async def buy_enter_qty(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("ابتدا جزوه را انتخاب کنید.")
         return S_MAIN
     p = products.get(pid, {})
-    it = {
-        'product_id': pid,
-        'title': p.get('title'),
-        'type': context.user_data.get('buy_type', 'نامشخص'),
-        'qty': qty,
-        'unit_price': int(context.user_data.get('unit_price', 0)),
-    }
+    it = Item(
+        product_id=pid,
+        title=p.get('title'),
+        type=print_type(context.user_data.get('buy_type', 'نامشخص')),
+        qty=qty,
+        unit_price=int(context.user_data.get('unit_price', 0)),
+    )
     ensure_user(uid)
     users[str(uid)]['cart'].append(it)
-    persist_all()
+    await persist("users", str(uid))
     await update.message.reply_text("ثبت شد ✅", reply_markup=user_main_keyboard(True))
     return S_MAIN
 
@@ -687,8 +3177,7 @@ async def handle_photo_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
     file_id = update.message.photo[-1].file_id
     pay_id = str(uuid.uuid4())
 
-    user_orders = orders.get(str(uid), [])
-    sel_order = next((o for o in user_orders if o.get("order_id") == order_id), None)
+    _, sel_order = indexes.order(order_id, str(uid))
 
     if not sel_order:
         await update.message.reply_text(
@@ -701,22 +3190,19 @@ async def handle_photo_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
     pending_payments[pay_id] = {
         "payment_id": pay_id,
         "user_id": uid,
-        "first_name": users[str(uid)].get("first_name"),
-        "last_name": users[str(uid)].get("last_name"),
-        "is_dorm": users[str(uid)].get("is_dorm"),
-        "dorm_name": users[str(uid)].get("dorm_name"),
         "order_id": order_id,
-        "items": sel_order.get("items", []),
+        # copies: the order's items move on to purchases and get edited there
+        "items": [it.copy() for it in sel_order.get("items", [])],
         "total": sel_order.get("total", 0),
         "file_id": file_id,
         "timestamp": datetime.datetime.utcnow().isoformat(),
         "status": "pending",
     }
 
-    persist_all()
+    await persist("pending_payments", pay_id)
 
     caption = (
-        f"📌 فیش پرداختی از {make_disp_name(users[str(uid)])}\n"
+        f"📌 فیش پرداختی از {user_disp_name(uid)}\n"
         f"آیدی: {uid}\n"
         f"جمع: {sel_order.get('total', 0)} تومان\n"
         f"payment_id: {pay_id}"
@@ -733,38 +3219,36 @@ async def handle_photo_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
     # گرفتن آیدی گروه از ENV
     PHOTO_GROUP_ID = os.getenv("PHOTO_GROUP_ID")
 
-    sent = False
-
-    if PHOTO_GROUP_ID:
-        try:
-            await context.bot.send_photo(
-                chat_id=int(PHOTO_GROUP_ID),
-                photo=file_id,
-                caption=caption,
-                reply_markup=kb
-            )
-            sent = True
-        except Exception as e:
-            print(f"⚠️ ارسال به گروه ناموفق بود: {e}")
+    async def notify_admins():
+        sent = False
 
-    # fallback اگر گروه ست نبود یا ارسال شکست خورد
-    if not sent:
-        all_admins = [ADMIN_ID] + admins
-        for admin_id in all_admins:
+        if PHOTO_GROUP_ID:
             try:
                 await context.bot.send_photo(
-                    chat_id=admin_id,
+                    chat_id=int(PHOTO_GROUP_ID),
                     photo=file_id,
                     caption=caption,
                     reply_markup=kb
                 )
+                sent = True
             except Exception as e:
-                print(f"⚠️ ارسال فیش به ادمین {admin_id} ناموفق بود: {e}")
+                print(f"⚠️ ارسال به گروه ناموفق بود: {e}")
+
+        # fallback اگر گروه ست نبود یا ارسال شکست خورد
+        if not sent:
+            results = await broadcaster.send(
+                admin_ids(),
+                lambda chat_id: context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=kb),
+            )
+            log_failed_sends(results, "فیش")
 
     await update.message.reply_text(
         "✅ فیش شما ارسال شد و در انتظار تایید می‌باشد.",
         reply_markup=user_main_keyboard(True)
     )
+    # the fan-out is paced per admin chat: the user doesn't wait for it, and
+    # the payment is already saved, so "🕓" can resend it if this fails
+    context.application.create_task(notify_admins())
 
     context.user_data.pop('pay_order_id', None)
     return S_MAIN
@@ -807,17 +3291,9 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_qty = {}
 
         if source == 'purchased':
-            for uid_k, pur_list in purchases.items():
-                for pur in pur_list:
-                    for it in pur.get('items', []):
-                        if it.get('product_id') == pid and it.get('type') == typ:
-                            user_qty[str(uid_k)] = user_qty.get(str(uid_k), 0) + it.get('qty', 0)
+            user_qty = aggregates["purchases"].user_totals(pid, typ)
         elif source == 'finalized':
-            for uid_k, order_list in orders.items():
-                for ord_entry in order_list:
-                    for it in ord_entry.get('items', []):
-                        if it.get('product_id') == pid and it.get('type') == typ:
-                            user_qty[str(uid_k)] = user_qty.get(str(uid_k), 0) + it.get('qty', 0)
+            user_qty = aggregates["orders"].user_totals(pid, typ)
 
         context.user_data.pop('inspect_product', None)
         if not user_qty:
@@ -825,7 +3301,7 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return S_MAIN
         lines = []
         for uid_k, qty in user_qty.items():
-            name = make_disp_name(users.get(str(uid_k), {}))
+            name = user_disp_name(uid_k)
             lines.append(f"{name} — {qty} عدد")
         await update.message.reply_text("\n".join(lines), reply_markup=admin_main_keyboard())
         return S_MAIN
@@ -851,26 +3327,21 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🟡 پایین: {p.get('color_low_price','-')} — "
                 f"⬛ سیاه: {p.get('bw_price','-')}\n"
             )
-        kb = [[p['title']] for p in products.values()]
-        kb.append(["🗑 حذف جزوه"])
-        kb.append(["🔙 بازگشت"])
-        await update.message.reply_text("\n".join(lines), reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        await update.message.reply_text("\n".join(lines), reply_markup=products_keyboard("🗑 حذف جزوه", "🔙 بازگشت"))
         return S_ADMIN_LIST
 
     if text == "👥 اسامی ثبت نام نهایی کنندگان":
         names = []
-        for uid_k, u in users.items():
+        for uid_k in users:
             if orders.get(uid_k):
-                names.append((uid_k, make_disp_name(u)))
+                names.append((uid_k, user_disp_name(uid_k)))
         if not names:
             await update.message.reply_text("فعلا کسی ثبت نهایی نکرده است.", reply_markup=admin_main_keyboard())
             return S_MAIN
         # provide top "delete list" button + per-user buttons
-        kb = [["🗑 حذف لیست"]]
-        kb += [[f"{n[1]} — id:{n[0]}"] for n in names]
-        kb.append(["🔙 بازگشت"])
-        await update.message.reply_text("اسامی ثبت نهایی‌کنندگان:", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
-        context.user_data['reg_names_map'] = {f"{n[1]} — id:{n[0]}": n[0] for n in names}
+        kb = names_keyboard("finalized", names, ("users", "orders"))
+        await update.message.reply_text("اسامی ثبت نهایی‌کنندگان:", reply_markup=kb)
+        context.user_data['reg_names_map'] = [n[0] for n in names]
         context.user_data.pop('buyers_map', None)
         return S_MAIN
 
@@ -879,8 +3350,7 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         names = []
         for uid_k, p_list in purchases.items():
             if p_list:
-                u = users.get(uid_k, {})
-                names.append((uid_k, make_disp_name(u)))
+                names.append((uid_k, user_disp_name(uid_k)))
     
         if not names:
             await update.message.reply_text(
@@ -889,47 +3359,29 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return S_MAIN
     
-        kb = [["🗑 حذف لیست"]]
-    
         # نمایش خریداران به صورت دکمه
-        kb += [[f"{n[1]} — id:{n[0]}"] for n in names]
-    
-        kb.append(["🔙 بازگشت"])
+        kb = names_keyboard("buyers", names, ("users", "purchases"))
     
         await update.message.reply_text(
             "اسامی خریداران تاییدشده:\n\n"
             "👆 روی هر خریدار بزنید تا جزوات خریداری شده او نمایش داده شود.",
-            reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+            reply_markup=kb
         )
     
         # ذخیره mapping برای انتخاب بعدی
-        context.user_data['buyers_map'] = {
-            f"{n[1]} — id:{n[0]}": n[0] for n in names
-        }
+        context.user_data['buyers_map'] = [n[0] for n in names]
     
         return S_MAIN
 
     if text == "📚 جزوات خریداری شده":
         # aggregate purchases with color/bw counts
-        agg = {}
-        for uid_k, p_list in purchases.items():
-            for pur in p_list:
-                for it in pur.get("items", []):
-                    title = it['title']
-                    typ = it['type']
-                    if title not in agg:
-                        agg[title] = {
-                            "رنگی کیفیت بالا": 0,
-                            "رنگی کیفیت پایین": 0,
-                            "سیاه و سفید": 0
-                        }
-                    agg[title][typ] = agg[title].get(typ, 0) + it.get('qty', 0)
+        agg = aggregates["purchases"].type_totals()
         if not agg:
             await update.message.reply_text("فعلا جزوه خریداری شده‌ای وجود ندارد.", reply_markup=admin_main_keyboard())
             return S_MAIN
         kb = [[title] for title in agg.keys()]
         kb.append(["🔙 بازگشت"])
-        context.user_data['purchased_agg'] = agg
+        context.user_data['purchased_agg'] = list(agg)
         context.user_data.pop('finalized_agg', None)
         lines = [
             f"{t} : "
@@ -942,25 +3394,13 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return S_MAIN
 
     if text == "📄 جزوات ثبت نهایی شده":
-        agg = {}
-        for uid_k, order_list in orders.items():
-            for ord_entry in order_list:
-                for it in ord_entry.get("items", []):
-                    title = it['title']
-                    typ = it['type']
-                    if title not in agg:
-                        agg[title] = {
-                            "رنگی کیفیت بالا": 0,
-                            "رنگی کیفیت پایین": 0,
-                            "سیاه و سفید": 0
-                        }
-                    agg[title][typ] = agg[title].get(typ, 0) + it.get('qty', 0)
+        agg = aggregates["orders"].type_totals()
         if not agg:
             await update.message.reply_text("فعلا جزوه‌ای در حالت ثبت نهایی وجود ندارد.", reply_markup=admin_main_keyboard())
             return S_MAIN
         kb = [[title] for title in agg.keys()]
         kb.append(["🔙 بازگشت"])
-        context.user_data['finalized_agg'] = agg
+        context.user_data['finalized_agg'] = list(agg)
         context.user_data.pop('purchased_agg', None)
         lines = [
             f"{t} : "
@@ -973,68 +3413,56 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return S_MAIN
 
     if text == "🕓 فیش‌های در انتظار تایید":
-        if text == "🕓 فیش‌های در انتظار تایید":
-            if not pending_payments:
-                await update.message.reply_text("فعلا فیشی در انتظار تایید نیست.", reply_markup=admin_main_keyboard())
-                return S_MAIN
-        
-            all_admins = [ADMIN_ID] + admins
+        if not pending_payments:
+            await update.message.reply_text("فعلا فیشی در انتظار تایید نیست.", reply_markup=admin_main_keyboard())
+            return S_MAIN
 
-        for pay_id, pay in pending_payments.items():
-            if pay.get("status") != "pending":
-                continue
-            caption = f"📌 فیش از {make_disp_name({'first_name': pay.get('first_name'), 'last_name': pay.get('last_name'), 'is_dorm': pay.get('is_dorm'), 'dorm_name': pay.get('dorm_name')})}\nآیدی: {pay.get('user_id')}\nجمع: {pay.get('total')} تومان\npayment_id: {pay_id}"
+        def receipt_sender(pay_id, pay):
+            caption = f"📌 فیش از {record_disp_name(pay)}\nآیدی: {pay.get('user_id')}\nجمع: {pay.get('total')} تومان\npayment_id: {pay_id}"
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("✅ تایید", callback_data=f"pay_approve:{pay_id}"),
                  InlineKeyboardButton("❌ عدم تایید", callback_data=f"pay_reject:{pay_id}")],
                 [InlineKeyboardButton("↩️ پاسخ دادن", callback_data=f"reply_user:{pay.get('user_id')}")]
             ])
-            # ارسال فیش برای همه ادمین‌ها
-            for admin_id in all_admins:
-                try:
-                    await context.bot.send_photo(chat_id=admin_id, photo=pay.get('file_id'), caption=caption, reply_markup=kb)
-                except Exception as e:
-                    print(f"⚠️ ارسال فیش به ادمین {admin_id} ناموفق بود: {e}")
+            return lambda chat_id: context.bot.send_photo(chat_id=chat_id, photo=pay.get('file_id'), caption=caption, reply_markup=kb)
+
+        # ارسال فیش برای همه ادمین‌ها: هر ادمین فیش‌ها را به ترتیب می‌گیرد، ادمین‌ها هم‌زمان
+        jobs = [
+            (admin_id, receipt_sender(pay_id, pay))
+            for pay_id, pay in pending_payments.items()
+            if pay.get("status") == "pending"
+            for admin_id in admin_ids()
+        ]
+        async def resend():
+            log_failed_sends(await broadcaster.run(jobs), "فیش")
 
-        await update.message.reply_text("📨 تمام فیش‌های در انتظار برای همه ادمین‌ها ارسال شدند.", reply_markup=admin_main_keyboard())
+        # pending × admins paced sends: in the background, not in the admin's handler
+        context.application.create_task(resend())
+        await update.message.reply_text("📨 فیش‌های در انتظار برای همه ادمین‌ها ارسال می‌شوند.", reply_markup=admin_main_keyboard())
         return S_MAIN
 
 
     if text == "📊 دریافت فایل اکسل خرید جزوات":
-        all_products = list(products.values())
-        rows = []
-        for uid_k, u in users.items():
-            disp_name = make_disp_name(u)
-            row = {"نام": disp_name}
-            for p in all_products:
-                found_items = []
-                for pur in purchases.get(str(uid_k), []):
-                    for it in pur.get('items', []):
-                        if it.get('title') == p['title']:
-                            found_items.append(f"{it['type']} × {it['qty']}")
-                row[p['title']] = " / ".join(found_items) if found_items else 0
-            rows.append(row)
-
-        # مرتب‌سازی: اول خوابگاهی‌ها، بعد تهرانی‌ها
-        def sort_key(r):
-            if "تهران" in r['نام'] or "تهرانی" in r['نام']:
-                return (1, r['نام'])
-            return (0, r['نام'])
-
-        rows_sorted = sorted(rows, key=sort_key)
-
-        import pandas as pd
-        df = pd.DataFrame(rows_sorted)
-        path = DATA_DIR / "purchases.xlsx"
-        df.to_excel(path, index=False)
-
-    # ✅ ارسال فایل برای همه ادمین‌ها
-        all_admins = [ADMIN_ID] + admins
-        for admin_id in all_admins:
-            try:
-                await context.bot.send_document(chat_id=admin_id, document=path.open('rb'))
-            except Exception as e:
-                print(f"⚠️ ارسال فایل اکسل به ادمین {admin_id} ناموفق بود: {e}")
+        user_keys = list(users)
+        names = [user_disp_name(k) for k in user_keys]
+        titles = list(dict.fromkeys(p['title'] for p in products.values()))
+        items = purchase_items_long(purchases)
+
+        fmt = EXPORT_FORMAT if EXPORT_FORMAT in EXPORT_FORMATS else "xlsx"
+        digest = await io_executor.run(content_digest, "purchases", fmt, user_keys, names, titles, items, kind="hash")
+
+        async def build_export():
+            path = await io_executor.run(
+                export_purchases, user_keys, names, titles, items, DATA_DIR / f"purchases.{fmt}", fmt,
+                kind="excel", cpu=True,
+            )
+            return await io_executor.run(path.read_bytes, kind="excel")
+
+        # ✅ ارسال فایل برای همه ادمین‌ها؛ اگر داده تغییری نکرده باشد، فایل قبلی دوباره فرستاده می‌شود
+        results = await media_cache.send_document(
+            context.bot, admin_ids(), digest, build_export, f"purchases.{fmt}",
+        )
+        log_failed_sends(results, "فایل اکسل")
 
         await update.message.reply_text("📊 فایل اکسل خرید جزوات برای تمام ادمین‌ها ارسال شد.", reply_markup=admin_main_keyboard())
         return S_MAIN
@@ -1085,8 +3513,8 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return S_MAIN
 
     # clicked on a name under reg_names_map -> show finalized orders and allow delete all
-    if 'reg_names_map' in context.user_data and text in context.user_data['reg_names_map']:
-        the_uid = context.user_data['reg_names_map'][text]
+    the_uid = picked_uid(text, context.user_data.get('reg_names_map', ()))
+    if the_uid is not None:
         ords = orders.get(str(the_uid), [])
         if not ords:
             await update.message.reply_text("این کاربر ثبت نهایی‌ای ندارد.", reply_markup=admin_main_keyboard())
@@ -1099,15 +3527,15 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             total_sum += ord_entry.get('total',0)
         kb = [[KeyboardButton("🗑 حذف همه جزوات کاربر")], [KeyboardButton("💬 چت با کاربر")], [KeyboardButton("🔙 بازگشت")]]
         context.user_data['selected_reg_user'] = the_uid
-        await update.message.reply_text(f"جزوات نهایی {make_disp_name(users[str(the_uid)])}:\n\n" + "\n\n".join(lines) + f"\n\nجمع کل: {total_sum}", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        await update.message.reply_text(f"جزوات نهایی {user_disp_name(the_uid)}:\n\n" + "\n\n".join(lines) + f"\n\nجمع کل: {total_sum}", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
         return S_MAIN
 
     # clicked on buyer
     # clicked on buyer
     # clicked on buyer
-    if 'buyers_map' in context.user_data and text in context.user_data['buyers_map']:
+    the_uid = picked_uid(text, context.user_data.get('buyers_map', ()))
+    if the_uid is not None:
     
-        the_uid = context.user_data['buyers_map'][text]
         context.user_data['selected_buyer'] = the_uid
     
         await show_buyer_purchase_panel(update, context, the_uid)
@@ -1127,36 +3555,41 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if idx >= len(items_map):
             return S_MAIN
     
-        item = items_map[idx]
-    
         buyer_uid = context.user_data.get("selected_buyer")
+        item = buyer_item(buyer_uid, items_map[idx])
+        if item is None:
+            return S_MAIN
     
         # حذف فقط همان آیتم
-        for uid_k in list(purchases.keys()):
+        async with locks.hold("purchases"):
+            touched = []
+            for uid_k in list(purchases.keys()):
     
-            for pur in purchases[uid_k]:
+                for pur in purchases[uid_k]:
     
-                for i in range(len(pur["items"]) - 1, -1, -1):
+                    for i in range(len(pur["items"]) - 1, -1, -1):
     
-                    it = pur["items"][i]
+                        it = pur["items"][i]
     
-                    if (
-                        it.get("title") == item["title"] and
-                        it.get("type") == item["type"] and
-                        it.get("unit_price") == item["unit_price"]
-                    ):
-                        pur["items"].pop(i)
-                        break
+                        if (
+                            it.get("title") == item["title"] and
+                            it.get("type") == item["type"] and
+                            it.get("unit_price") == item["unit_price"]
+                        ):
+                            pur["items"].pop(i)
+                            touched.append(uid_k)
+                            break
     
-            purchases[uid_k] = [
-                p for p in purchases[uid_k]
-                if p.get("items")
-            ]
+                purchases[uid_k] = [
+                    p for p in purchases[uid_k]
+                    if p.get("items")
+                ]
     
-            if not purchases[uid_k]:
-                purchases.pop(uid_k, None)
+                if not purchases[uid_k]:
+                    purchases.pop(uid_k, None)
     
-        persist_all()
+            if touched:
+                await persist("purchases", *set(touched))
     
         # ⭐ صفحه همان خریدار دوباره نمایش داده شود
         if buyer_uid:
@@ -1177,40 +3610,45 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if idx >= len(items_map):
             return S_MAIN
     
-        item = items_map[idx]
-    
         buyer_uid = context.user_data.get("selected_buyer")
+        item = buyer_item(buyer_uid, items_map[idx])
+        if item is None:
+            return S_MAIN
     
         # ⭐ فقط 1 عدد کم کن
-        for uid_k in list(purchases.keys()):
+        async with locks.hold("purchases"):
+            touched = []
+            for uid_k in list(purchases.keys()):
     
-            for pur in purchases[uid_k]:
+                for pur in purchases[uid_k]:
     
-                for it in pur.get("items", []):
+                    for it in pur.get("items", []):
     
-                    if (
-                        it["title"] == item["title"] and
-                        it["type"] == item["type"]
-                    ):
+                        if (
+                            it["title"] == item["title"] and
+                            it["type"] == item["type"]
+                        ):
     
-                        it["qty"] -= 1
+                            it["qty"] -= 1
+                            touched.append(uid_k)
     
-                        # اگر صفر شد → حذف کامل
-                        if it["qty"] <= 0:
-                            pur["items"].remove(it)
+                            # اگر صفر شد → حذف کامل
+                            if it["qty"] <= 0:
+                                pur["items"].remove(it)
     
-                        break
+                            break
     
-            # پاکسازی سفارش‌های خالی
-            purchases[uid_k] = [
-                p for p in purchases[uid_k]
-                if p.get("items")
-            ]
+                # پاکسازی سفارش‌های خالی
+                purchases[uid_k] = [
+                    p for p in purchases[uid_k]
+                    if p.get("items")
+                ]
     
-            if not purchases[uid_k]:
-                purchases.pop(uid_k, None)
+                if not purchases[uid_k]:
+                    purchases.pop(uid_k, None)
     
-        persist_all()
+            if touched:
+                await persist("purchases", *set(touched))
     
         # ⭐ دوباره همان صفحه را نشان بده
         if buyer_uid:
@@ -1225,7 +3663,7 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("هیچ کاربری انتخاب نشده است.", reply_markup=admin_main_keyboard())
             return S_MAIN
         context.user_data['reply_to'] = int(the_uid)
-        await update.message.reply_text(f"حالا پیام خود را تایپ کنید تا برای {make_disp_name(users.get(str(the_uid), {}))} ارسال شود.")
+        await update.message.reply_text(f"حالا پیام خود را تایپ کنید تا برای {user_disp_name(the_uid)} ارسال شود.")
         return S_MAIN
 
     # delete all finalized for selected reg user
@@ -1276,22 +3714,28 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("هیچ کاربری برای حذف انتخاب نشده.", reply_markup=admin_main_keyboard())
             return S_MAIN
         # remove purchases and entry
-        purchases.pop(str(the_uid), None)
-        persist_all()
+        async with locks.hold(user_lock(the_uid)):
+            async with locks.hold("purchases"):
+                purchases.pop(str(the_uid), None)
+                saved = persist("purchases", str(the_uid))
+            await saved
         await update.message.reply_text("کاربر و خریدهایش حذف شد.", reply_markup=admin_main_keyboard())
         return S_MAIN
 
     # --- Backup system ---
     if text == "📤 دریافت بکاپ":
         # ایجاد فایل ZIP از دیتای موجود
-        import zipfile, io
-        buf = io.BytesIO()
-        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
-            for f in [USERS_FILE, PRODUCTS_FILE, ORDERS_FILE, PENDING_PAYMENTS_FILE, PURCHASES_FILE, BLOCKED_FILE]:
-                if f.exists():
-                    z.write(f, arcname=f.name)
-        buf.seek(0)
-        await context.bot.send_document(chat_id=ADMIN_ID, document=buf, filename="backup.zip")
+        # snapshot from memory: the files on disk may still be behind the WAL; only the
+        # collections a backup carries (sessions and admins are not part of it)
+        payloads = snapshot_payloads({n: _loaded[n] for n in BACKUP_COLLECTIONS})
+        names = list(payloads)
+        digest = await io_executor.run(content_digest, "backup.zip", *(payloads[n] for n in names), kind="hash")
+        results = await media_cache.send_document(
+            context.bot, [ADMIN_ID], digest,
+            lambda: io_executor.run(build_backup_zip, payloads, names, kind="backup_zip"),
+            "backup.zip",
+        )
+        log_failed_sends(results, "بکاپ")
         await update.message.reply_text("📤 فایل بکاپ ارسال شد.", reply_markup=admin_main_keyboard())
         return S_MAIN
 
@@ -1326,6 +3770,14 @@ async def handle_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("دستور نامعتبر.", reply_markup=admin_main_keyboard())
     return S_MAIN
 
+def buyer_item(buyer_uid, item_id: str):
+    # buyer_items_map only keeps item ids; the item may be gone since the panel was shown
+    for pur in purchases.get(str(buyer_uid), []):
+        for it in pur.get("items", []):
+            if it.get("item_id") == item_id:
+                return it
+    return None
+
 async def show_buyer_purchase_panel(update, context, buyer_uid):
 
     pur_list = purchases.get(str(buyer_uid), [])
@@ -1340,30 +3792,38 @@ async def show_buyer_purchase_panel(update, context, buyer_uid):
     lines = []
     kb = []
     items_map = []
+    ids_assigned = False
 
     total_sum = 0
 
-    for pur in pur_list:
-        for it in pur.get("items", []):
+    # ids are assigned in place: the same edit as any other per-user purchase change
+    async with locks.hold("purchases"):
+        for pur in purchases.get(str(buyer_uid), []):
+            for it in pur.get("items", []):
 
-            # اگر id ندارد بساز
-            if "item_id" not in it:
-                it["item_id"] = str(uuid.uuid4())
+                # اگر id ندارد بساز
+                if "item_id" not in it:
+                    it["item_id"] = str(uuid.uuid4())
+                    ids_assigned = True
 
-            items_map.append(it)
+                items_map.append(it["item_id"])
 
-            idx = len(items_map) - 1
+                idx = len(items_map) - 1
 
-            lines.append(
-                f"{idx}. {it['title']} {it['type']} x {it['qty']}"
-            )
+                lines.append(
+                    f"{idx}. {it['title']} {it['type']} x {it['qty']}"
+                )
 
-            # ⭐ دکمه کاهش 1 عدد
-            kb.append([
-                KeyboardButton(f"➖ کم کردن آیتم {idx}")
-            ])
+                # ⭐ دکمه کاهش 1 عدد
+                kb.append([
+                    KeyboardButton(f"➖ کم کردن آیتم {idx}")
+                ])
+
+                total_sum += it["qty"] * it["unit_price"]
 
-            total_sum += it["qty"] * it["unit_price"]
+        saved = persist("purchases", str(buyer_uid)) if ids_assigned else None
+    if saved is not None:
+        await saved
 
     context.user_data["buyer_items_map"] = items_map
     context.user_data["selected_buyer"] = buyer_uid
@@ -1373,7 +3833,7 @@ async def show_buyer_purchase_panel(update, context, buyer_uid):
     kb.append([KeyboardButton("🔙 بازگشت")])
 
     await update.message.reply_text(
-        f"خریدهای {make_disp_name(users.get(str(buyer_uid), {}))}:\n\n"
+        f"خریدهای {user_disp_name(buyer_uid)}:\n\n"
         + "\n".join(lines)
         + f"\n\nجمع کل: {total_sum}",
         reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
@@ -1385,13 +3845,15 @@ async def admin_add_product_name(update: Update, context: ContextTypes.DEFAULT_T
     if text == "🔙 بازگشت":
         await update.message.reply_text("بازگشت", reply_markup=admin_main_keyboard())
         return S_MAIN
-    pid = next_product_id()
-    products[pid] = {
-        "title": text,
-        "color_high_price": 0,
-        "color_low_price": 0,
-        "bw_price": 0
-    }
+    async with locks.hold("products"):
+        pid = next_product_id()
+        products[pid] = {
+            "title": text,
+            "color_high_price": 0,
+            "color_low_price": 0,
+            "bw_price": 0
+        }
+        await persist("products", pid)
     context.user_data['new_product_id'] = pid
     kb = ReplyKeyboardMarkup(
         [
@@ -1404,7 +3866,6 @@ async def admin_add_product_name(update: Update, context: ContextTypes.DEFAULT_T
         resize_keyboard=True
     )
     await update.message.reply_text("برای اضافه کردن قیمت، یکی از گزینه‌ها را انتخاب کنید یا ثبت جزوه را بزنید:", reply_markup=kb)
-    persist_all()
     return S_ADMIN_ADD_CHOOSE
 
 async def admin_add_product_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1432,7 +3893,7 @@ async def admin_add_product_choice(update: Update, context: ContextTypes.DEFAULT
         if not prod:
             await update.message.reply_text("خطا: جزوه یافت نشد.")
             return S_MAIN
-        persist_all()
+        await persist("products", pid)
         await update.message.reply_text(f"جزوه '{prod['title']}' ثبت شد.", reply_markup=admin_main_keyboard())
         return S_MAIN
     if text == "🔙 بازگشت":
@@ -1457,8 +3918,13 @@ async def admin_add_color_price(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("لطفا عدد صحیح وارد کنید.")
         return S_ADMIN_ADD_COLOR_PRICE
 
-    products[pid][field] = val
-    persist_all()
+    async with locks.hold("products"):
+        # another admin may have deleted it meanwhile
+        if pid not in products:
+            await update.message.reply_text("خطا: جزوه یافت نشد.", reply_markup=admin_main_keyboard())
+            return S_MAIN
+        products[pid][field] = val
+        await persist("products", pid)
 
     await update.message.reply_text(
         "قیمت ثبت شد.",
@@ -1487,8 +3953,12 @@ async def admin_add_bw_price(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception:
         await update.message.reply_text("لطفا عدد صحیح وارد کنید.")
         return S_ADMIN_ADD_BW_PRICE
-    products[pid]['bw_price'] = val
-    persist_all()
+    async with locks.hold("products"):
+        if pid not in products:
+            await update.message.reply_text("خطا: جزوه یافت نشد.", reply_markup=admin_main_keyboard())
+            return S_MAIN
+        products[pid]['bw_price'] = val
+        await persist("products", pid)
     await update.message.reply_text(
         "قیمت سیاه و سفید ثبت شد.",
         reply_markup=ReplyKeyboardMarkup(
@@ -1514,37 +3984,20 @@ async def admin_list_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not products:
             await update.message.reply_text("هیچ جزوه‌ای برای حذف وجود ندارد.")
             return S_MAIN
-        kb = [[p['title']] for p in products.values()]
-        kb.append(["🔙 بازگشت"])
-        await update.message.reply_text("جزوه‌ای که می‌خواهید حذف کنید را انتخاب کنید:", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
+        await update.message.reply_text("جزوه‌ای که می‌خواهید حذف کنید را انتخاب کنید:", reply_markup=products_keyboard("🔙 بازگشت"))
         return S_ADMIN_DELETE_SELECT
 
     pid, p = find_product_by_title(text)
     if pid:
-        total_high = 0
-        total_low = 0
-        total_bw = 0
+        finalized = aggregates["orders"].ready()
+        total_high = finalized.by_type.get((pid, "رنگی کیفیت بالا"), 0)
+        total_low = finalized.by_type.get((pid, "رنگی کیفیت پایین"), 0)
+        total_bw = finalized.by_type.get((pid, "سیاه و سفید"), 0)
         detail_lines = []
-        
-        for uid_k, user_orders in orders.items():
-            for ord_entry in user_orders:
-                for it in ord_entry.get('items', []):
-                    if it.get('product_id') == pid:
-                        typ = it.get('type')
-                        qty = it.get('qty', 0)
-        
-                        if typ == "رنگی کیفیت بالا":
-                            total_high += qty
-                        elif typ == "رنگی کیفیت پایین":
-                            total_low += qty
-                        else:
-                            total_bw += qty
-        
-                        detail_lines.append(
-                            f"{ord_entry.get('first_name','')} "
-                            f"{ord_entry.get('last_name','')} — "
-                            f"{qty} — {typ}"
-                        )
+
+        for typ in PRINT_TYPES:
+            for uid_k, qty in finalized.user_totals(pid, typ).items():
+                detail_lines.append(f"{user_disp_name(uid_k)} — {qty} — {typ}")
         lines = [
             f"جزوه: {p.get('title')}",
             f"🎨 رنگی کیفیت بالا: {total_high}",
@@ -1569,33 +4022,53 @@ async def admin_delete_select_handler(update: Update, context: ContextTypes.DEFA
     if not pid:
         await update.message.reply_text("جزوه‌ای با این نام یافت نشد.")
         return S_ADMIN_DELETE_SELECT
-    del products[pid]
-    # remove references from orders and purchases
-    for uid_k in list(orders.keys()):
-        new_orders = []
-        for ord_entry in orders[uid_k]:
-            new_items = [it for it in ord_entry.get('items', []) if it.get('product_id') != pid]
-            if new_items:
-                ord_entry['items'] = new_items
-                ord_entry['total'] = sum(it['qty']*it['unit_price'] for it in new_items)
-                new_orders.append(ord_entry)
-        if new_orders:
-            orders[uid_k] = new_orders
-        else:
-            orders.pop(uid_k, None)
-    for uid_k in list(purchases.keys()):
-        new_purs = []
-        for pur in purchases[uid_k]:
-            new_items = [it for it in pur.get('items', []) if it.get('product_id') != pid]
-            if new_items:
-                pur['items'] = new_items
-                pur['total'] = sum(it['qty']*it['unit_price'] for it in new_items)
-                new_purs.append(pur)
-        if new_purs:
-            purchases[uid_k] = new_purs
-        else:
-            purchases.pop(uid_k, None)
-    persist_all()
+    async with locks.hold("products", "orders", "purchases"):
+        if pid not in products:
+            await update.message.reply_text("جزوه‌ای با این نام یافت نشد.")
+            return S_ADMIN_DELETE_SELECT
+        del products[pid]
+        # remove references from orders and purchases
+        # only the users whose records reference the product
+        touched_orders = []
+        for uid_k in indexes.users_referencing("orders", pid):
+            new_orders = []
+            changed = False
+            for ord_entry in orders[uid_k]:
+                new_items = [it for it in ord_entry.get('items', []) if it.get('product_id') != pid]
+                changed = changed or len(new_items) != len(ord_entry.get('items', []))
+                if new_items:
+                    ord_entry['items'] = new_items
+                    ord_entry['total'] = sum(it['qty']*it['unit_price'] for it in new_items)
+                    new_orders.append(ord_entry)
+            if changed or not new_orders:
+                touched_orders.append(uid_k)
+            if new_orders:
+                orders[uid_k] = new_orders
+            else:
+                orders.pop(uid_k, None)
+        touched_purchases = []
+        for uid_k in indexes.users_referencing("purchases", pid):
+            new_purs = []
+            changed = False
+            for pur in purchases[uid_k]:
+                new_items = [it for it in pur.get('items', []) if it.get('product_id') != pid]
+                changed = changed or len(new_items) != len(pur.get('items', []))
+                if new_items:
+                    pur['items'] = new_items
+                    pur['total'] = sum(it['qty']*it['unit_price'] for it in new_items)
+                    new_purs.append(pur)
+            if changed or not new_purs:
+                touched_purchases.append(uid_k)
+            if new_purs:
+                purchases[uid_k] = new_purs
+            else:
+                purchases.pop(uid_k, None)
+        persist("products", pid)
+        if touched_orders:
+            persist("orders", *touched_orders)
+        if touched_purchases:
+            persist("purchases", *touched_purchases)
+        await committer.flush()
     await update.message.reply_text(f"جزوه '{p.get('title')}' حذف شد و از سفارشات/خریدها نیز پاک شد.", reply_markup=admin_main_keyboard())
     return S_MAIN
 
@@ -1610,9 +4083,10 @@ async def admin_block_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text("آیدی باید یک عدد باشد.")
         return S_ADMIN_BLOCK_ID
-    if the_uid not in blocked:
-        blocked.append(the_uid)
-        persist_all()
+    async with locks.hold("blocked"):
+        if the_uid not in blocked:
+            blocked.add(the_uid)
+            await persist("blocked")
     await update.message.reply_text(f"کاربر {the_uid} مسدود شد.", reply_markup=admin_main_keyboard())
     return S_MAIN
 
@@ -1626,9 +4100,10 @@ async def admin_unblock_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text("آیدی باید یک عدد باشد.")
         return S_ADMIN_UNBLOCK_ID
-    if the_uid in blocked:
-        blocked.remove(the_uid)
-        persist_all()
+    async with locks.hold("blocked"):
+        if the_uid in blocked:
+            blocked.discard(the_uid)
+            await persist("blocked")
     await update.message.reply_text(f"کاربر {the_uid} رفع مسدود شد.", reply_markup=admin_main_keyboard())
     return S_MAIN
 
@@ -1644,75 +4119,120 @@ async def handle_backup_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not update.message.document:
         await update.message.reply_text("لطفا فایل بکاپ را بفرستید.", reply_markup=back_kb())
         return S_MAIN
-    import zipfile, io
-    file = await update.message.document.get_file()
-    buf = io.BytesIO()
-    await file.download_to_memory(out=buf)
-    buf.seek(0)
-    with zipfile.ZipFile(buf, 'r') as z:
-        for name in z.namelist():
-            out_path = DATA_DIR / name
-            with z.open(name) as src, open(out_path, 'wb') as dst:
-                dst.write(src.read())
-    # reload data
-    global users, products, orders, pending_payments, purchases, blocked
-    users = load_json(USERS_FILE, {})
-    products = load_json(PRODUCTS_FILE, {})
-    orders = load_json(ORDERS_FILE, {})
-    pending_payments = load_json(PENDING_PAYMENTS_FILE, {})
-    purchases = load_json(PURCHASES_FILE, {})
-    blocked = load_json(BLOCKED_FILE, [])
-    persist_all()
+    zip_path = DATA_DIR / "restore.zip.part"
+    try:
+        await download_to_file(await update.message.document.get_file(), zip_path)
+        meta = await io_executor.run(stage_backup, zip_path, RESTORE_DIR, kind="backup_extract")
+        if meta and meta.get("kind") == "delta":
+            await io_executor.run(validate_delta, meta, kind="backup_extract")
+            return await restore_backup_delta(update, context, meta)
+        restored = await io_executor.run(load_staged, RESTORE_DIR, kind="backup_extract")
+    except BackupError as e:
+        context.user_data.pop('awaiting_backup_file', None)
+        await update.message.reply_text(f"❌ بکاپ بازیابی نشد: {e}", reply_markup=admin_main_keyboard())
+        return S_MAIN
+    finally:
+        zip_path.unlink(missing_ok=True)
+
+    def swap():
+        # in place, so the tracked collections keep their identity
+        for name, data in restored.items():
+            _replace_collection(_loaded[name], data)
+        adopt_items(_loaded)
+        rebuild_derived()
+
+    await storage.install(swap, RESTORE_DIR)
+    # a delta of this base may follow; later auto backups start from a new full
+    await backups.mark_restored((meta or {}).get("base"), 0)
+    backups.force_full()
     context.user_data.pop('awaiting_backup_file', None)
     await update.message.reply_text("✅ بکاپ با موفقیت بازیابی شد.", reply_markup=admin_main_keyboard())
     return S_MAIN
 
+async def restore_backup_delta(update: Update, context: ContextTypes.DEFAULT_TYPE, delta: dict):
+    context.user_data.pop('awaiting_backup_file', None)
+    base, seq = delta.get("base"), delta.get("seq", 0)
+    if backups.restored["base"] != base or seq <= backups.restored["seq"]:
+        await update.message.reply_text(
+            f"این فایل تغییرات پایه {base} است. ابتدا بکاپ کامل همین پایه را وارد کنید، بعد جدیدترین فایل تغییرات را.",
+            reply_markup=admin_main_keyboard(),
+        )
+        return S_MAIN
+    # the changes are WAL entries: apply them and log them like any other edit
+    ticket = None
+    for entry in delta["changes"]:
+        _apply_change(_loaded, entry)
+        ticket = persist(entry["c"], entry["k"]) if "k" in entry else persist(entry["c"])
+    adopt_items(_loaded)
+    if ticket is not None:
+        await ticket
+    await backups.mark_restored(base, seq)
+    backups.force_full()
+    await update.message.reply_text(f"✅ تغییرات {seq} روی بکاپ پایه {base} اعمال شد.", reply_markup=admin_main_keyboard())
+    return S_MAIN
+
 
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    # Telegram may deliver the same callback twice (webhook retries)
+    if not seen_callbacks.first_time(query.id):
+        payment_stats["duplicate_callbacks"] += 1
+        return
+    try:
+        return await _handle_callback_query(update, context)
+    except Exception:
+        # failed part way (e.g. a commit error): let a redelivery or a retry run
+        # again; the payment status checks keep it from being settled twice
+        seen_callbacks.forget(query.id)
+        raise
+
+
+async def _handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
     data = query.data or ""
 
-    if data.startswith("pay_approve:"):
+    if data.startswith(("pay_approve:", "pay_reject:")):
         pay_id = data.split(":",1)[1]
         pay = pending_payments.get(pay_id)
-        if not pay:
-            try:
-                await query.edit_message_caption(caption="این فیش دیگر موجود نیست یا قبلا پردازش شده.", reply_markup=None)
-            except Exception:
-                pass
+        if not pay or pay.get("status") != "pending":
+            # settled (and archived) already: one dict lookup, no write, no message to the user
+            payment_stats["lost_race"] += 1
+            await query.answer("این فیش قبلا پردازش شده است.")
             return
+    await query.answer()
+
+    if data.startswith("pay_approve:"):
         uid = pay.get("user_id")
-        # find and remove order
-        user_orders = orders.get(str(uid), [])
-        ord_to_remove = None
-        for ord_entry in list(user_orders):
-            if ord_entry.get("order_id") == pay.get("order_id"):
-                ord_to_remove = ord_entry
-                break
-        if not ord_to_remove:
-            try:
-                await query.edit_message_caption(caption="سفارش مربوطه یافت نشد.", reply_markup=None)
-            except Exception:
-                pass
-            return
-        purchase = {
-            "purchase_id": str(uuid.uuid4()),
-            "user_id": uid,
-            "first_name": users.get(str(uid), {}).get("first_name"),
-            "last_name": users.get(str(uid), {}).get("last_name"),
-            "items": ord_to_remove.get("items", []),
-            "total": ord_to_remove.get("total",0),
-            "timestamp": datetime.datetime.utcnow().isoformat(),
-        }
-        purchases.setdefault(str(uid), []).append(purchase)
-        # remove order
-        orders[str(uid)].remove(ord_to_remove)
-        # update payment
-        pay['status'] = 'approved'
-        pay['processed_by'] = update.effective_user.id
-        pay['processed_at'] = datetime.datetime.utcnow().isoformat()
-        persist_all()
+        async with locks.hold(user_lock(uid)):
+            # another admin (maybe in another worker) may have settled it while we waited for the lock
+            pay = pending_payments.get(pay_id)
+            if not pay or pay.get("status") != "pending":
+                payment_stats["lost_race"] += 1
+                return
+            async with locks.hold("orders", "purchases"):
+                # find and remove order
+                _, ord_to_remove = indexes.order(pay.get("order_id"), str(uid))
+                if ord_to_remove:
+                    transition_payment(pay_id, "pending", "approved", update.effective_user.id)
+                    purchase = {
+                        "purchase_id": str(uuid.uuid4()),
+                        "user_id": uid,
+                        "items": ord_to_remove.get("items", []),
+                        "total": ord_to_remove.get("total",0),
+                        "timestamp": datetime.datetime.utcnow().isoformat(),
+                    }
+                    purchases.setdefault(str(uid), []).append(purchase)
+                    # remove order
+                    orders[str(uid)].remove(ord_to_remove)
+                    persist("purchases", str(uid))
+                    persist("orders", str(uid))
+            if not ord_to_remove:
+                try:
+                    await query.edit_message_caption(caption="سفارش مربوطه یافت نشد.", reply_markup=None)
+                except Exception:
+                    pass
+                return
+            await archive_payment(pay_id)
         try:
             await query.edit_message_caption(caption=(query.message.caption or "") + "\n\n✅ این فیش تأیید شد.", reply_markup=None)
         except Exception:
@@ -1724,18 +4244,11 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     if data.startswith("pay_reject:"):
-        pay_id = data.split(":",1)[1]
-        pay = pending_payments.get(pay_id)
-        if not pay:
-            try:
-                await query.edit_message_caption(caption="این فیش دیگر موجود نیست یا قبلا پردازش شده.", reply_markup=None)
-            except Exception:
-                pass
-            return
-        pay['status'] = 'rejected'
-        pay['processed_by'] = update.effective_user.id
-        pay['processed_at'] = datetime.datetime.utcnow().isoformat()
-        persist_all()
+        # same lock as approve: with several workers the compare-and-set alone is per process
+        async with locks.hold(user_lock(pay.get("user_id"))):
+            if not transition_payment(pay_id, "pending", "rejected", update.effective_user.id):
+                return
+            await archive_payment(pay_id)
         try:
             await query.edit_message_caption(caption=(query.message.caption or "") + "\n\n❌ این فیش رد شد.", reply_markup=None)
         except Exception:
@@ -1750,15 +4263,16 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     if data.startswith("reply_user:"):
         target_uid = int(data.split(":",1)[1])
         context.user_data['reply_to'] = target_uid
-        await query.message.reply_text(f"حالا پیام خود را تایپ کنید تا برای {make_disp_name(users.get(str(target_uid),{}))} ارسال شود.")
+        await query.message.reply_text(f"حالا پیام خود را تایپ کنید تا برای {user_disp_name(target_uid)} ارسال شود.")
         return
 
     if data.startswith("confirm_delete_list:"):
         action = data.split(":",1)[1]
         if action == "buyers":
             # delete purchases for all
-            purchases.clear()
-            persist_all()
+            async with locks.hold("purchases"):
+                purchases.clear()
+                await persist("purchases")
             try:
                 await query.edit_message_text("همهٔ اسامی خریداران و خریدهایشان حذف شد.", reply_markup=None)
             except Exception:
@@ -1771,8 +4285,9 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
             return
         if action == "reg_names":
             # delete all orders (finalized) for everyone
-            orders.clear()
-            persist_all()
+            async with locks.hold("orders"):
+                orders.clear()
+                await persist("orders")
             try:
                 await query.edit_message_text("همهٔ اسامی ثبت نهایی کنندگان و سفارشاتشان حذف شد.", reply_markup=None)
             except Exception:
@@ -1807,8 +4322,11 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
                     pass
             return
         the_uid = action
-        purchases.pop(str(the_uid), None)
-        persist_all()
+        async with locks.hold(user_lock(the_uid)):
+            async with locks.hold("purchases"):
+                purchases.pop(str(the_uid), None)
+                saved = persist("purchases", str(the_uid))
+            await saved
         try:
             await query.edit_message_text("تمام خریدهای این کاربر حذف شد.", reply_markup=None)
         except Exception:
@@ -1832,8 +4350,11 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
                     pass
             return
         the_uid = action
-        orders.pop(str(the_uid), None)
-        persist_all()
+        async with locks.hold(user_lock(the_uid)):
+            async with locks.hold("orders"):
+                orders.pop(str(the_uid), None)
+                saved = persist("orders", str(the_uid))
+            await saved
         try:
             await query.edit_message_text("تمام جزوات نهایی این کاربر حذف شد.", reply_markup=None)
         except Exception:
@@ -1863,7 +4384,7 @@ async def handle_manage_admins(update: Update, context: ContextTypes.DEFAULT_TYP
             await update.message.reply_text("هیچ ادمینی وجود ندارد.", reply_markup=back_kb())
             return S_MANAGE_ADMINS
 
-        kb = [[KeyboardButton(str(a))] for a in admins]
+        kb = [[KeyboardButton(str(a))] for a in sorted(admins)]
         kb.append([KeyboardButton("🔙 بازگشت")])
         await update.message.reply_text(
             "ادمین مورد نظر برای حذف را انتخاب کنید:",
@@ -1884,15 +4405,15 @@ async def handle_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ آیدی نامعتبر است.", reply_markup=back_kb())
         return S_ADD_ADMIN
 
-    if new_admin in admins:
-        await update.message.reply_text("⚠️ این کاربر از قبل ادمین است.", reply_markup=admin_main_keyboard())
-        return S_MAIN
-
-    if str(new_admin) in users:
-        del users[str(new_admin)]
+    async with locks.hold("admins"):
+        if new_admin in admins:
+            await update.message.reply_text("⚠️ این کاربر از قبل ادمین است.", reply_markup=admin_main_keyboard())
+            return S_MAIN
 
-    admins.append(new_admin)
-    persist_all()
+        # the user record stays: their orders and purchases only carry user_id and
+        # read the name from it (record_disp_name)
+        admins.add(new_admin)
+        await persist("admins")
     await update.message.reply_text(f"✅ کاربر {new_admin} به عنوان ادمین اضافه شد.", reply_markup=admin_main_keyboard())
     return S_MAIN
 
@@ -1909,32 +4430,264 @@ async def handle_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ مقدار وارد شده معتبر نیست.", reply_markup=back_kb())
         return S_REMOVE_ADMIN
 
-    if admin_id not in admins:
-        await update.message.reply_text("⚠️ چنین ادمینی وجود ندارد.", reply_markup=admin_main_keyboard())
-        return S_MAIN
+    async with locks.hold("admins"):
+        if admin_id not in admins:
+            await update.message.reply_text("⚠️ چنین ادمینی وجود ندارد.", reply_markup=admin_main_keyboard())
+            return S_MAIN
 
-    admins.remove(admin_id)
-    persist_all()
+        admins.discard(admin_id)
+        await persist("admins")
     await update.message.reply_text(f"🚫 ادمین {admin_id} حذف شد و به کاربر عادی تبدیل گردید.", reply_markup=admin_main_keyboard())
     return S_MAIN
 # --- 🔼 پایان کد جدید ---
 
 
 # ---------------- setup & run for Render (FastAPI + Webhook) ----------------
-from fastapi import FastAPI, Request, HTTPException
+startup.mark("handlers")
+from fastapi import FastAPI, Request, HTTPException, Response
 import os
 from telegram import Update
 from telegram.ext import ApplicationBuilder
+startup.mark("fastapi")
 
 # Allow overriding token via environment variable for secure deployments
 TOKEN = os.getenv("BOT_TOKEN", os.getenv("TOKEN", TOKEN))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # e.g. https://<your-service>.onrender.com/webhook
+# a self-hosted (or fake, for load tests) Bot API server instead of api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL")
 
 # Create FastAPI app
 fastapi_app = FastAPI()
 
+# ----------------------------- Persistence -----------------------------
+# وضعیت ConversationHandler و context.user_data هم در همان storage نوشته می‌شوند،
+# تا ری‌دیپلوی یا کرش خرید و فیشِ نیمه‌کاره را از بین نبرد.
+# PTB hands over the touched users every SESSION_FLUSH_INTERVAL seconds; the
+# ones whose data did not change are skipped, the rest share one group commit.
+# A user's data is read on that user's first update after a restart, not at startup.
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+
+
+class StorePersistence(BasePersistence):
+    def __init__(self, update_interval: float = SESSION_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.conversations = _loaded["conversations"]   # "<name>:<chat_id>:<user_id>" -> state
+        self.user_data = _loaded["user_data"]           # user key -> user_data as last written
+        self._refreshed: Dict[int, dict] = {}           # user id -> the live context.user_data
+        self.handlers: Dict[str, ConversationHandler] = {}
+        self.stats = {"loaded": 0, "written": 0, "unchanged": 0, "states_written": 0, "foreign": 0}
+        feed.listeners.append(self.apply_foreign)
+
+    def track(self, handler: ConversationHandler):
+        self.handlers[handler.name] = handler
+
+    def apply_foreign(self, entry: dict):
+        # another worker handled this user last: bring the live PTB state up to date
+        name, key = entry["c"], entry.get("k")
+        if key is None or name not in SESSION_COLLECTIONS:
+            return
+        value = None if entry.get("d") else entry.get("v")
+        if name == "conversations":
+            conv_name, chat_id, user_id = key.split(":")
+            handler = self.handlers.get(conv_name)
+            if handler is None:
+                return
+            # PTB has no public setter; update_no_track keeps this out of the next update_persistence
+            states = handler._conversations
+            if value is None:
+                states.data.pop((int(chat_id), int(user_id)), None)
+            else:
+                states.update_no_track({(int(chat_id), int(user_id)): value})
+        else:
+            live = self._refreshed.get(int(key))
+            if live is None:
+                return   # not seen here yet: refresh_user_data reads it when it is
+            live.clear()
+            live.update(copy.deepcopy(value or {}))
+        self.stats["foreign"] += 1
+
+    async def get_conversations(self, name: str) -> dict:
+        prefix = f"{name}:"
+        return {
+            tuple(int(part) for part in key[len(prefix):].split(":")): state
+            for key, state in self.conversations.items() if key.startswith(prefix)
+        }
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        conv_key = ":".join(map(str, (name, *key)))
+        if self.conversations.get(conv_key) == new_state:
+            return
+        if new_state is None:
+            self.conversations.pop(conv_key)
+        else:
+            self.conversations[conv_key] = new_state
+        self.stats["states_written"] += 1
+        await persist("conversations", conv_key)
+
+    async def get_user_data(self) -> dict:
+        # nothing up front: refresh_user_data loads each user when they show up
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id in self._refreshed:
+            return
+        self._refreshed[user_id] = user_data
+        key = str(user_id)
+        stored = await query("session_record", "user_data", key)
+        if stored is None:
+            return
+        if not storage.queries_memory:
+            self.user_data[key] = stored
+        # a copy: handlers must not edit the stored version behind update_user_data's back
+        user_data.update(copy.deepcopy(stored))
+        self.stats["loaded"] += 1
+
+    async def update_user_data(self, user_id: int, data: dict):
+        # PTB sends every user that had an update, changed or not
+        key = str(user_id)
+        value = data or None
+        if self.user_data.get(key) == value:
+            self.stats["unchanged"] += 1
+            return
+        if value is None:
+            self.user_data.pop(key)
+        else:
+            self.user_data[key] = value   # already a deep copy made by PTB
+        self.stats["written"] += 1
+        await persist("user_data", key)
+
+    async def drop_user_data(self, user_id: int):
+        await self.update_user_data(user_id, {})
+
+    async def flush(self):
+        await committer.flush()
+
+    # chat_data, bot_data and callback_data are not used by this bot
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+
+# ----------------------------- Metrics -----------------------------
+# هر فراخوانی Bot API و هر هندلر زمان‌گیری می‌شود؛ خروجی در /metrics.
+# Errors without a response (timeouts, connection resets) are counted by exception
+# type; 429s and other error statuses by code. Resends after a 429 or a network
+# error happen in Broadcaster and show up in its counters.
+from telegram.request import BaseRequest, HTTPXRequest
+
+
+class InstrumentedRequest(BaseRequest):
+    """BaseRequest دیگری را می‌پوشاند و زمان و نتیجهٔ هر فراخوانی را به تفکیک متد می‌شمارد"""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        # file downloads go to .../file/bot<token>/<path>: one label for all of them
+        api_method = "download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            api_errors.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - t0, api_method)
+        api_responses.inc(api_method, code)
+        return code, payload
+
+
+STATE_NAMES = {value: name[2:].lower() for name, value in globals().items()
+               if name.startswith("S_") and isinstance(value, int)}
+
+
+def timed(callback, state: str):
+    name = getattr(callback, "__name__", "handler").strip("<>")
+
+    @functools.wraps(callback)
+    async def run(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise   # control flow (the blocked-user gate), not a failure
+        except Exception:
+            handler_errors.inc(name, state)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - t0, name, state)
+    return run
+
+
+def instrument_handlers(application):
+    # conversation handlers are labelled by the state they serve; entry points and
+    # fallbacks run in any state, everything outside the conversation has none
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                for h in handler.entry_points:
+                    h.callback = timed(h.callback, "entry")
+                for state, state_handlers in handler.states.items():
+                    for h in state_handlers:
+                        h.callback = timed(h.callback, STATE_NAMES.get(state, str(state)))
+                for h in handler.fallbacks:
+                    h.callback = timed(h.callback, "fallback")
+            else:
+                handler.callback = timed(handler.callback, "none")
+
+
+# Connections to the Bot API, per process. Each update worker (see Update
+# Queue) has at most one request in flight and the broadcaster at most
+# BROADCAST_CONCURRENCY; a few more cover the background jobs (backups, the
+# snapshot sender). PTB's default of 256 is not tied to any of that; sized to
+# what we can actually have in flight, a stuck request shows up as pool wait
+# in the bot_api latency instead of as a growing socket count. getUpdates
+# needs a single connection.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+BOT_API_POOL = int(os.getenv("BOT_API_POOL", str(UPDATE_WORKERS + BROADCAST_CONCURRENCY + 4)))
+
 # Recreate Application with possibly updated TOKEN
-application = ApplicationBuilder().token(TOKEN).build()
+builder = ApplicationBuilder().token(TOKEN).persistence(StorePersistence())
+if BOT_API_URL:
+    builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+if METRICS:
+    builder = builder.request(InstrumentedRequest(HTTPXRequest(connection_pool_size=BOT_API_POOL)))
+    builder = builder.get_updates_request(InstrumentedRequest(HTTPXRequest(connection_pool_size=1)))
+else:
+    builder = builder.connection_pool_size(BOT_API_POOL)
+application = builder.build()
 
 # Register the same handlers into this 'application' instance.
 # We'll reuse the ConversationHandler and CallbackQueryHandler setup from original main.
@@ -1944,45 +4697,49 @@ async def ignore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def setup_handlers_for_web(application):
+    application.add_handler(TypeHandler(Update, drop_blocked), group=-1)
     conv = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', actor(start))],
         states={
             S_MAIN: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_main),
-                MessageHandler(filters.Document.ALL & filters.User(ADMIN_ID), handle_backup_file),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, actor(handle_text_main)),
+                MessageHandler(filters.Document.ALL & filters.User(ADMIN_ID), actor(handle_backup_file)),
             ],
-            S_REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_name)],
-            S_REGISTER_DORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_dorm)],
-            S_REGISTER_OTHER_DORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_other_dorm_name)],
-            S_BUY_SELECT_PRODUCT: [MessageHandler(filters.TEXT & ~filters.COMMAND, buy_select_product)],
-            S_BUY_SELECT_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, buy_select_type)],
-            S_BUY_ENTER_QTY: [MessageHandler(filters.TEXT & ~filters.COMMAND, buy_enter_qty)],
+            S_REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(register_name))],
+            S_REGISTER_DORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(register_dorm))],
+            S_REGISTER_OTHER_DORM: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(register_other_dorm_name))],
+            S_BUY_SELECT_PRODUCT: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(buy_select_product))],
+            S_BUY_SELECT_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(buy_select_type))],
+            S_BUY_ENTER_QTY: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(buy_enter_qty))],
             S_AWAITING_RECEIPT: [
-                MessageHandler(filters.PHOTO, handle_photo_receipt),
-                MessageHandler(filters.ALL, handle_photo_receipt),
+                MessageHandler(filters.PHOTO, actor(handle_photo_receipt)),
+                MessageHandler(filters.ALL, actor(handle_photo_receipt)),
             ],
-            S_ADMIN_ADD_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_product_name)],
-            S_ADMIN_ADD_CHOOSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_product_choice)],
-            S_ADMIN_ADD_COLOR_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_color_price)],
-            S_ADMIN_ADD_BW_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_bw_price)],
-            S_ADMIN_LIST: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_list_handler)],
-            S_ADMIN_DELETE_SELECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_delete_select_handler)],
-            S_ADMIN_BLOCK_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_block_id)],
-            S_ADMIN_UNBLOCK_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_unblock_id)],
+            S_ADMIN_ADD_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_add_product_name))],
+            S_ADMIN_ADD_CHOOSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_add_product_choice))],
+            S_ADMIN_ADD_COLOR_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_add_color_price))],
+            S_ADMIN_ADD_BW_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_add_bw_price))],
+            S_ADMIN_LIST: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_list_handler))],
+            S_ADMIN_DELETE_SELECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_delete_select_handler))],
+            S_ADMIN_BLOCK_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_block_id))],
+            S_ADMIN_UNBLOCK_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, actor(admin_unblock_id))],
 
             # --- 🔽 Stateهای جدید برای مدیریت ادمین‌ها ---
-            S_MANAGE_ADMINS: [MessageHandler(..., handle_manage_admins)],
-            S_ADD_ADMIN: [MessageHandler(..., handle_add_admin)],
-            S_REMOVE_ADMIN: [MessageHandler(..., handle_remove_admin)],
+            S_MANAGE_ADMINS: [MessageHandler(..., actor(handle_manage_admins))],
+            S_ADD_ADMIN: [MessageHandler(..., actor(handle_add_admin))],
+            S_REMOVE_ADMIN: [MessageHandler(..., actor(handle_remove_admin))],
             # --- 🔼 پایان stateهای جدید ---
         },
-        fallbacks=[MessageHandler(filters.COMMAND, ignore_command)],
+        fallbacks=[MessageHandler(filters.COMMAND, actor(ignore_command))],
         allow_reentry=True,
+        name="main",
+        persistent=True,
     )
+    application.persistence.track(conv)
 
 
     application.add_handler(conv)
-    application.add_handler(CallbackQueryHandler(callback_query_handler))
+    application.add_handler(CallbackQueryHandler(actor(callback_query_handler)))
     # Admin reply handling & other message handlers as in original
     async def admin_text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = update.effective_user.id
@@ -1992,50 +4749,210 @@ def setup_handlers_for_web(application):
     application.add_handler(MessageHandler(filters.TEXT & filters.User(ADMIN_ID), admin_text_router))
     application.add_handler(MessageHandler(filters.PHOTO & filters.User(ADMIN_ID), admin_text_router))
     application.add_handler(MessageHandler((filters.TEXT | filters.PHOTO) & ~filters.User(ADMIN_ID), lambda u,c: None))
+    if METRICS:
+        instrument_handlers(application)
     return application
 
 # Register handlers
 application = setup_handlers_for_web(application)
 
+# ----------------------------- Update Queue -----------------------------
+# /webhook only enqueues the update and answers 200 right away. Each user (or
+# chat) has its own chain of queued updates; UPDATE_WORKERS workers take the
+# next update of whichever user is waiting, one update of a user at a time.
+# One user's updates stay in order, and a slow handler (a paced fan-out to the
+# admins, an export) holds up only that user and one worker, not everyone who
+# happens to share a queue with them. UPDATE_WORKERS is read next to the
+# builder above, since it also sizes the Bot API connection pool.
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))   # all users together
+
+
+class UpdateQueue:
+    def __init__(self, app, workers: int = UPDATE_WORKERS, size: int = UPDATE_QUEUE_SIZE):
+        self.app = app
+        self.workers = max(1, workers)
+        # key -> its queued (enqueued_at, update), oldest first; the key stays here while
+        # a worker runs its update, so a second worker never picks the same user
+        self._pending: Dict[int, collections.deque] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()   # keys with a queued update and no worker
+        self._slots = asyncio.Semaphore(max(1, size))
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.depth = 0
+        self._tasks: List[asyncio.Task] = []
+        self.latencies = collections.deque(maxlen=1000)   # enqueue → handled, seconds
+        self.counters = {"enqueued": 0, "processed": 0, "failed": 0, "in_flight": 0}
+
+    def _key(self, update: Update) -> int:
+        user, chat = update.effective_user, update.effective_chat
+        return user.id if user else chat.id if chat else update.update_id
+
+    async def put(self, update: Update):
+        # waits only when UPDATE_QUEUE_SIZE updates are queued: back-pressure instead of unbounded memory
+        await self._slots.acquire()
+        key = self._key(update)
+        chain = self._pending.get(key)
+        if chain is None:
+            chain = self._pending[key] = collections.deque()
+            self._ready.put_nowait(key)
+        chain.append((time.perf_counter(), update))
+        self.depth += 1
+        self._idle.clear()
+        self.counters["enqueued"] += 1
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            chain = self._pending[key]
+            enqueued_at, update = chain.popleft()
+            self.depth -= 1
+            self._slots.release()
+            self.counters["in_flight"] += 1
+            try:
+                if MULTI_WORKER:
+                    await self._process_shared(update)
+                else:
+                    await self.app.process_update(update)
+            except Exception as e:
+                self.counters["failed"] += 1
+                logger.exception("Update %s failed: %s", update.update_id, e)
+            finally:
+                startup.first_update()
+                self.counters["in_flight"] -= 1
+                self.counters["processed"] += 1
+                elapsed = time.perf_counter() - enqueued_at
+                self.latencies.append(elapsed)
+                update_seconds.observe(elapsed)
+                if chain:
+                    # the user's next update goes behind the users already waiting
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                    if not self._pending:
+                        self._idle.set()
+
+    async def _process_shared(self, update: Update):
+        # the user's previous update may have gone to another worker: take the user's key
+        # across processes (which also catches up on the change feed), run the handlers
+        # and write the conversation state and user_data through before letting go
+        user = update.effective_user
+        async with locks.hold(*((actor_key(user.id),) if user else ())):
+            await self.app.process_update(update)
+            await self.app.update_persistence()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        # let queued updates finish, then stop the workers
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d queued updates on shutdown", self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        lat = sorted(self.latencies)
+        return {
+            "workers": self.workers,
+            "depth": self.depth,
+            "users": len(self._pending),
+            "max_user_depth": max(map(len, self._pending.values()), default=0),
+            **self.counters,
+            "latency_ms": {
+                "avg": round(sum(lat) / len(lat) * 1000, 2) if lat else 0.0,
+                **{f"p{q}": round(lat[min(len(lat) - 1, int(len(lat) * q / 100))] * 1000, 2) if lat else 0.0
+                   for q in (50, 95, 99)},
+                "max": round(lat[-1] * 1000, 2) if lat else 0.0,
+            },
+        }
+
+
+update_queue = UpdateQueue(application)
+
 # FastAPI lifecycle events
 
 import asyncio
 
 async def auto_backup():
     while True:
-        import zipfile, io
-        buf = io.BytesIO()
-        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
-            for f in [USERS_FILE, PRODUCTS_FILE, ORDERS_FILE, PENDING_PAYMENTS_FILE, PURCHASES_FILE, BLOCKED_FILE]:
-                if f.exists():
-                    z.write(f, arcname=f.name)
-        buf.seek(0)
+        # wait first: right after a (cold) start the CPU belongs to the updates that woke us
+        await asyncio.sleep(BACKUP_INTERVAL)
         try:
-            await application.bot.send_document(
-                chat_id=ADMIN_ID,
-                document=buf,
-                filename="auto_backup.zip",
-                caption="📦 بکاپ خودکار هر 1 دقیقه",
-            )
+            await backups.tick(application.bot, ADMIN_ID)
         except Exception as e:
             logger.warning(f"Auto backup failed: {e}")
-        await asyncio.sleep(60)  # ۱ دقیقه
+
+
+webhook_stats = {"checked": 0, "set": 0, "unchanged": 0}
+
+async def ensure_webhook():
+    # Telegram keeps the webhook across restarts and already delivers to it: check it
+    # after startup instead of setting it again before the first update is served
+    try:
+        webhook_stats["checked"] += 1
+        info = await application.bot.get_webhook_info()
+        if info.url == WEBHOOK_URL:
+            webhook_stats["unchanged"] += 1
+            return
+        await application.bot.set_webhook(WEBHOOK_URL)
+        webhook_stats["set"] += 1
+        logger.info("✅ Webhook set to %s", WEBHOOK_URL)
+    except Exception as e:
+        logger.warning(f"Webhook check failed: {e}")
+
+
+async def startup_migrations():
+    await archive_settled_payments()
+    await normalize_user_refs()
+
+
+def start_singleton_jobs():
+    # If webhook URL provided, make sure Telegram has it
+    if WEBHOOK_URL:
+        application.create_task(ensure_webhook())
+    application.create_task(auto_backup())
+    application.create_task(wal_compactor())
+    if MULTI_WORKER:
+        application.create_task(trim_change_feed())
+
+
+async def lead():
+    # multi-worker: whichever worker holds the leader lease
+    await startup_migrations()
+    start_singleton_jobs()
 
 
 @fastapi_app.on_event("startup")
 async def on_startup():
     try:
+        startup.mark("server")
         await application.initialize()
-        # If webhook URL provided, set webhook and start application
+        startup.mark("initialize")
+        if not MULTI_WORKER:
+            await startup_migrations()
+            startup.mark("migrations")
+        await application.start()
+        update_queue.start()
+        startup.mark("start")
+        application.create_task(loop_lag_monitor())
+        if MULTI_WORKER:
+            application.create_task(feed.poll())
+            application.create_task(leader.run(lead))
+            logger.info("Worker %s started (%d workers)", WORKER_ID, WEB_WORKERS)
+        else:
+            start_singleton_jobs()
+        if STARTUP_PROFILE:
+            logger.info("Startup profile (ready after %.0f ms): %s",
+                        (time.perf_counter() - startup.started) * 1000, startup.phases)
         if WEBHOOK_URL:
-            await application.bot.set_webhook(WEBHOOK_URL)
-            await application.start()
-            application.create_task(auto_backup())
-            logger.info("✅ Webhook set to %s and bot started", WEBHOOK_URL)
+            logger.info("✅ Bot started, webhook %s", WEBHOOK_URL)
         else:
             # No webhook configured: we'll initialize but not set webhook (useful for local dev)
-            await application.start()
-            application.create_task(auto_backup())
             logger.info("No WEBHOOK_URL set. Bot started without webhook (use polling locally if desired).")
     except Exception as e:
         logger.exception("Failed to start bot on startup: %s", e)
@@ -2044,8 +4961,13 @@ async def on_startup():
 @fastapi_app.on_event("shutdown")
 async def on_shutdown():
     try:
+        await update_queue.stop()
         await application.stop()
         await application.shutdown()
+        await compact()
+        committer.close()
+        storage.close()
+        io_executor.shutdown()
         logger.info("Bot stopped on shutdown")
     except Exception as e:
         logger.exception("Error during shutdown: %s", e)
@@ -2058,7 +4980,8 @@ async def telegram_webhook(request: Request):
         logger.warning("Received webhook call but WEBHOOK_URL not configured - processing anyway")
     body = await request.json()
     update = Update.de_json(body, application.bot)
-    await application.process_update(update)
+    # answer Telegram now; a worker runs the handlers
+    await update_queue.put(update)
     return {"ok": True}
 
 
@@ -2066,7 +4989,49 @@ async def telegram_webhook(request: Request):
 @fastapi_app.get("/health")
 @fastapi_app.head("/health")
 async def health_check():
-    return {"status": "ok", "time": datetime.datetime.utcnow().isoformat()}
+    return {"status": "ok", "time": datetime.datetime.utcnow().isoformat(), "io": io_executor.stats(),
+            "updates": update_queue.stats(), "locks": locks.snapshot(), "payments": {**payment_stats, "outstanding": len(pending_payments)}, "broadcast": broadcaster.stats, "media_cache": media_cache.stats, "render": render_cache.stats, "gate": gate_stats, "sessions": application.persistence.stats, "startup": {**startup.report(), "webhook": webhook_stats},
+            "worker": {"id": WORKER_ID, "workers": WEB_WORKERS, "leader": leader.is_leader, "feed": {"seq": feed.seq, **feed.stats},
+                       "shared_locks": locks.shared.stats if locks.shared is not None else None},
+            "backups": {**backups.stats, "base": backups.state.get("base"), "seq": backups.state.get("seq")}}
+
+
+# ----------------------------- Prometheus Metrics -----------------------------
+# Counters and histograms are recorded where things happen (see METRICS); the
+# rest is read from the stats blocks /health already shows. With WEB_WORKERS > 1
+# every process keeps its own numbers: the worker label says whose a scrape got.
+StatMetric("worker_info", "This process", lambda: {(WORKER_ID, str(leader.is_leader).lower()): 1},
+           labels=("worker", "leader"))
+StatMetric("update_queue_depth", "Updates waiting for a worker", lambda: update_queue.depth)
+StatMetric("update_queue_users", "Users with an update queued or being handled", lambda: len(update_queue._pending))
+StatMetric("updates_in_flight", "Updates being handled", lambda: update_queue.counters["in_flight"])
+StatMetric("updates_total", "Updates by outcome", lambda: {(k,): update_queue.counters[k] for k in ("enqueued", "processed", "failed")},
+           kind="counter", labels=("outcome",))
+StatMetric("commit_staged_entries", "Change entries waiting for the next group commit", lambda: len(committer._entries))
+StatMetric("commit_batches_total", "Group commit batches written", lambda: committer.stats["batches"], kind="counter")
+StatMetric("commit_entries_total", "Change entries written by group commits", lambda: committer.stats["entries"], kind="counter")
+StatMetric("commit_failures_total", "Group commit batches that failed and were queued again",
+           lambda: committer.stats["failed"], kind="counter")
+StatMetric("io_jobs", "I/O executor jobs", lambda: {("waiting",): io_executor.waiting, ("running",): io_executor.running},
+           labels=("status",))
+StatMetric("loop_lag_seconds", "Event loop lag at the last check", lambda: io_executor.loop_lag["last_ms"] / 1000)
+StatMetric("lock_keys", "Keys currently locked or waited on", lambda: len(locks._locks))
+StatMetric("lock_contended_total", "Lock acquisitions that had to wait", lambda: locks.stats["contended"], kind="counter")
+StatMetric("broadcast_total", "Broadcast sends by outcome",
+           lambda: {(k,): broadcaster.stats[k] for k in ("sent", "failed", "retries")}, kind="counter", labels=("outcome",))
+StatMetric("broadcast_retry_after_seconds_total", "Seconds Telegram asked broadcasts to wait (429)",
+           lambda: broadcaster.stats["retry_after_s"], kind="counter")
+StatMetric("pending_payments", "Receipts waiting for an admin", lambda: len(pending_payments))
+
+
+@fastapi_app.get("/metrics")
+async def metrics_endpoint():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+startup.mark("module")
+gc.freeze()   # the views, handlers and app built since the load are just as long-lived
+atexit.register(gc.unfreeze)   # interpreter shutdown still finalizes them in order
 
 
 # ----------------------------- Run Modes -----------------------------
@@ -2089,7 +5054,11 @@ if __name__ == "__main__":
     # در غیر این صورت (Render) FastAPI با uvicorn اجرا شود
     else:
         port = int(os.environ.get("PORT", 10000))
-        uvicorn.run(fastapi_app, host="0.0.0.0", port=port)
+        if MULTI_WORKER:
+            # each worker process imports the module itself
+            uvicorn.run("main:fastapi_app", host="0.0.0.0", port=port, workers=WEB_WORKERS)
+        else:
+            uvicorn.run(fastapi_app, host="0.0.0.0", port=port)
 
 
 # ----------------------------- Expose App for Render -----------------------------